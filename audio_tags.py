@@ -0,0 +1,235 @@
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+from logger import get_logger
+
+log = get_logger("audio_tags")
+
+try:
+    # mutagen 为可选依赖，未安装时不写入标签，本地匹配退化为按文件名匹配
+    import mutagen
+    from mutagen.id3 import ID3, ID3NoHeaderError, TIT2, TPE1, TXXX
+    from mutagen.mp4 import MP4, MP4FreeForm
+except ImportError:
+    mutagen = None
+
+# 自定义标签名：ID3 使用 TXXX 帧描述，Vorbis 注释使用小写键，MP4 使用自由格式原子
+MID_TAG = "QQMUSIC_MID"
+QUALITY_TAG = "QQMUSIC_QUALITY"
+_MP4_FREEFORM_PREFIX = "----:com.qqmusic:"
+
+def write_tags(path: str, mid: str, title: str, artists: List[str], quality: str) -> bool:
+    """将歌曲 mid、标题、歌手和音质写入音频文件标签（同步执行，应放在线程池中调用）
+
+    Returns:
+        bool: 是否写入成功
+    """
+    if mutagen is None:
+        return False
+    try:
+        if path.endswith(".mp3"):
+            try:
+                tags = ID3(path)
+            except ID3NoHeaderError:
+                tags = ID3()
+            tags.setall("TIT2", [TIT2(encoding=3, text=title)])
+            tags.setall("TPE1", [TPE1(encoding=3, text=artists)])
+            tags.delall(f"TXXX:{MID_TAG}")
+            tags.delall(f"TXXX:{QUALITY_TAG}")
+            tags.add(TXXX(encoding=3, desc=MID_TAG, text=mid))
+            tags.add(TXXX(encoding=3, desc=QUALITY_TAG, text=quality))
+            tags.save(path)
+        elif path.endswith(".m4a"):
+            audio = MP4(path)
+            if audio.tags is None:
+                audio.add_tags()
+            audio.tags["\xa9nam"] = [title]
+            audio.tags["\xa9ART"] = artists
+            audio.tags[_MP4_FREEFORM_PREFIX + MID_TAG] = [MP4FreeForm(mid.encode("utf-8"))]
+            audio.tags[_MP4_FREEFORM_PREFIX + QUALITY_TAG] = [MP4FreeForm(quality.encode("utf-8"))]
+            audio.save()
+        else:
+            # FLAC、Ogg Vorbis 等使用 Vorbis 注释
+            audio = mutagen.File(path)
+            if audio is None:
+                return False
+            if audio.tags is None:
+                audio.add_tags()
+            audio.tags["title"] = [title]
+            audio.tags["artist"] = artists
+            audio.tags[MID_TAG.lower()] = [mid]
+            audio.tags[QUALITY_TAG.lower()] = [quality]
+            audio.save()
+        return True
+    except Exception as e:
+        log.warning("写入音频标签失败 %s: %s", path, e)
+        return False
+
+def read_tags(path: str) -> Optional[Dict[str, str]]:
+    """读取本程序写入的 mid 和音质标签（同步执行，应放在线程池中调用）
+
+    Returns:
+        Optional[Dict[str, str]]: {"mid": ..., "quality": ...}；文件没有 mid 标签时为 None
+    """
+    if mutagen is None:
+        return None
+    try:
+        if path.endswith(".mp3"):
+            try:
+                tags = ID3(path)
+            except ID3NoHeaderError:
+                return None
+            mid_frame = tags.get(f"TXXX:{MID_TAG}")
+            if not mid_frame:
+                return None
+            quality_frame = tags.get(f"TXXX:{QUALITY_TAG}")
+            return {"mid": str(mid_frame.text[0]), "quality": str(quality_frame.text[0]) if quality_frame else ""}
+        if path.endswith(".m4a"):
+            tags = MP4(path).tags
+            if not tags or _MP4_FREEFORM_PREFIX + MID_TAG not in tags:
+                return None
+            quality = tags.get(_MP4_FREEFORM_PREFIX + QUALITY_TAG)
+            return {
+                "mid": bytes(tags[_MP4_FREEFORM_PREFIX + MID_TAG][0]).decode("utf-8"),
+                "quality": bytes(quality[0]).decode("utf-8") if quality else "",
+            }
+        audio = mutagen.File(path)
+        if audio is None or not audio.tags or MID_TAG.lower() not in audio.tags:
+            return None
+        quality = audio.tags.get(QUALITY_TAG.lower())
+        return {"mid": audio.tags[MID_TAG.lower()][0], "quality": quality[0] if quality else ""}
+    except Exception as e:
+        log.debug("读取音频标签失败 %s: %s", path, e)
+        return None
+
+def _skip_id3v2(f: BinaryIO, pos: int, size: int) -> int:
+    """跳过 pos 处连续的 ID3v2 标签，返回标签之后的位置"""
+    while pos + 10 <= size:
+        f.seek(pos)
+        header = f.read(10)
+        if header[:3] != b"ID3":
+            break
+        # 标签大小为 4 字节 syncsafe 整数，不含 10 字节头；设置了 footer 标志时另有 10 字节尾
+        tag_size = (header[6] << 21) | (header[7] << 14) | (header[8] << 7) | header[9]
+        pos += 10 + tag_size + (10 if header[5] & 0x10 else 0)
+    return pos
+
+def _mp3_payload_end(f: BinaryIO, start: int, size: int) -> int:
+    """去掉文件末尾的 ID3v1 和 APEv2 标签，返回音频数据的结束位置"""
+    end = size
+    if end - start >= 128:
+        f.seek(end - 128)
+        if f.read(3) == b"TAG":
+            end -= 128
+    if end - start >= 32:
+        f.seek(end - 32)
+        footer = f.read(32)
+        if footer[:8] == b"APETAGEX":
+            # 标签大小包含 32 字节尾但不含头，带头时再减去 32 字节
+            tag_size = int.from_bytes(footer[12:16], "little")
+            has_header = int.from_bytes(footer[20:24], "little") & 0x80000000
+            end -= tag_size + (32 if has_header else 0)
+    return max(start, end)
+
+def _flac_payload_start(f: BinaryIO, pos: int, size: int) -> Optional[int]:
+    """跳过 FLAC 的所有元数据块（Vorbis 注释、封面、填充等），返回第一个音频帧的位置"""
+    f.seek(pos)
+    if f.read(4) != b"fLaC":
+        return None
+    pos += 4
+    while pos + 4 <= size:
+        header = f.read(4)
+        pos += 4 + int.from_bytes(header[1:4], "big")
+        if header[0] & 0x80:
+            return pos if pos <= size else None
+        f.seek(pos)
+    return None
+
+def _mp4_payload(f: BinaryIO, size: int) -> Optional[Tuple[int, int]]:
+    """返回 MP4 顶层 mdat 原子的内容范围；标签位于 moov 原子中，写标签不会改变 mdat 的内容"""
+    pos = 0
+    while pos + 8 <= size:
+        f.seek(pos)
+        header = f.read(8)
+        atom_size = int.from_bytes(header[:4], "big")
+        header_size = 8
+        if atom_size == 1:
+            atom_size = int.from_bytes(f.read(8), "big")
+            header_size = 16
+        elif atom_size == 0:
+            atom_size = size - pos
+        if atom_size < header_size:
+            return None
+        if header[4:8] == b"mdat":
+            return pos + header_size, min(pos + atom_size, size)
+        pos += atom_size
+    return None
+
+# Ogg 流首个数据包的标识 -> 头部数据包数量（标识头、注释头[、设置头]），之后才是音频
+_OGG_HEADER_PACKETS = {b"\x01vorbis": 3, b"OpusHead": 2}
+_OGG_PAGE_HEADER_SIZE = 27
+
+def _ogg_audio_start(f: BinaryIO, size: int) -> Optional[int]:
+    """跳过 Vorbis / Opus 的头部数据包（注释即标签在其中），返回第一个音频页的位置"""
+    pos = 0
+    packets = 0
+    needed = None
+    while pos + _OGG_PAGE_HEADER_SIZE <= size:
+        f.seek(pos)
+        header = f.read(_OGG_PAGE_HEADER_SIZE)
+        if header[:4] != b"OggS":
+            return None
+        lacing = f.read(header[26])
+        if needed is None:
+            first_packet = f.read(8)
+            needed = next((count for magic, count in _OGG_HEADER_PACKETS.items() if first_packet.startswith(magic)), None)
+            if needed is None:
+                return None
+        pos += _OGG_PAGE_HEADER_SIZE + len(lacing) + sum(lacing)
+        # 长度小于 255 的段表示一个数据包结束；头部数据包结束后总是另起新页
+        packets += sum(1 for value in lacing if value < 255)
+        if packets >= needed:
+            return pos if pos <= size else None
+    return None
+
+def iter_ogg_pages(f: BinaryIO, start: int, end: int) -> Iterator[bytes]:
+    """逐页读取 [start, end) 中的 Ogg 页，页序号和 CRC 置零
+
+    注释头变长或变短时 mutagen 会给后续所有页重新编号并重算 CRC，其余字节不变；
+    置零后同一音频的页内容才能逐字节比较。
+    """
+    pos = start
+    while pos + _OGG_PAGE_HEADER_SIZE <= end:
+        f.seek(pos)
+        header = f.read(_OGG_PAGE_HEADER_SIZE)
+        if header[:4] != b"OggS":
+            break
+        lacing = f.read(header[26])
+        body = f.read(sum(lacing))
+        yield header[:18] + bytes(8) + header[26:] + lacing + body
+        pos += _OGG_PAGE_HEADER_SIZE + len(lacing) + len(body)
+    if pos < end:
+        f.seek(pos)
+        yield f.read(end - pos)
+
+def audio_payload_range(path: str, size: int) -> Tuple[int, int]:
+    """返回文件中音频数据（不含标签）的字节范围 [start, end)（同步执行，应放在线程池中调用）
+
+    同一首歌写入不同 mid、标题等标签后文件字节不同，但音频数据相同；按该范围计算哈希才能识别这类重复。
+    直接解析容器结构，不依赖 mutagen；无法识别的格式返回整个文件。读取失败时抛出 OSError。
+    OGG 的范围从第一个音频页开始，哈希时还需用 iter_ogg_pages 屏蔽页序号。
+    """
+    with open(path, "rb") as f:
+        if path.endswith(".m4a"):
+            return _mp4_payload(f, size) or (0, size)
+        if path.endswith(".ogg"):
+            ogg_start = _ogg_audio_start(f, size)
+            return (ogg_start, size) if ogg_start is not None else (0, size)
+        start = _skip_id3v2(f, 0, size)
+        if start > size:
+            return 0, size
+        if path.endswith(".flac"):
+            flac_start = _flac_payload_start(f, start, size)
+            return (flac_start, size) if flac_start is not None else (0, size)
+        if path.endswith(".mp3"):
+            return start, _mp3_payload_end(f, start, size)
+    return 0, size
@@ -13,12 +13,41 @@ DEFAULT_CONFIG = {
     "download": {
         "max_concurrent": 5,
         "retry_interval_seconds": 24 * 3600,
+        # 下载目录布局: "flat"、"hash" 或目录模板（可用字段 {artist}、{album}、{title}）
+        # 改为非平铺布局后，启动时会把已有的平铺文件一次性移动到新布局
+        "layout": "flat",
         "quality_order": ["MASTER", "ATMOS_51", "ATMOS_2", "FLAC", "OGG_640", "OGG_320", "MP3_320", "ACC_192", "OGG_192", "MP3_128", "ACC_96", "OGG_96", "ACC_48"]
     },
     "monitor": {
-        "check_interval_seconds": 1800
+        "check_interval_seconds": 1800,
+        "min_interval_seconds": 300,
+        "max_interval_seconds": 24 * 3600,
+        "max_concurrent_checks": 5,
+        "check_timeout_seconds": 60,
+        "full_check_interval_seconds": 24 * 3600
+    },
+    "credential": {
+        "check_interval_seconds": 600,
+        "refresh_ahead_seconds": 6 * 3600,
+        "urgent_refresh_seconds": 1800,
+        "max_age_seconds": 24 * 3600
+    },
+    "dedup": {
+        "interval_seconds": 6 * 3600,
+        # "report" 只报告重复文件，"hardlink" 将重复文件替换为硬链接
+        "action": "report"
+    },
+    "logging": {
+        "level": "INFO",
+        "debug_sample_rate": 100
+    },
+    "http": {
+        # 超过该大小（字节）的 JSON、文本响应按 Accept-Encoding 压缩（br 或 gzip）
+        "compression_min_size": 1024
     },
     "notification": {
+        "digest_window_seconds": 60,
+        "digest_max_events": 50,
         "webhook": {
             "enabled": False,
             "url": ""
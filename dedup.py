@@ -0,0 +1,331 @@
+import asyncio
+import hashlib
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import orjson as json
+
+from audio_tags import audio_payload_range, iter_ogg_pages
+from config import config
+from logger import get_logger
+from utils import DATA_DIR, song_index_manager
+
+log = get_logger("dedup")
+
+HASH_CACHE_FILE = os.path.join(DATA_DIR, "content_hashes.json")
+HASH_CACHE_VERSION = 3
+# 部分哈希读取音频数据开头和结尾各 64KB，足以区分绝大多数长度相同但内容不同的音频文件
+PARTIAL_HASH_BYTES = 64 * 1024
+HASH_READ_CHUNK = 1024 * 1024
+
+# 哈希缓存：{相对路径: [mtime, size, 音频数据起点, 音频数据终点, 部分哈希或 None, 完整哈希或 None]}
+# 哈希只覆盖音频数据，不含标签：同一首歌写入不同 mid 等标签后仍能识别为重复。
+# 文件的 (mtime, size) 未变化时直接复用，只有新增或变化的文件才会被读取；哈希在需要比较时才计算
+
+def _iter_payload(f, path: str, start: int, end: int):
+    """按块读取音频数据；OGG 按页读取并屏蔽页序号和 CRC"""
+    if path.endswith(".ogg"):
+        yield from iter_ogg_pages(f, start, end)
+        return
+    f.seek(start)
+    remaining = end - start
+    while remaining > 0 and (chunk := f.read(min(HASH_READ_CHUNK, remaining))):
+        yield chunk
+        remaining -= len(chunk)
+
+def partial_hash(path: str, start: int, end: int) -> str:
+    """音频数据开头和结尾各 PARTIAL_HASH_BYTES 字节的哈希
+
+    OGG 的页边界要从头逐页解析才能确定，只取开头约 PARTIAL_HASH_BYTES 字节的页。
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        if path.endswith(".ogg"):
+            hashed = 0
+            for page in iter_ogg_pages(f, start, end):
+                digest.update(page)
+                hashed += len(page)
+                if hashed >= PARTIAL_HASH_BYTES:
+                    break
+            return digest.hexdigest()
+        f.seek(start)
+        digest.update(f.read(min(PARTIAL_HASH_BYTES, end - start)))
+        if end - start > PARTIAL_HASH_BYTES:
+            tail_start = max(start + PARTIAL_HASH_BYTES, end - PARTIAL_HASH_BYTES)
+            f.seek(tail_start)
+            digest.update(f.read(end - tail_start))
+    return digest.hexdigest()
+
+def full_hash(path: str, start: int, end: int) -> str:
+    """音频数据 [start, end) 的完整哈希"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in _iter_payload(f, path, start, end):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class LibraryDeduplicator:
+    """按内容查找下载目录中的重复文件
+
+    依次按音频数据（不含标签）长度分桶、部分哈希、完整哈希缩小候选范围；哈希按 (mtime, size) 缓存，
+    每次检查只读取新增或变化的文件。重复文件可替换为硬链接（dedup.action = "hardlink"）或仅报告。
+    """
+    def __init__(self):
+        self._hashes: Dict[str, list] = {}
+        # 哈希缓存会在下载线程和去重线程中同时修改，遍历和增删时需要加锁
+        self._hashes_lock = threading.Lock()
+        self._loaded = False
+        self._dirty = False
+        self._lock = asyncio.Lock()
+        self._report: Dict[str, Any] = {"groups": [], "wasted_bytes": 0, "last_run": 0}
+        self._background_task = None
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        if not os.path.exists(HASH_CACHE_FILE):
+            return
+        try:
+            with open(HASH_CACHE_FILE, "rb") as f:
+                data = json.loads(f.read())
+            if isinstance(data, dict) and data.get("version") == HASH_CACHE_VERSION:
+                self._hashes = data["files"]
+            else:
+                log.info("内容哈希缓存版本不匹配，将重新计算。")
+        except (OSError, json.JSONDecodeError) as e:
+            log.warning("加载内容哈希缓存失败: %s", e)
+
+    def _save(self):
+        if not self._dirty:
+            return
+        self._dirty = False
+        try:
+            with self._hashes_lock:
+                data = json.dumps({"version": HASH_CACHE_VERSION, "files": self._hashes})
+            tmp_path = HASH_CACHE_FILE + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, HASH_CACHE_FILE)
+        except OSError as e:
+            self._dirty = True
+            log.error("保存内容哈希缓存失败: %s", e)
+
+    def _cached(self, relpath: str, stat: tuple) -> Optional[list]:
+        entry = self._hashes.get(relpath)
+        if entry and (entry[0], entry[1]) == tuple(stat):
+            return entry
+        return None
+
+    def record_file(self, relpath: str, path: str):
+        """下载流程在文件最终写完（含标签）后调用，记录音频数据范围和部分哈希（同步执行）
+
+        只读取文件头和音频数据首尾，完整哈希留到去重检查发现部分哈希相同时再计算。
+        """
+        self._load()
+        try:
+            stat = os.stat(path)
+            start, end = audio_payload_range(path, stat.st_size)
+            entry = [stat.st_mtime, stat.st_size, start, end, partial_hash(path, start, end), None]
+            with self._hashes_lock:
+                self._hashes[relpath] = entry
+            self._dirty = True
+        except OSError as e:
+            log.warning("计算文件哈希失败 %s: %s", path, e)
+
+    def _find_duplicates(self, files: Dict[str, tuple]) -> List[List[str]]:
+        """在线程池中运行：返回内容完全相同的文件分组（按相对路径）"""
+        self._load()
+        # 缓存中已不存在的文件直接剔除
+        with self._hashes_lock:
+            for relpath in [relpath for relpath in self._hashes if relpath not in files]:
+                del self._hashes[relpath]
+                self._dirty = True
+
+        # 1. 按音频数据长度分桶，只有长度相同的文件才可能重复；只需读取文件头
+        entries: Dict[str, list] = {}
+        by_length: Dict[int, List[str]] = {}
+        for relpath, stat in files.items():
+            if stat[1] <= 0:
+                continue
+            entry = self._range_entry(relpath, stat)
+            if entry and entry[3] > entry[2]:
+                entries[relpath] = entry
+                by_length.setdefault(entry[3] - entry[2], []).append(relpath)
+
+        groups = []
+        for relpaths in by_length.values():
+            if len(relpaths) < 2:
+                continue
+            # 2. 部分哈希
+            by_partial: Dict[str, List[str]] = {}
+            for relpath in relpaths:
+                digest = self._ensure_hash(relpath, entries[relpath], 4, partial_hash)
+                if digest:
+                    by_partial.setdefault(digest, []).append(relpath)
+            # 3. 部分哈希相同的文件再比较完整哈希
+            for candidates in by_partial.values():
+                if len(candidates) < 2:
+                    continue
+                by_full: Dict[str, List[str]] = {}
+                for relpath in candidates:
+                    digest = self._ensure_hash(relpath, entries[relpath], 5, full_hash)
+                    if digest:
+                        by_full.setdefault(digest, []).append(relpath)
+                groups.extend(sorted(group) for group in by_full.values() if len(group) > 1)
+        self._save()
+        return groups
+
+    def _range_entry(self, relpath: str, stat: tuple) -> Optional[list]:
+        """返回文件的缓存条目，未缓存或已变化时重新解析音频数据范围（哈希待需要时再计算）"""
+        entry = self._cached(relpath, stat)
+        if entry:
+            return entry
+        song_info = song_index_manager.get_song_info_by_path(relpath)
+        if not song_info:
+            return None
+        try:
+            start, end = audio_payload_range(song_info["path"], stat[1])
+        except OSError as e:
+            log.warning("读取文件失败 %s: %s", relpath, e)
+            return None
+        entry = [stat[0], stat[1], start, end, None, None]
+        with self._hashes_lock:
+            self._hashes[relpath] = entry
+        self._dirty = True
+        return entry
+
+    def _ensure_hash(self, relpath: str, entry: list, slot: int, hash_func) -> Optional[str]:
+        """按需计算条目中的部分哈希（slot 4）或完整哈希（slot 5）"""
+        if entry[slot] is None:
+            song_info = song_index_manager.get_song_info_by_path(relpath)
+            if not song_info:
+                return None
+            try:
+                entry[slot] = hash_func(song_info["path"], entry[2], entry[3])
+            except OSError as e:
+                log.warning("计算文件哈希失败 %s: %s", relpath, e)
+                return None
+            self._dirty = True
+        return entry[slot]
+
+    def _choose_keeper(self, relpaths: List[str]) -> str:
+        """优先保留带 mid 标签（本程序下载）的文件，其次保留最早的文件"""
+        def rank(relpath):
+            song_info = song_index_manager.get_song_info_by_path(relpath) or {}
+            return (not song_info.get("tags"), self._hashes[relpath][0], relpath)
+        return min(relpaths, key=rank)
+
+    def _link_targets(self, relpaths: List[str], files: Dict[str, tuple]) -> List[Tuple[str, str, tuple]]:
+        """在事件循环上解析文件路径，返回 (相对路径, 文件路径, 计算哈希时的 (mtime, size))
+
+        第一个为保留文件。已不在索引中的文件跳过；标签中的 mid 与保留文件不同的文件也跳过，
+        硬链接会让它们换成保留文件的标签，丢失自己的 mid。
+        """
+        targets = []
+        keeper_mid = None
+        for relpath in relpaths:
+            song_info = song_index_manager.get_song_info_by_path(relpath)
+            if not song_info:
+                continue
+            mid = (song_info.get("tags") or {}).get("mid")
+            if not targets:
+                keeper_mid = mid
+            elif mid and mid != keeper_mid:
+                continue
+            targets.append((relpath, song_info["path"], tuple(files[relpath])))
+        return targets
+
+    def _hardlink_group(self, keeper: Tuple[str, str, tuple], duplicates: List[Tuple[str, str, tuple]]) -> List[str]:
+        """将重复文件原子地替换为指向保留文件的硬链接（在线程池中运行）
+
+        链接前重新 stat，计算哈希之后被修改过的文件一律跳过，避免按过期的比较结果覆盖文件。
+        """
+        keeper_relpath, keeper_path, keeper_hashed = keeper
+        try:
+            keeper_stat = os.stat(keeper_path)
+        except OSError as e:
+            log.warning("读取保留文件失败 %s: %s", keeper_relpath, e)
+            return []
+        if (keeper_stat.st_mtime, keeper_stat.st_size) != keeper_hashed:
+            log.info("保留文件 %s 在检查后已变化，跳过本组。", keeper_relpath)
+            return []
+        linked = []
+        for relpath, path, hashed in duplicates:
+            try:
+                stat = os.stat(path)
+                if (stat.st_dev, stat.st_ino) == (keeper_stat.st_dev, keeper_stat.st_ino):
+                    linked.append(relpath)
+                    continue
+                if (stat.st_mtime, stat.st_size) != hashed:
+                    log.info("文件 %s 在检查后已变化，跳过。", relpath)
+                    continue
+                tmp_path = path + ".dedup.tmp"
+                os.link(keeper_path, tmp_path)
+                os.replace(tmp_path, path)
+                linked.append(relpath)
+            except OSError as e:
+                log.warning("替换为硬链接失败 %s: %s", relpath, e)
+        return linked
+
+    async def run(self) -> Dict[str, Any]:
+        """执行一次去重检查，返回报告"""
+        async with self._lock:
+            files = song_index_manager.get_file_stats()
+            groups = await asyncio.to_thread(self._find_duplicates, files)
+            hardlink = config.get("dedup.action", "report") == "hardlink"
+
+            report_groups = []
+            wasted = 0
+            for group in groups:
+                keeper = self._choose_keeper(group)
+                duplicates = [relpath for relpath in group if relpath != keeper]
+                linked = []
+                if hardlink:
+                    targets = self._link_targets([keeper] + duplicates, files)
+                    if targets and targets[0][0] == keeper:
+                        linked = await asyncio.to_thread(self._hardlink_group, targets[0], targets[1:])
+                with self._hashes_lock:
+                    for relpath in linked:
+                        # 硬链接与保留文件共享 mtime，直接沿用其哈希，下次检查无需重新读取
+                        self._hashes[relpath] = list(self._hashes[keeper])
+                        self._dirty = True
+                size = files[keeper][1]
+                wasted += size * (len(duplicates) - len(linked))
+                report_groups.append({
+                    "size": size,
+                    "hash": self._hashes[keeper][5],
+                    "keep": keeper,
+                    "duplicates": duplicates,
+                    "linked": linked,
+                })
+
+            await asyncio.to_thread(self._save)
+            self._report = {"groups": report_groups, "wasted_bytes": wasted, "last_run": int(time.time())}
+            if report_groups:
+                log.info("发现 %d 组重复文件，未处理的重复文件占用 %d 字节。", len(report_groups), wasted)
+            return self._report
+
+    def get_report(self) -> Dict[str, Any]:
+        return self._report
+
+    async def _periodic_run(self):
+        # 启动后稍等片刻，让索引先完成与下载目录的对账
+        delay = 60
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                await self.run()
+            except Exception as e:
+                log.exception("重复文件检查出错: %s", e)
+            delay = int(config.get("dedup.interval_seconds", 6 * 3600))
+
+    def start_background_task(self):
+        """启动后台定期去重检查"""
+        if not self._background_task:
+            self._background_task = asyncio.create_task(self._periodic_run())
+
+# 创建全局去重实例
+library_deduplicator = LibraryDeduplicator()
@@ -0,0 +1,42 @@
+import asyncio
+from typing import Any, Set, Tuple
+
+from logger import get_logger
+
+log = get_logger("event_bus")
+
+class EventBus:
+    """进程内的发布/订阅事件总线
+
+    订阅者各自持有一个有界队列；publish 不会阻塞，队列满时丢弃该订阅者的新事件。
+    因此订阅者应把事件当作"有变化"的通知，再按版本游标等方式读取最新状态，而不是依赖每条事件都送达。
+    publish 必须在事件循环线程中调用。
+    """
+    def __init__(self, max_queue_size: int = 256):
+        self._subscribers: Set[asyncio.Queue] = set()
+        self._max_queue_size = max_queue_size
+
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=self._max_queue_size)
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self._subscribers.discard(queue)
+
+    @property
+    def subscriber_count(self) -> int:
+        return len(self._subscribers)
+
+    def publish(self, topic: str, data: Any = None):
+        if not self._subscribers:
+            return
+        event: Tuple[str, Any] = (topic, data)
+        for queue in self._subscribers:
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                log.debug("订阅者队列已满，丢弃事件 %s", topic)
+
+# 创建全局事件总线实例
+event_bus = EventBus()
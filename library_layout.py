@@ -0,0 +1,145 @@
+import asyncio
+import hashlib
+import os
+import posixpath
+import re
+from typing import Dict, List, Optional, Tuple
+
+import orjson as json
+
+from audio_tags import read_tags
+from config import config
+from logger import get_logger
+from shared_state import download_tasks, mark_task_changed
+from song_catalog import song_catalog
+from utils import DATA_DIR, DOWNLOADS_DIR, _clean_name, song_index_manager
+
+log = get_logger("library_layout")
+
+# 下载目录布局，通过 download.layout 配置：
+#   "flat"             所有文件直接放在 downloads/ 下（默认，与旧版一致）
+#   "hash"             按 mid 的哈希分成两级子目录，例如 downloads/3f/a2/歌名 - 歌手.flac
+#   "{artist}/{album}" 目录模板，可用字段 {artist}、{album}、{title}
+# 文件名始终为 "歌名 - 歌手.扩展名"，本地匹配依赖这一格式。
+# 移动文件会使外部引用（共享目录、其他播放器的播放列表、/downloads/ 链接）失效，
+# 因此默认保持平铺，只有用户主动配置了其他布局时才迁移已有文件
+DEFAULT_LAYOUT = "flat"
+# 记录已完成迁移的布局，避免每次启动都重新检查
+MIGRATION_STATE_FILE = os.path.join(DATA_DIR, "library_layout.json")
+
+_TEMPLATE_FIELD_RE = re.compile(r"\{(\w+)\}")
+
+def current_layout() -> str:
+    return str(config.get("download.layout", DEFAULT_LAYOUT)).strip().strip("/") or "flat"
+
+def _path_component(value: str, default: str) -> str:
+    """将元数据转换为安全的目录名"""
+    value = _clean_name(value).strip(" .")
+    return value or default
+
+def _layout_dir(layout: str, mid: Optional[str], song_name: str, entry: Dict) -> str:
+    if layout == "flat":
+        return ""
+    if layout == "hash":
+        digest = hashlib.md5((mid or song_name).encode("utf-8")).hexdigest()
+        return f"{digest[:2]}/{digest[2:4]}"
+    singers = entry.get("singers") or []
+    fields = {
+        "artist": _path_component(singers[0] if singers else "", "未知歌手"),
+        "album": _path_component(entry.get("album", ""), "未知专辑"),
+        "title": _path_component(entry.get("name", "") or song_name, "未知歌曲"),
+    }
+    return _TEMPLATE_FIELD_RE.sub(lambda m: fields.get(m.group(1), m.group(0)), layout)
+
+def song_relpath(mid: str, song_name: str, extension: str, layout: Optional[str] = None) -> str:
+    """按当前布局生成歌曲相对下载目录的路径（使用 / 分隔）"""
+    layout = layout or current_layout()
+    entry = song_catalog.get(mid) or {}
+    directory = _layout_dir(layout, mid, song_name, entry)
+    filename = f"{_clean_name(song_name)}{extension}"
+    return posixpath.join(directory, filename) if directory else filename
+
+def _entry_from_filename(basename: str) -> Dict:
+    """元数据目录中没有记录时，从 "歌名 - 歌手1, 歌手2" 格式的文件名推断"""
+    name, sep, singers = basename.partition(" - ")
+    return {"name": name, "singers": singers.split(", ") if sep else [], "album": ""}
+
+def _migrate_flat_files(layout: str, known_mids: Dict[str, Optional[str]]) -> List[Tuple[str, str]]:
+    """将下载目录顶层的文件移动到布局对应的子目录（在线程池中运行）
+
+    Returns:
+        List[Tuple[str, str]]: 成功移动的 (原相对路径, 新相对路径)
+    """
+    moves = []
+    with os.scandir(DOWNLOADS_DIR) as entries:
+        files = [entry for entry in entries if entry.is_file()]
+    for entry in files:
+        basename, _ = os.path.splitext(entry.name)
+        mid = known_mids.get(entry.name)
+        if not mid:
+            tags = read_tags(entry.path)
+            mid = tags["mid"] if tags else None
+        song_entry = (song_catalog.get(mid) if mid else None) or _entry_from_filename(basename)
+        directory = _layout_dir(layout, mid, basename, song_entry)
+        new_relpath = posixpath.join(directory, entry.name)
+        target = os.path.join(DOWNLOADS_DIR, *new_relpath.split("/"))
+        if os.path.exists(target):
+            log.warning("迁移跳过 %s：目标 %s 已存在", entry.name, new_relpath)
+            continue
+        try:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.rename(entry.path, target)
+            moves.append((entry.name, new_relpath))
+            log.info("迁移: %s -> %s", entry.name, new_relpath)
+        except OSError as e:
+            log.error("迁移文件 %s 失败: %s", entry.name, e)
+    return moves
+
+def _load_migrated_layout() -> Optional[str]:
+    try:
+        with open(MIGRATION_STATE_FILE, "rb") as f:
+            return json.loads(f.read()).get("layout")
+    except (OSError, json.JSONDecodeError):
+        return None
+
+async def migrate_flat_library():
+    """用户配置了非平铺布局时，将平铺的下载目录一次性迁移到该布局，并更新下载任务中的文件路径"""
+    layout = current_layout()
+    if layout == "flat" or _load_migrated_layout() == layout:
+        return
+    # 先与磁盘对账，确保能复用索引中已识别的 mid
+    await song_index_manager.refresh_incremental()
+    known_mids = {
+        info["relpath"]: info.get("mid")
+        for info in song_index_manager.get_indexed_songs()
+        if "/" not in info["relpath"]
+    }
+    log.warning(
+        "已配置下载目录布局 %s，将把 %s 顶层的 %d 个文件移动到对应子目录；指向 /downloads/<文件名> 的外部链接将失效。",
+        layout, DOWNLOADS_DIR, len(known_mids),
+    )
+    moves = await asyncio.to_thread(_migrate_flat_files, layout, known_mids)
+
+    if moves:
+        new_paths = {os.path.join(DOWNLOADS_DIR, old): new for old, new in moves}
+        for mid, task in download_tasks.items():
+            file_path = task.get("file_path")
+            new_relpath = new_paths.get(os.path.normpath(file_path)) if file_path else None
+            if new_relpath:
+                task["file_path"] = os.path.join(DOWNLOADS_DIR, *new_relpath.split("/"))
+                task["url"] = f"/downloads/{new_relpath}"
+                mark_task_changed(mid)
+        import tasks
+        await tasks._save_download_tasks()
+        await song_index_manager.refresh_incremental()
+
+    try:
+        with open(MIGRATION_STATE_FILE, "wb") as f:
+            f.write(json.dumps({"layout": layout}))
+    except OSError as e:
+        log.error("保存迁移状态失败: %s", e)
+    log.info("下载目录迁移完成，共移动 %d 个文件。", len(moves))
+
+def start_migration():
+    """在后台执行一次性迁移，不阻塞启动"""
+    asyncio.create_task(migrate_flat_library())
@@ -0,0 +1,104 @@
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+from shared_state import download_tasks, task_changes
+from song_catalog import song_catalog
+from utils import song_index_manager
+
+def resolve_local_status(songs: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """一次性解析一批歌曲的下载任务状态和本地文件状态
+
+    Returns:
+        Dict[str, Dict[str, Any]]: mid -> 需要附加到歌曲上的字段；没有任务也没有本地文件时为空字典
+    """
+    statuses: Dict[str, Dict[str, Any]] = {}
+    unmatched = []
+    for song in songs:
+        mid = song.get("mid")
+        # 优先从内存任务列表获取状态
+        task_info = download_tasks.get(mid)
+        if task_info:
+            fields = {"status": task_info.get("status")}
+            # 如果是已完成状态，也一并提供下载链接
+            if task_info.get("status") == "completed":
+                fields["url"] = task_info.get("url")
+            statuses[mid] = fields
+        else:
+            unmatched.append(song)
+
+    # 内存中没有任务记录的歌曲，一次性批量匹配本地文件
+    local_matches = song_index_manager.match_many(unmatched)
+    for song in unmatched:
+        local_song = local_matches.get(song.get("mid"))
+        if local_song:
+            statuses[song.get("mid")] = {
+                "status": "completed",
+                "local_info": {
+                    "filename": local_song["filename"],
+                    "quality": local_song["quality"],
+                    "size": local_song["size"],
+                    "extension": local_song["extension"]
+                },
+            }
+        else:
+            statuses[song.get("mid")] = {}
+    return statuses
+
+def _apply_statuses(songs: List[Dict[str, Any]], statuses: Dict[str, Dict[str, Any]]) -> List[Dict[str, Any]]:
+    for song in songs:
+        song.update(statuses.get(song.get("mid"), {}))
+    return songs
+
+def attach_local_status(songs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """为歌曲列表批量附加下载任务状态和本地文件信息"""
+    return _apply_statuses(songs, resolve_local_status(songs))
+
+class PlaylistStatusCache:
+    """按歌单缓存歌曲的本地状态
+
+    缓存记录解析时的索引版本、元数据目录版本和任务版本：
+    - 本地索引或元数据目录变化后匹配结果可能整体改变，整个歌单重新解析
+    - 只有任务变化时，通过任务变更日志找出变化的 mid，只重新解析歌单中受影响的歌曲
+    """
+    def __init__(self, max_playlists: int = 32):
+        self._entries: "OrderedDict[Any, Dict[str, Any]]" = OrderedDict()
+        self._max_playlists = max_playlists
+
+    def attach(self, playlist_id: Any, songs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """为歌单歌曲附加本地状态，尽量复用上次的解析结果"""
+        entry = self._entries.get(playlist_id)
+        stale = self._stale_songs(entry, songs)
+        if stale is None:
+            entry = {"statuses": resolve_local_status(songs)}
+        elif stale:
+            entry["statuses"].update(resolve_local_status(stale))
+        entry.update({
+            "index_version": song_index_manager.version,
+            "catalog_version": song_catalog.version,
+            "task_epoch": task_changes.epoch,
+            "task_version": task_changes.version,
+        })
+        self._entries[playlist_id] = entry
+        self._entries.move_to_end(playlist_id)
+        while len(self._entries) > self._max_playlists:
+            self._entries.popitem(last=False)
+        return _apply_statuses(songs, entry["statuses"])
+
+    def _stale_songs(self, entry: Optional[Dict[str, Any]], songs: List[Dict[str, Any]]) -> Optional[List[Dict[str, Any]]]:
+        """返回需要重新解析的歌曲；None 表示整个歌单都要重新解析"""
+        if (
+            not entry
+            or entry["index_version"] != song_index_manager.version
+            or entry["catalog_version"] != song_catalog.version
+            or entry["task_epoch"] != task_changes.epoch
+        ):
+            return None
+        delta = task_changes.changes_since(entry["task_version"])
+        if delta is None:
+            return None
+        changed = set(delta[0]).union(delta[1])
+        statuses = entry["statuses"]
+        return [song for song in songs if song.get("mid") in changed or song.get("mid") not in statuses]
+
+# 创建全局歌单状态缓存实例
+playlist_status_cache = PlaylistStatusCache()
@@ -0,0 +1,71 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+from typing import Dict
+
+from config import config
+
+# 所有模块的日志记录器都挂在这个根记录器下，例如 "qqmusic.utils"
+ROOT_LOGGER_NAME = "qqmusic"
+LOG_FORMAT = "%(asctime)s %(levelname)-7s [%(name)s] %(message)s%(fields_text)s"
+
+# 逐条调试日志（每个文件、每次匹配）使用 extra=SAMPLED，按 logging.debug_sample_rate 采样输出
+SAMPLED = {"sampled": True}
+
+class StructuredFormatter(logging.Formatter):
+    """在消息后以 key=value 形式追加结构化字段
+
+    用法: log.info("下载完成", extra={"fields": {"mid": mid, "quality": quality}})
+    """
+    def format(self, record: logging.LogRecord) -> str:
+        fields = getattr(record, "fields", None)
+        record.fields_text = (" " + " ".join(f"{key}={value}" for key, value in fields.items())) if fields else ""
+        return super().format(record)
+
+class SamplingFilter(logging.Filter):
+    """对标记为 sampled 的日志，每个消息模板每 rate 条只保留一条"""
+    def __init__(self, rate: int):
+        super().__init__()
+        self.rate = max(1, rate)
+        self._counters: Dict[tuple, int] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not getattr(record, "sampled", False) or self.rate == 1:
+            return True
+        key = (record.name, record.msg)
+        with self._lock:
+            count = self._counters.get(key, 0)
+            self._counters[key] = count + 1
+        return count % self.rate == 0
+
+def _setup_logging() -> logging.handlers.QueueListener:
+    """配置根记录器：调用方只把日志记录放入队列，格式化和写 stdout 在后台线程完成"""
+    level_name = str(config.get("logging.level", "INFO")).upper()
+    sample_rate = int(config.get("logging.debug_sample_rate", 100))
+
+    root = logging.getLogger(ROOT_LOGGER_NAME)
+    root.setLevel(getattr(logging, level_name, logging.INFO))
+    root.propagate = False
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(sample_rate))
+    root.addHandler(queue_handler)
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(StructuredFormatter(LOG_FORMAT))
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    listener.start()
+    # 退出前把队列中剩余的日志写完
+    atexit.register(listener.stop)
+    return listener
+
+_listener = _setup_logging()
+
+def get_logger(name: str) -> logging.Logger:
+    """获取模块日志记录器"""
+    return logging.getLogger(f"{ROOT_LOGGER_NAME}.{name}")
@@ -1,20 +1,30 @@
 import re
-from fastapi import FastAPI, Request, Depends, HTTPException
-from fastapi.responses import HTMLResponse
+from fastapi import FastAPI, Request, Depends, HTTPException, Query
+from fastapi.responses import HTMLResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
 import uvicorn
 import base64
 import asyncio
 import os
 import httpx
+import orjson as json
 import qq_music
 import monitor
 import tasks
 from tasks import add_song_to_queue, load_download_tasks, start_download_workers
+from song_catalog import song_catalog, format_song_name
+from shared_state import mark_task_changed, mark_task_removed, task_changes
+from event_bus import event_bus
+from task_index import task_index
+from local_status import attach_local_status, playlist_status_cache
+from responses import CompressionETagMiddleware, FastJSONResponse
 from contextlib import asynccontextmanager
+from logger import get_logger
+
+log = get_logger("main")
 
 # --- 从 tasks 模块导入 download_tasks ---
 download_tasks = tasks.download_tasks
@@ -26,41 +36,61 @@ worker_tasks = []
 async def lifespan(app: FastAPI):
     """应用生命周期管理器"""
     # --- 启动时执行 ---
-    print("Application startup...")
+    log.info("Application startup...")
     await tasks.load_download_tasks()
-    # 启动下载工作者（消费者）
-    global worker_tasks
-    worker_tasks = start_download_workers()
     # 初始化 qqmusic api 会话
     qq_music.initialize_qqmusic_session()
     await qq_music.initialize_from_cookie()
+    # 启动下载工作者（消费者）；会话保存在 contextvars 中，工作者需在会话初始化之后创建才能继承它
+    global worker_tasks
+    worker_tasks = start_download_workers()
+    # 启动后台凭证刷新任务
+    qq_music.start_credential_refresh_task()
     # 启动后台监控任务
     monitor.start_monitoring_task()
     # 启动定时重试任务
     tasks.start_retry_task()
-    # 初始化并启动歌曲索引管理器
+    # 启动已完成文件的存在性检查
+    tasks.start_file_check_task()
+    # 加载歌曲元数据目录并启动定期落盘
+    song_catalog.start_background_save()
+    # 启动通知发件箱的后台发送任务
+    from notification import notification_manager
+    await notification_manager.start_outbox_sender()
+    # 初始化并启动歌曲索引管理器：优先加载快照，在后台与下载目录对账
     from utils import song_index_manager
-    await song_index_manager.update_index()
+    song_index_manager.load_snapshot()
     song_index_manager.start_background_update()
-    print(f"应用启动时歌曲索引状态: {len(song_index_manager.get_existing_song_basenames())} 首本地歌曲")
+    # 配置了非平铺布局时，已有的平铺文件在后台一次性迁移到该布局
+    import library_layout
+    library_layout.start_migration()
+    # 后台定期检查内容重复的文件
+    from dedup import library_deduplicator
+    library_deduplicator.start_background_task()
+    log.info("应用启动时歌曲索引状态: %s 首本地歌曲", len(song_index_manager.get_existing_song_basenames()))
     
     yield
     
     # --- 关闭时执行 ---
-    print("Application shutdown...")
+    log.info("Application shutdown...")
     # 取消所有后台下载任务
     for task in worker_tasks:
         task.cancel()
     await asyncio.gather(*worker_tasks, return_exceptions=True)
-    print("所有下载工作者已停止。")
+    log.info("所有下载工作者已停止。")
     
     # 在关闭前最后保存一次任务状态
-    print("正在保存最终任务状态...")
+    log.info("正在保存最终任务状态...")
     await tasks._save_download_tasks()
+    await song_catalog.save()
+    song_index_manager.save_snapshot()
     
+    await notification_manager.close()
     await qq_music.close_qqmusic_session()
 
-app = FastAPI(title="QQ音乐下载器", lifespan=lifespan)
+app = FastAPI(title="QQ音乐下载器", lifespan=lifespan, default_response_class=FastJSONResponse)
+# 完整响应添加 ETag（支持 304）并按 Accept-Encoding 压缩；事件流和文件下载原样透传
+app.add_middleware(CompressionETagMiddleware)
 
 # 定义数据和下载目录
 DATA_DIR = "data"
@@ -129,12 +159,6 @@ async def logout():
     qq_music.initialize_qqmusic_session()
     return {"status": "success"}
 
-# Helper function to get a set of existing filenames without extension
-def get_existing_song_basenames():
-    from utils import song_index_manager
-    return song_index_manager.get_existing_song_basenames()
-
-
 @app.get("/api/playlists", dependencies=[Depends(check_auth_status)])
 async def api_get_user_playlists():
     """获取当前登录用户的歌单"""
@@ -153,38 +177,63 @@ async def api_get_playlist_songs(playlist_id: int):
         if not isinstance(songs, list):
             return songs  # Return original response if not a list
 
-        from utils import song_index_manager
-        existing_files = get_existing_song_basenames()
+        song_catalog.upsert_many(songs)
+        return FastJSONResponse(playlist_status_cache.attach(playlist_id, songs))
+    except Exception as e:
+        return {"error": str(e)}
 
-        for song in songs:
-            # 优先从内存任务列表获取状态
-            task_info = download_tasks.get(song.get("mid"))
-            if task_info:
-                song["status"] = task_info.get("status")
-                # 如果是已完成状态，也一并提供下载链接
-                if task_info.get("status") == "completed":
-                    song["url"] = task_info.get("url")
-                continue  # 如果在内存中找到，则跳过文件检查
-
-            # 如果内存中没有，使用智能检测方法检查文件系统
-            song_name = song.get('name', '')
-            singer_names = [s.get('name', '') for s in song.get('singer', [])]
-            
-            # 查找匹配的本地歌曲
-            matching_songs = song_index_manager.find_matching_songs(song_name, singer_names)
-            if matching_songs:
-                # 选择第一个匹配的歌曲
-                local_song = matching_songs[0]
-                song["status"] = "completed"
-                song["local_info"] = {
-                    "filename": local_song["filename"],
-                    "quality": local_song["quality"],
-                    "size": local_song["size"],
-                    "extension": local_song["extension"]
-                }
-                # 注意：这里无法轻易获取到确切的文件扩展名，所以无法生成下载链接
-                # 但至少前端可以显示“已下载”
-        return songs
+@app.get("/api/export/playlist/{playlist_id}", dependencies=[Depends(check_auth_status)])
+async def export_playlist(playlist_id: int, request: Request):
+    """将歌单中已下载到本地的歌曲打包为 ZIP（不压缩，附带 M3U 播放列表）流式下载，支持断点续传"""
+    import playlist_export
+
+    songs = await qq_music.get_playlist_songs(playlist_id)
+    if not isinstance(songs, list):
+        raise HTTPException(status_code=502, detail="获取歌单失败")
+    files = playlist_export.collect_playlist_files(songs)
+    if not files:
+        raise HTTPException(status_code=404, detail="歌单中没有已下载的歌曲")
+    name = f"playlist_{playlist_id}"
+    archive = await playlist_export.build_archive(files, name)
+    return playlist_export.archive_response(
+        archive, f"{name}.zip", request.headers.get("range"), request.headers.get("if-range")
+    )
+
+@app.get("/api/export/tasks")
+async def export_tasks(mids: str, request: Request):
+    """将选中的已完成任务打包为 ZIP 流式下载，mids 用逗号分隔"""
+    import playlist_export
+
+    files = playlist_export.collect_task_files([mid for mid in mids.split(",") if mid])
+    if not files:
+        raise HTTPException(status_code=404, detail="所选任务没有已下载的文件")
+    archive = await playlist_export.build_archive(files, "downloads")
+    return playlist_export.archive_response(
+        archive, "downloads.zip", request.headers.get("range"), request.headers.get("if-range")
+    )
+
+# 搜索每页的最大数量
+SEARCH_PAGE_MAX_NUM = 50
+
+@app.get("/api/search", dependencies=[Depends(check_auth_status)])
+async def api_search_songs(
+    keyword: str,
+    page: int = Query(1, ge=1),
+    num: int = Query(20, ge=1, le=SEARCH_PAGE_MAX_NUM),
+):
+    """搜索歌曲（带缓存），并附加本地下载状态；同时在后台预取下一页"""
+    keyword = keyword.strip()
+    if not keyword:
+        return {"keyword": keyword, "page": page, "songs": [], "has_more": False}
+    try:
+        songs = await qq_music.search_song_cached(keyword, page=page, num=num)
+        song_catalog.upsert_many(songs)
+        has_more = len(songs) >= num
+        if has_more:
+            qq_music.prefetch_search_page(keyword, page + 1, num)
+        # 复制一份再附加状态，避免污染缓存中的结果
+        songs = attach_local_status([dict(song) for song in songs])
+        return FastJSONResponse({"keyword": keyword, "page": page, "songs": songs, "has_more": has_more})
     except Exception as e:
         return {"error": str(e)}
 
@@ -196,14 +245,16 @@ async def download_playlist(playlist_id: int):
         if not isinstance(songs, list):
             raise HTTPException(status_code=404, detail="无法获取歌单歌曲")
 
+        song_catalog.upsert_many(songs)
         added_count = 0
         for song in songs:
             song_mid = song.get("mid")
             if not song_mid:
                 continue
 
-            if song_mid not in download_tasks or download_tasks[song_mid].get('status') != 'completed':
-                song_name = f"{song.get('name', '未知歌曲')} - {', '.join(s.get('name', '未知歌手') for s in song.get('singer', []))}"
+            # 已完成、排队中或下载中的歌曲不重复入队
+            if song_mid not in download_tasks or download_tasks[song_mid].get('status') not in ['completed', 'queued', 'downloading']:
+                song_name = format_song_name(song.get('name', '未知歌曲'), [s.get('name', '未知歌手') for s in song.get('singer', [])])
                 # 将任务放入队列，这是一个快速的非阻塞操作
                 await add_song_to_queue(song_mid, song_name)
                 added_count += 1
@@ -224,37 +275,152 @@ async def download_song(song_mid: str, song_name: str):
 
 @app.get("/api/download/status")
 async def get_download_status():
-    """获取所有下载任务的状态，并检查已完成文件是否存在"""
+    """获取所有下载任务的状态（全量）
+
+    已完成文件是否存在由后台任务定期检查；前端轮询请使用 /api/download/status/delta。
+    """
     import time
 
     cred = qq_music.get_credential()
     cooldown_until = getattr(cred, 'cooldown_until', 0) if cred else 0
 
-    tasks_to_update = []
-    for mid, task in download_tasks.items():
-        if task.get("status") == "completed":
-            file_path = task.get("file_path")
-            # 检查文件路径是否存在且在文件系统中是否真的存在
-            if file_path and not os.path.exists(file_path):
-                tasks_to_update.append(mid)
-
-    # 如果有任何已完成但文件被删除的任务，更新它们的状态
-    if tasks_to_update:
-        for mid in tasks_to_update:
-            if mid in download_tasks:
-                download_tasks[mid]["status"] = "failed"  # 标记为失败
-                download_tasks[mid]["error"] = "本地文件已被删除"
-                download_tasks[mid]["progress"] = 0
-        
-        # 将更新后的状态保存回文件
-        await tasks._save_download_tasks()
+    return FastJSONResponse({
+        "tasks": download_tasks,
+        "version": task_changes.version,
+        "epoch": task_changes.epoch,
+        "api_cooldown_until": cooldown_until,
+        "server_time": int(time.time())
+    })
+
+def _task_summary() -> dict:
+    """各状态的任务数量
+
+    任务索引在每次任务变化时增量维护各状态列表，这里只读取列表长度，不遍历全部任务。
+    """
+    return {"total": len(task_index), **task_index.status_counts()}
+
+def _task_delta(since: int, epoch: Optional[int]) -> dict:
+    """计算自游标以来变化的任务，供增量接口和事件流共用"""
+    import time
+
+    cred = qq_music.get_credential()
+    cooldown_until = getattr(cred, 'cooldown_until', 0) if cred else 0
+
+    delta = task_changes.changes_since(since) if epoch == task_changes.epoch else None
+    if delta is None:
+        changed_tasks, removed, full = download_tasks, [], True
+    else:
+        changed, removed = delta
+        changed_tasks = {mid: download_tasks[mid] for mid in changed if mid in download_tasks}
+        full = False
 
     return {
-        "tasks": download_tasks,
+        "epoch": task_changes.epoch,
+        "version": task_changes.version,
+        "full": full,
+        "tasks": changed_tasks,
+        "removed": removed,
+        "summary": _task_summary(),
         "api_cooldown_until": cooldown_until,
         "server_time": int(time.time())
     }
 
+# 任务列表每页的最大数量
+TASK_PAGE_MAX_LIMIT = 200
+
+@app.get("/api/download/tasks")
+async def list_download_tasks(
+    status: Optional[str] = None,
+    q: str = "",
+    sort: str = "time",
+    cursor: Optional[str] = None,
+    limit: int = 50,
+):
+    """分页列出下载任务
+
+    Args:
+        status: 按状态筛选，多个状态用逗号分隔，例如 "failed,cancelled"
+        q: 按歌名搜索（子串，不区分大小写）
+        sort: "time" 按创建时间倒序；"priority" 按状态优先级，同优先级内按创建时间倒序
+        cursor: 上一页返回的 next_cursor
+        limit: 每页数量，最多 200
+    """
+    if sort not in ("time", "priority"):
+        raise HTTPException(status_code=400, detail="sort 只能是 time 或 priority")
+    statuses = [s.strip() for s in status.split(",") if s.strip()] if status else None
+    limit = max(1, min(limit, TASK_PAGE_MAX_LIMIT))
+    try:
+        mids, next_cursor, total = task_index.query(statuses, q, sort, cursor, limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return FastJSONResponse({
+        "tasks": [{**download_tasks[mid], "mid": mid} for mid in mids],
+        "next_cursor": next_cursor,
+        "total": total,
+        "version": task_changes.version,
+    })
+
+@app.get("/api/download/status/delta")
+async def get_download_status_delta(since: int = 0, epoch: Optional[int] = None):
+    """获取自游标 since 以来变化的下载任务
+
+    客户端保存返回的 version 和 epoch，下次请求时带上；服务重启（epoch 变化）或游标过旧时返回全量，
+    此时 full 为 true，客户端应丢弃本地任务列表。
+    """
+    return FastJSONResponse(_task_delta(since, epoch))
+
+# 同一连接两次推送之间的最短间隔，期间的多次变化（例如下载进度）合并为一条
+TASK_EVENT_MIN_INTERVAL_SECONDS = 0.5
+# 没有变化时定期发送心跳，保持连接并刷新账号冷却时间
+TASK_EVENT_HEARTBEAT_SECONDS = 15
+
+@app.get("/api/download/events")
+async def download_events(request: Request, since: int = 0, epoch: Optional[int] = None):
+    """以 Server-Sent Events 推送下载任务的变化
+
+    每条 tasks 事件的内容与 /api/download/status/delta 相同，事件 id 为 "epoch:version"，
+    浏览器断线重连时通过 Last-Event-ID 带回，从断开处继续增量推送。
+    """
+    last_event_id = request.headers.get("last-event-id")
+    if last_event_id:
+        try:
+            epoch, since = (int(part) for part in last_event_id.split(":"))
+        except ValueError:
+            pass
+
+    async def event_stream():
+        queue = event_bus.subscribe()
+        cursor_epoch, cursor = epoch, since
+        send_empty = True
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                delta = _task_delta(cursor, cursor_epoch)
+                if send_empty or delta["full"] or delta["tasks"] or delta["removed"]:
+                    yield f"event: tasks\nid: {delta['epoch']}:{delta['version']}\ndata: {json.dumps(delta).decode()}\n\n"
+                cursor_epoch, cursor = delta["epoch"], delta["version"]
+
+                try:
+                    await asyncio.wait_for(queue.get(), TASK_EVENT_HEARTBEAT_SECONDS)
+                    send_empty = False
+                except asyncio.TimeoutError:
+                    send_empty = True
+                if await request.is_disconnected():
+                    break
+                if not send_empty:
+                    await asyncio.sleep(TASK_EVENT_MIN_INTERVAL_SECONDS)
+                    # 变化内容按游标读取，排队中的通知可以直接丢弃
+                    while not queue.empty():
+                        queue.get_nowait()
+        finally:
+            event_bus.unsubscribe(queue)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 class TaskActionPayload(BaseModel):
     mids: List[str]
     delete_files: bool = False
@@ -277,9 +443,10 @@ async def remove_selected_downloads(payload: TaskActionPayload):
                     os.remove(file_path)
                     deleted_files_count += 1
             except OSError as e:
-                print(f"删除文件失败: {e}")
+                log.error("删除文件失败: %s", e)
 
         del download_tasks[mid]
+        mark_task_removed(mid)
         removed_count += 1
 
     await tasks._save_download_tasks()
@@ -336,6 +503,7 @@ async def cancel_download(song_mid: str):
         download_tasks[song_mid].update(
             {"status": "cancelled", "error": "用户手动取消"}
         )
+        mark_task_changed(song_mid)
         await tasks._save_download_tasks()
         return {"status": "success", "message": "任务已取消"}
     else:
@@ -349,6 +517,7 @@ async def remove_download_task(song_mid: str):
         raise HTTPException(status_code=404, detail="任务不存在")
 
     del download_tasks[song_mid]
+    mark_task_removed(song_mid)
     await tasks._save_download_tasks()
     return {"status": "success", "message": "任务已从列表移除"}
 
@@ -386,10 +555,10 @@ async def test_local_songs():
     """返回所有本地歌曲信息"""
     from utils import song_index_manager
     
-    return {
-        "local_songs": list(song_index_manager._index["by_basename"].values()),
-        "count": len(song_index_manager._index["by_basename"])
-    }
+    return FastJSONResponse({
+        "local_songs": song_index_manager.get_indexed_songs(),
+        "count": len(song_index_manager.get_indexed_songs())
+    })
 
 # 测试端点：直接测试本地歌曲匹配
 @app.get("/api/test-local-matching")
@@ -414,7 +583,7 @@ async def test_local_matching():
         })
     
     return {
-        "local_songs": list(song_index_manager._index["by_basename"].values()),
+        "local_songs": song_index_manager.get_indexed_songs(),
         "test_results": results
     }
 
@@ -436,6 +605,52 @@ async def get_monitoring_status():
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# 变更记录每页的最大条数
+HISTORY_PAGE_MAX_LIMIT = 500
+
+@app.get("/api/monitor/history", dependencies=[Depends(check_auth_status)])
+async def get_all_monitoring_history(since: Optional[int] = None, until: Optional[int] = None, limit: int = 200):
+    """查询所有监控歌单在时间范围内的变更记录（例如本周新增的歌曲）"""
+    limit = max(1, min(limit, HISTORY_PAGE_MAX_LIMIT))
+    return {"entries": await monitor.get_all_playlist_history(since=since, until=until, limit=limit)}
+
+@app.get("/api/monitor/{playlist_id}/history", dependencies=[Depends(check_auth_status)])
+async def get_monitoring_history(playlist_id: str, since: Optional[int] = None, until: Optional[int] = None,
+                                 cursor: Optional[int] = None, limit: int = 50):
+    """分页查询单个监控歌单的变更记录，按时间倒序"""
+    if not playlist_id.isdigit():
+        raise HTTPException(status_code=400, detail="无效的歌单ID")
+    # limit 为 0 时游标不会前进，客户端会一直拿到同一页
+    limit = max(1, min(limit, HISTORY_PAGE_MAX_LIMIT))
+    return await monitor.get_playlist_history(playlist_id, since=since, until=until, cursor=cursor, limit=limit)
+
+@app.get("/api/monitor/schedule", dependencies=[Depends(check_auth_status)])
+async def get_monitoring_schedule():
+    """获取每个监控歌单的检查间隔和下次检查时间"""
+    return await monitor.get_monitor_schedule()
+
+class MonitorIntervalPayload(BaseModel):
+    interval_seconds: Optional[int] = None
+
+@app.put("/api/monitor/{playlist_id}/interval", dependencies=[Depends(check_auth_status)])
+async def set_playlist_monitor_interval(playlist_id: str, payload: MonitorIntervalPayload):
+    """为监控歌单固定检查间隔；interval_seconds 为空时恢复自适应调度"""
+    if not await monitor.set_manual_interval(playlist_id, payload.interval_seconds):
+        raise HTTPException(status_code=404, detail="该歌单未在监控中")
+    return {"status": "success"}
+
+@app.get("/api/library/duplicates")
+async def get_library_duplicates():
+    """获取最近一次重复文件检查的报告"""
+    from dedup import library_deduplicator
+    return library_deduplicator.get_report()
+
+@app.post("/api/library/dedup")
+async def run_library_dedup():
+    """立即执行一次重复文件检查"""
+    from dedup import library_deduplicator
+    return await library_deduplicator.run()
+
 @app.get("/", response_class=HTMLResponse)
 async def read_root(request: Request):
     """
@@ -1,169 +1,743 @@
 import asyncio
+import base64
 import os
-from typing import Dict, List, Set
+import sys
+import time
+import zlib
+from typing import Dict, Iterable, Iterator, List, Optional, Set
 
 import aiofiles
 import orjson as json
 
 import qq_music
+from notification import notification_manager
+from playlist_history import playlist_history
+from shared_state import download_tasks
+from song_catalog import song_catalog, format_song_name
 from tasks import add_song_to_queue
 
 DATA_DIR = "data"
+# 旧版单文件存储，仅用于一次性迁移
 MONITOR_FILE = os.path.join(DATA_DIR, "monitored_playlists.json")
+# 每个监控歌单单独保存为一个文件，只重写发生变化的歌单
+MONITOR_DIR = os.path.join(DATA_DIR, "monitored_playlists")
+# 所有监控歌单共享的 mid 驻留表，每行一个 mid，行号即其编号（只追加）
+MID_TABLE_FILE = os.path.join(MONITOR_DIR, "_mid_table.txt")
+# 驻留表的校验信息：已落盘的 mid 数量、字节数和 CRC32，每次追加成功后原子更新
+MID_TABLE_META_FILE = os.path.join(MONITOR_DIR, "_mid_table.meta")
 file_lock = asyncio.Lock()
 
 # 从配置管理模块获取配置
 from config import config
+from logger import get_logger
+
+log = get_logger("monitor")
+
 CHECK_INTERVAL_SECONDS = config.get("monitor.check_interval_seconds", 1800)  # 检查间隔（秒），默认为 30 分钟
+SCHEDULER_TICK_SECONDS = 30  # 调度器检查到期歌单的最长间隔
+
+# 自适应调度：有变化时缩短间隔，无变化时逐步放宽
+INTERVAL_SHRINK_FACTOR = 0.5
+INTERVAL_GROW_FACTOR = 1.5
 
 # 确保数据目录在启动时存在
 os.makedirs(DATA_DIR, exist_ok=True)
+os.makedirs(MONITOR_DIR, exist_ok=True)
+
+# {
+#     "playlist_id": {
+#         "title": "歌单名",
+#         "known_song_mids": KnownMids,      # 磁盘上保存为 known_song_bitmap（基于 mid 驻留表编号的位图）
+#         "last_song_mids": KnownMids,       # 上次完整拉取时的歌曲，用于计算删除的歌曲；磁盘上保存为 last_song_bitmap
+#         "interval_seconds": 1800,          # 当前自适应检查间隔
+#         "manual_interval_seconds": None,   # 手动固定的检查间隔（可选）
+#         "next_check_at": 1700000000,       # 下次检查时间戳
+#         "last_changed_at": 1700000000,     # 最近一次发现新歌的时间戳
+#         "fingerprint": "120:1700000000:mid1",  # 歌曲数:修改时间:首曲 mid
+#         "last_full_check_at": 1700000000,  # 最近一次完整拉取的时间戳
+#         "baseline_unknown": True           # 仅在驻留表损坏导致位图无法解析时出现，下次检查时重新建立基线
+#     }
+# }
+MonitoredPlaylists = Dict[str, Dict]
+
+class MidTable:
+    """所有监控歌单共享的 mid 驻留表
+
+    每个 mid 只保存一份字符串并分配一个递增编号，歌单中的已知歌曲
+    以该编号上的位图表示。磁盘上为只追加的文本文件，新 mid 追加写入；
+    编号完全取决于行号，因此另存一份校验信息，加载时发现截断或损坏就整体作废。
+    """
+    def __init__(self):
+        self._ids: Dict[str, int] = {}
+        self._mids: List[str] = []
+        self._flushed = 0
+        self._flushed_bytes = 0
+        self._crc = 0
+
+    def __len__(self) -> int:
+        return len(self._mids)
+
+    def _reset(self):
+        self._ids.clear()
+        self._mids.clear()
+        self._flushed = 0
+        self._flushed_bytes = 0
+        self._crc = 0
+
+    def load(self) -> bool:
+        """加载驻留表并按校验信息验证
+
+        Returns:
+            bool: 驻留表是否可信；为 False 时表已重置为空，歌单位图中的编号都无法解析
+        """
+        self._reset()
+        meta = self._read_meta()
+        if not os.path.exists(MID_TABLE_FILE):
+            if meta and meta.get("count"):
+                log.error("mid 驻留表 '%s' 丢失，监控歌单的已知歌曲将在下次检查时重新建立。", MID_TABLE_FILE)
+                self._write_meta(0, 0, 0)
+                return False
+            return True
+
+        with open(MID_TABLE_FILE, "rb") as f:
+            data = f.read()
+        if meta is None:
+            # 旧版没有校验信息：只丢弃末尾不完整的一行，各歌单位图再由编号上限检查
+            size = data.rfind(b"\n") + 1
+        else:
+            size = meta.get("bytes", -1)
+            if len(data) < size or zlib.crc32(data[:size]) != meta.get("crc32") \
+                    or data[:size].count(b"\n") != meta.get("count"):
+                log.error("mid 驻留表 '%s' 校验失败，已重置，监控歌单的已知歌曲将在下次检查时重新建立。", MID_TABLE_FILE)
+                os.replace(MID_TABLE_FILE, MID_TABLE_FILE + ".corrupt")
+                self._write_meta(0, 0, 0)
+                return False
+
+        for line in data[:size].decode("utf-8").splitlines():
+            self.intern(line)
+        self._flushed = len(self._mids)
+        self._flushed_bytes = size
+        self._crc = zlib.crc32(data[:size])
+        if len(data) > size:
+            # 上次追加写入了内容但未来得及更新校验信息，这些编号不会被任何已保存的位图引用
+            log.warning("丢弃 mid 驻留表末尾未确认的 %d 字节。", len(data) - size)
+            with open(MID_TABLE_FILE, "r+b") as f:
+                f.truncate(size)
+        if meta is None:
+            self._write_meta(self._flushed, self._flushed_bytes, self._crc)
+        return True
+
+    @staticmethod
+    def _read_meta() -> Optional[Dict]:
+        try:
+            with open(MID_TABLE_META_FILE, "rb") as f:
+                meta = json.loads(f.read())
+            return meta if isinstance(meta, dict) else None
+        except (OSError, json.JSONDecodeError):
+            return None
+
+    @staticmethod
+    def _write_meta(count: int, size: int, crc: int):
+        tmp_path = MID_TABLE_META_FILE + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(json.dumps({"count": count, "bytes": size, "crc32": crc}))
+        os.replace(tmp_path, MID_TABLE_META_FILE)
+
+    def intern(self, mid: str) -> int:
+        """返回 mid 的编号，不存在时分配新编号"""
+        mid_id = self._ids.get(mid)
+        if mid_id is None:
+            mid_id = len(self._mids)
+            mid = sys.intern(mid)
+            self._ids[mid] = mid_id
+            self._mids.append(mid)
+        return mid_id
+
+    def lookup(self, mid: str) -> Optional[int]:
+        return self._ids.get(mid)
+
+    def mid(self, mid_id: int) -> str:
+        return self._mids[mid_id]
+
+    def flush(self):
+        """将新分配的 mid 追加写入磁盘，写入成功后更新校验信息"""
+        if self._flushed >= len(self._mids):
+            return
+        data = "".join(f"{mid}\n" for mid in self._mids[self._flushed:]).encode("utf-8")
+        # 从上次确认的位置写起：上次追加中途失败留下的残缺内容会被覆盖，重试不会重复追加
+        with open(MID_TABLE_FILE, "r+b" if os.path.exists(MID_TABLE_FILE) else "wb") as f:
+            f.seek(self._flushed_bytes)
+            f.truncate()
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        crc = zlib.crc32(data, self._crc)
+        self._write_meta(len(self._mids), self._flushed_bytes + len(data), crc)
+        self._flushed = len(self._mids)
+        self._flushed_bytes += len(data)
+        self._crc = crc
+
+mid_table = MidTable()
+
+class KnownMids:
+    """基于 mid 驻留表编号的位图集合，支持 O(1) 成员测试"""
+    __slots__ = ("_bits", "_count")
+
+    def __init__(self, mids: Iterable[str] = ()):
+        self._bits = bytearray()
+        self._count = 0
+        self.update(mids)
+
+    def __contains__(self, mid: str) -> bool:
+        mid_id = mid_table.lookup(mid)
+        if mid_id is None:
+            return False
+        byte_index = mid_id >> 3
+        return byte_index < len(self._bits) and bool(self._bits[byte_index] & (1 << (mid_id & 7)))
+
+    def add(self, mid: str):
+        mid_id = mid_table.intern(mid)
+        byte_index = mid_id >> 3
+        if byte_index >= len(self._bits):
+            self._bits.extend(bytes(byte_index + 1 - len(self._bits)))
+        mask = 1 << (mid_id & 7)
+        if not self._bits[byte_index] & mask:
+            self._bits[byte_index] |= mask
+            self._count += 1
+
+    def update(self, mids: Iterable[str]):
+        for mid in mids:
+            self.add(mid)
+
+    def __len__(self) -> int:
+        return self._count
 
-# { "playlist_id": {"title": "歌单名", "known_song_mids": ["mid1", "mid2"]} }
-MonitoredPlaylists = Dict[str, Dict[str, Set[str]]]
+    def max_id(self) -> int:
+        """位图中最大的编号，空位图为 -1"""
+        for byte_index in range(len(self._bits) - 1, -1, -1):
+            if self._bits[byte_index]:
+                return (byte_index << 3) | (self._bits[byte_index].bit_length() - 1)
+        return -1
 
-async def _load_monitored_playlists() -> MonitoredPlaylists:
-    """加载被监控的歌单列表，确保 song_mids 是集合类型"""
-    async with file_lock:
+    def __iter__(self) -> Iterator[str]:
+        for byte_index, byte in enumerate(self._bits):
+            if not byte:
+                continue
+            for bit in range(8):
+                if byte & (1 << bit):
+                    yield mid_table.mid((byte_index << 3) | bit)
+
+    def to_bytes(self) -> str:
+        """压缩并编码为可存入 JSON 的字符串"""
+        return base64.b64encode(zlib.compress(bytes(self._bits))).decode("ascii")
+
+    @classmethod
+    def from_bytes(cls, data: str) -> "KnownMids":
+        known = cls()
+        known._bits = bytearray(zlib.decompress(base64.b64decode(data)))
+        known._count = sum(bin(byte).count("1") for byte in known._bits)
+        return known
+
+class MonitorRegistry:
+    """常驻内存的监控歌单注册表
+
+    启动后只从磁盘加载一次，之后所有读取都直接访问内存。
+    修改过的歌单通过 mark_dirty 标记，save 时只重写这些歌单的文件。
+    """
+    def __init__(self):
+        self._playlists: MonitoredPlaylists = {}
+        self._dirty: Set[str] = set()
+        self._removed: Set[str] = set()
+        self._loaded = False
+        self._load_lock = asyncio.Lock()
+
+    async def load(self):
+        """从磁盘加载注册表；已加载时直接返回"""
+        if self._loaded:
+            return
+        async with self._load_lock:
+            if self._loaded:
+                return
+            async with file_lock:
+                table_valid = mid_table.load()
+                playlists = await self._read_playlist_files(table_valid)
+            self._playlists = playlists
+            # 基线失效的标记立即落盘，避免重启后新分配的编号让旧位图被错误地解析
+            self._dirty.update(pid for pid, details in playlists.items() if details.get("baseline_unknown"))
+            self._loaded = True
+            await self._migrate_legacy_file()
+            log.info("已加载 %s 个监控歌单。", len(self._playlists))
+
+    async def _read_playlist_files(self, table_valid: bool = True) -> MonitoredPlaylists:
+        playlists = {}
+        for filename in os.listdir(MONITOR_DIR):
+            if not filename.endswith(".json"):
+                continue
+            path = os.path.join(MONITOR_DIR, filename)
+            try:
+                async with aiofiles.open(path, "rb") as f:
+                    content = await f.read()
+                details = json.loads(content)
+                if not isinstance(details, dict):
+                    log.warning("'%s' 文件内容不是预期的字典格式，已跳过。", path)
+                    continue
+                playlists[filename[:-len(".json")]] = self._decode(details, table_valid)
+            except (json.JSONDecodeError, IOError) as e:
+                log.warning("读取或解析 '%s' 文件失败: %s，已跳过。", path, e)
+        return playlists
+
+    async def _migrate_legacy_file(self):
+        """将旧版 monitored_playlists.json 迁移为按歌单拆分的文件"""
         if not os.path.exists(MONITOR_FILE):
-            return {}
+            return
         try:
             async with aiofiles.open(MONITOR_FILE, "rb") as f:
                 content = await f.read()
-                if not content:
-                    return {}
-                data = json.loads(content)
-
-            if not isinstance(data, dict):
-                print(f"警告: '{MONITOR_FILE}' 文件内容不是预期的字典格式，将重置为空。")
-                return {}
+            data = json.loads(content) if content.strip() else {}
+        except (json.JSONDecodeError, IOError) as e:
+            log.warning("读取旧版监控列表 '%s' 失败: %s，跳过迁移。", MONITOR_FILE, e)
+            return
 
+        if isinstance(data, dict):
             for playlist_id, details in data.items():
-                if "known_song_mids" in details and isinstance(
-                    details["known_song_mids"], list
-                ):
-                    details["known_song_mids"] = set(details["known_song_mids"])
-            return data
-        except (json.JSONDecodeError, IOError) as e:
-            print(f"警告: 读取或解析 '{MONITOR_FILE}' 文件失败: {e}。将返回空监控列表。")
-            return {}
+                if playlist_id not in self._playlists and isinstance(details, dict):
+                    self._playlists[playlist_id] = self._decode(details)
+                    self._dirty.add(playlist_id)
+        await self.save()
+        os.replace(MONITOR_FILE, MONITOR_FILE + ".migrated")
+        log.info("已将旧版监控列表迁移至 '%s'。", MONITOR_DIR)
 
-async def _save_monitored_playlists(playlists: MonitoredPlaylists):
-    """保存被监控的歌单列表，将集合转回列表以便JSON序列化"""
-    async with file_lock:
-        try:
-            data_to_save = {}
-            for playlist_id, details in playlists.items():
-                data_to_save[playlist_id] = details.copy()
-                if "known_song_mids" in data_to_save[playlist_id]:
-                    data_to_save[playlist_id]["known_song_mids"] = list(
-                        details["known_song_mids"]
-                    )
-            # orjson.dumps 返回 bytes, indent=2
-            json_data = json.dumps(data_to_save, option=json.OPT_INDENT_2)
-            async with aiofiles.open(MONITOR_FILE, "wb") as f:
-                await f.write(json_data)
-        except IOError as e:
-            print(f"错误：无法保存监控列表文件: {e}")
+    # 内存中的 KnownMids 字段 -> 磁盘上的位图字段
+    BITMAP_FIELDS = {
+        "known_song_mids": "known_song_bitmap",
+        "last_song_mids": "last_song_bitmap",
+    }
+
+    @classmethod
+    def _decode(cls, details: Dict, table_valid: bool = True) -> Dict:
+        """将磁盘上的位图（或旧版 mid 列表）还原为 KnownMids
+
+        驻留表不可信，或位图引用了表中不存在的编号时，已知歌曲无从得知：标记 baseline_unknown，
+        下次检查时以歌单当前内容重新建立基线，而不是把所有歌曲都当成新歌。
+        """
+        for field, bitmap_field in cls.BITMAP_FIELDS.items():
+            if bitmap_field in details:
+                known = KnownMids.from_bytes(details.pop(bitmap_field))
+                if not table_valid or known.max_id() >= len(mid_table):
+                    details["baseline_unknown"] = True
+                details[field] = known
+            elif field == "known_song_mids" and details.get("baseline_unknown"):
+                continue
+            elif field == "known_song_mids" and not isinstance(details.get(field), KnownMids):
+                details[field] = KnownMids(details.get(field) or ())
+            elif field in details and not isinstance(details[field], KnownMids):
+                details[field] = KnownMids(details[field])
+        if details.get("baseline_unknown"):
+            log.warning("监控歌单 '%s' 的已知歌曲无法解析，下次检查时将重新建立基线。", details.get("title"))
+            for field in cls.BITMAP_FIELDS:
+                details[field] = None
+        return details
+
+    @classmethod
+    def _encode(cls, details: Dict) -> bytes:
+        """将 KnownMids 编码为位图以便 JSON 序列化"""
+        data = details.copy()
+        for field, bitmap_field in cls.BITMAP_FIELDS.items():
+            mids = data.pop(field, None)
+            if mids is not None:
+                data[bitmap_field] = mids.to_bytes()
+        return json.dumps(data)
+
+    def ids(self) -> List[str]:
+        return list(self._playlists.keys())
+
+    def items(self):
+        return self._playlists.items()
+
+    def get(self, playlist_id: str) -> Optional[Dict]:
+        return self._playlists.get(playlist_id)
+
+    def __contains__(self, playlist_id: str) -> bool:
+        return playlist_id in self._playlists
+
+    def __len__(self) -> int:
+        return len(self._playlists)
+
+    def add(self, playlist_id: str, details: Dict):
+        self._playlists[playlist_id] = self._decode(details)
+        self._removed.discard(playlist_id)
+        self._dirty.add(playlist_id)
+
+    def remove(self, playlist_id: str):
+        if self._playlists.pop(playlist_id, None) is not None:
+            self._dirty.discard(playlist_id)
+            self._removed.add(playlist_id)
+
+    def mark_dirty(self, playlist_id: str):
+        if playlist_id in self._playlists:
+            self._dirty.add(playlist_id)
+
+    async def save(self):
+        """只写入发生变化的歌单，并删除已取消监控的歌单文件"""
+        if not self._dirty and not self._removed:
+            return
+        async with file_lock:
+            dirty, self._dirty = self._dirty, set()
+            removed, self._removed = self._removed, set()
+            # 先写入新分配的 mid，保证歌单位图引用的编号都已落盘
+            try:
+                mid_table.flush()
+            except IOError as e:
+                log.error("无法保存 mid 驻留表: %s", e)
+                self._dirty |= dirty
+                self._removed |= removed
+                return
+            for playlist_id in dirty:
+                details = self._playlists.get(playlist_id)
+                if details is None:
+                    continue
+                path = os.path.join(MONITOR_DIR, f"{playlist_id}.json")
+                tmp_path = path + ".tmp"
+                try:
+                    async with aiofiles.open(tmp_path, "wb") as f:
+                        await f.write(self._encode(details))
+                    os.replace(tmp_path, path)
+                except IOError as e:
+                    log.error("无法保存监控歌单 %s: %s", playlist_id, e)
+                    self._dirty.add(playlist_id)
+            for playlist_id in removed:
+                path = os.path.join(MONITOR_DIR, f"{playlist_id}.json")
+                try:
+                    if os.path.exists(path):
+                        os.remove(path)
+                except OSError as e:
+                    log.error("无法删除监控歌单文件 %s: %s", path, e)
+
+# 全局监控注册表实例
+monitor_registry = MonitorRegistry()
 
 async def toggle_monitoring(playlist_id: str) -> bool:
     """切换一个歌单的监控状态，返回当前是否在监控"""
-    playlists = await _load_monitored_playlists()
-    
-    if playlist_id in playlists:
+    await monitor_registry.load()
+
+    if playlist_id in monitor_registry:
         # 如果已在监控，则取消监控
-        del playlists[playlist_id]
+        monitor_registry.remove(playlist_id)
         is_monitoring = False
-        print(f"已取消对歌单 {playlist_id} 的监控。")
+        log.info("已取消对歌单 %s 的监控。", playlist_id)
     else:
         # 如果未在监控，则开始监控
         try:
             # 获取歌单详情以存储歌单名和当前歌曲列表
             playlist_details = await qq_music.get_playlist_songs(int(playlist_id))
             if isinstance(playlist_details, list): # 假设返回的是歌曲列表
+                song_catalog.upsert_many(playlist_details)
                 current_mids = {song['mid'] for song in playlist_details}
                 # 尝试从API获取歌单名，这里需要一个能获取歌单信息的函数
                 # 暂时使用 playlist_id 作为 title
                 title = f"歌单 {playlist_id}" 
-                playlists[playlist_id] = {
+                base_interval = _base_interval()
+                monitor_registry.add(playlist_id, {
                     "title": title,
-                    "known_song_mids": current_mids
-                }
+                    "known_song_mids": current_mids,
+                    "last_song_mids": current_mids,
+                    "interval_seconds": base_interval,
+                    "manual_interval_seconds": None,
+                    "next_check_at": int(time.time()) + base_interval,
+                    "last_changed_at": 0
+                })
                 is_monitoring = True
-                print(f"已开始监控歌单 {playlist_id}。当前有 {len(current_mids)} 首歌曲。")
+                log.info("已开始监控歌单 %s。当前有 %s 首歌曲。", playlist_id, len(current_mids))
             else:
-                print(f"错误：无法获取歌单 {playlist_id} 的歌曲列表。")
+                log.error("无法获取歌单 %s 的歌曲列表。", playlist_id)
                 return False # 操作失败
         except Exception as e:
-            print(f"错误：添加监控时无法获取歌单详情: {e}")
+            log.error("添加监控时无法获取歌单详情: %s", e)
             return False # 操作失败
 
-    await _save_monitored_playlists(playlists)
+    await monitor_registry.save()
     return is_monitoring
 
 async def get_monitored_playlist_ids() -> List[str]:
     """获取所有被监控的歌单ID"""
-    playlists = await _load_monitored_playlists()
-    return list(playlists.keys())
+    await monitor_registry.load()
+    return monitor_registry.ids()
+
+# --- 调度 ---
+
+def _base_interval() -> int:
+    """实时读取全局检查间隔，配置修改后立即生效"""
+    return max(60, int(config.get("monitor.check_interval_seconds", CHECK_INTERVAL_SECONDS)))
+
+def _interval_bounds() -> tuple:
+    """自适应间隔的上下限"""
+    min_interval = max(60, int(config.get("monitor.min_interval_seconds", 300)))
+    max_interval = max(min_interval, int(config.get("monitor.max_interval_seconds", 24 * 3600)))
+    return min_interval, max_interval
+
+_last_base_interval: Optional[int] = None
+
+def _apply_config_changes() -> bool:
+    """全局检查间隔变化时，重置所有未手动固定歌单的自适应间隔"""
+    global _last_base_interval
+    base_interval = _base_interval()
+    if _last_base_interval is None:
+        _last_base_interval = base_interval
+        return False
+    if base_interval == _last_base_interval:
+        return False
+
+    log.info("检查间隔已由 %s 秒调整为 %s 秒，重新调度监控歌单。", _last_base_interval, base_interval)
+    _last_base_interval = base_interval
+    now = int(time.time())
+    for playlist_id, details in monitor_registry.items():
+        if details.get("manual_interval_seconds"):
+            continue
+        details["interval_seconds"] = base_interval
+        details["next_check_at"] = min(details.get("next_check_at", now), now + base_interval)
+        monitor_registry.mark_dirty(playlist_id)
+    return True
+
+def _reschedule(details: Dict, changed: Optional[bool]):
+    """根据本次检查结果更新歌单的检查间隔和下次检查时间
+
+    changed 为 None 表示本次检查失败，此时保持原间隔。
+    """
+    now = int(time.time())
+    manual_interval = details.get("manual_interval_seconds")
+    if manual_interval:
+        interval = int(manual_interval)
+    else:
+        min_interval, max_interval = _interval_bounds()
+        interval = int(details.get("interval_seconds") or _base_interval())
+        if changed:
+            interval = int(interval * INTERVAL_SHRINK_FACTOR)
+        elif changed is False:
+            interval = int(interval * INTERVAL_GROW_FACTOR)
+        interval = max(min_interval, min(max_interval, interval))
 
-async def check_playlists_for_updates():
-    """检查所有被监控的歌单是否有更新，并自动下载新歌曲"""
-    print("开始检查监控的歌单是否有更新...")
+    details["interval_seconds"] = interval
+    details["next_check_at"] = now + interval
+    if changed:
+        details["last_changed_at"] = now
+
+async def set_manual_interval(playlist_id: str, interval_seconds: Optional[int]) -> bool:
+    """为歌单固定一个手动检查间隔；传入 None 恢复自适应调度"""
+    await monitor_registry.load()
+    details = monitor_registry.get(playlist_id)
+    if details is None:
+        return False
+
+    now = int(time.time())
+    if interval_seconds:
+        interval_seconds = max(60, int(interval_seconds))
+        details["manual_interval_seconds"] = interval_seconds
+        details["interval_seconds"] = interval_seconds
+        details["next_check_at"] = min(details.get("next_check_at", now), now + interval_seconds)
+    else:
+        details["manual_interval_seconds"] = None
+        details["interval_seconds"] = _base_interval()
+    monitor_registry.mark_dirty(playlist_id)
+    await monitor_registry.save()
+    return True
+
+async def get_monitor_schedule() -> Dict[str, Dict]:
+    """获取每个监控歌单的调度信息"""
+    await monitor_registry.load()
+    return {
+        playlist_id: {
+            "title": details.get("title", playlist_id),
+            "interval_seconds": details.get("interval_seconds", _base_interval()),
+            "manual_interval_seconds": details.get("manual_interval_seconds"),
+            "next_check_at": details.get("next_check_at", 0),
+            "last_changed_at": details.get("last_changed_at", 0),
+        }
+        for playlist_id, details in monitor_registry.items()
+    }
+
+async def check_playlists_for_updates(force: bool = False):
+    """检查到期的监控歌单是否有更新，并自动下载新歌曲
+
+    Args:
+        force: 为 True 时忽略调度，检查所有监控歌单
+    """
     await qq_music.auth_completed.wait()
     if not qq_music.is_login_valid:
-        print("检查更新失败：用户未登录。")
+        log.error("检查更新失败：用户未登录。")
         return
 
-    playlists = await _load_monitored_playlists()
-    if not playlists:
-        print("没有正在监控的歌单。")
+    await monitor_registry.load()
+    if not len(monitor_registry):
         return
 
-    updated_playlists = playlists.copy()
-    
-    for playlist_id, details in playlists.items():
+    _apply_config_changes()
+    now = int(time.time())
+    due_playlists = {
+        playlist_id: details
+        for playlist_id, details in monitor_registry.items()
+        if force or details.get("next_check_at", 0) <= now
+    }
+    if not due_playlists:
+        await monitor_registry.save()
+        return
+
+    log.info("开始检查 %s 个到期的监控歌单...", len(due_playlists))
+
+    max_concurrent = max(1, int(config.get("monitor.max_concurrent_checks", 5)))
+    check_timeout = int(config.get("monitor.check_timeout_seconds", 60))
+    semaphore = asyncio.Semaphore(max_concurrent)
+
+    # 并发拉取所有到期歌单，每个歌单独立超时、独立处理错误
+    results = await asyncio.gather(
+        *(
+            _check_single_playlist(playlist_id, details, semaphore, check_timeout)
+            for playlist_id, details in due_playlists.items()
+        )
+    )
+
+    # 汇总所有歌单的差异后统一入队，并只保存一次
+    # 同一首歌出现在多个歌单中时，本轮只入队一次
+    queued_mids = set()
+    for playlist_id, new_songs, current_mids in results:
+        details = monitor_registry.get(playlist_id)
+        if details is None:
+            # 检查期间被取消了监控
+            continue
+        if current_mids is not None:
+            await _record_changes(playlist_id, details, current_mids, new_songs)
+        if new_songs:
+            log.info("歌单 '%s' 发现 %s 首新歌曲！", details.get('title', playlist_id), len(new_songs))
+            for song in new_songs:
+                mid = song['mid']
+                task = download_tasks.get(mid)
+                if mid in queued_mids or (task and task.get("status") in ("queued", "downloading", "completed")):
+                    continue
+                queued_mids.add(mid)
+                song_name = format_song_name(song['name'], [s['name'] for s in song['singer']])
+                log.debug("正在将新歌曲 '%s' 加入下载队列...", song_name)
+                # 将新歌放入任务队列，而不是直接下载
+                await add_song_to_queue(mid, song_name)
+
+            # 更新该歌单的已知歌曲列表
+            details["known_song_mids"].update(song['mid'] for song in new_songs)
+
+            await notification_manager.enqueue("playlist_update", {
+                "playlist_name": details.get('title', playlist_id),
+                "new_songs": [
+                    {"name": song['name'], "singer": [{"name": s['name']} for s in song['singer']]}
+                    for song in new_songs
+                ],
+            })
+
+        _reschedule(details, None if new_songs is None else bool(new_songs))
+        monitor_registry.mark_dirty(playlist_id)
+
+    await monitor_registry.save()
+    log.info("歌单更新检查完成。")
+
+async def _record_changes(playlist_id: str, details: Dict, current_mids: List[str], new_songs: List[Dict]):
+    """与上次完整拉取的结果对比，将新增和删除的歌曲写入变更日志"""
+    last_mids = details.get("last_song_mids")
+    details["last_song_mids"] = KnownMids(current_mids)
+    if last_mids is None:
+        # 还没有上次的快照（旧数据），本次只建立基线
+        return
+
+    current_set = set(current_mids)
+    added = [mid for mid in current_mids if mid not in last_mids]
+    removed = [mid for mid in last_mids if mid not in current_set]
+    task_ids = [song['mid'] for song in new_songs]
+    await playlist_history.record(playlist_id, added, removed, task_ids)
+
+async def get_playlist_history(playlist_id: str, since: Optional[int] = None, until: Optional[int] = None,
+                               cursor: Optional[int] = None, limit: int = 50) -> Dict:
+    """分页查询单个监控歌单的变更记录"""
+    return await playlist_history.query(playlist_id, since=since, until=until, cursor=cursor, limit=limit)
+
+async def get_all_playlist_history(since: Optional[int] = None, until: Optional[int] = None, limit: int = 200) -> List[Dict]:
+    """查询所有监控歌单在时间范围内的变更记录"""
+    await monitor_registry.load()
+    return await playlist_history.query_all(monitor_registry.ids(), since=since, until=until, limit=limit)
+
+async def _check_single_playlist(playlist_id: str, details: Dict, semaphore: asyncio.Semaphore, timeout: int):
+    """检查单个歌单，返回 (playlist_id, 新歌曲列表, 当前全部 mid)
+
+    出错时新歌曲列表为 None；未进行完整拉取时当前全部 mid 为 None。
+    """
+    title = details.get('title', playlist_id)
+    async with semaphore:
+        # 先用轻量指纹判断歌单是否可能变化，未变化时跳过完整拉取
+        fingerprint = None
         try:
-            print(f"正在检查歌单: {details.get('title', playlist_id)}...")
-            # 传入 no_cache=True 来绕过 API 缓存
-            current_songs = await qq_music.get_playlist_songs(int(playlist_id), no_cache=True)
-            if not isinstance(current_songs, list):
-                print(f"警告：无法获取歌单 {playlist_id} 的当前歌曲列表，跳过。")
-                continue
+            fingerprint = await asyncio.wait_for(
+                qq_music.get_playlist_fingerprint(int(playlist_id)), timeout
+            )
+        except Exception as e:
+            log.warning("获取歌单 %s 指纹失败: %s，将进行完整检查。", playlist_id, e)
 
-            current_mids = {song['mid'] for song in current_songs}
-            known_mids = details.get("known_song_mids", set())
-            
-            new_mids = current_mids - known_mids
-            
-            if new_mids:
-                print(f"歌单 '{details.get('title', playlist_id)}' 发现 {len(new_mids)} 首新歌曲！")
-                for song in current_songs:
-                    if song['mid'] in new_mids:
-                        song_name = f"{song['name']} - {', '.join(s['name'] for s in song['singer'])}"
-                        print(f"  -> 正在将新歌曲 '{song_name}' 加入下载队列...")
-                        # 将新歌放入任务队列，而不是直接下载
-                        await add_song_to_queue(song['mid'], song_name)
-                
-                # 更新该歌单的已知歌曲列表
-                updated_playlists[playlist_id]["known_song_mids"].update(new_mids)
-            else:
-                print(f"歌单 '{details.get('title', playlist_id)}' 没有发现新歌曲。")
+        now = int(time.time())
+        full_check_interval = int(config.get("monitor.full_check_interval_seconds", 24 * 3600))
+        full_check_due = now - details.get("last_full_check_at", 0) >= full_check_interval
+        baseline_unknown = details.get("baseline_unknown", False)
+        if fingerprint and fingerprint == details.get("fingerprint") and not full_check_due and not baseline_unknown:
+            log.debug("歌单 '%s' 指纹未变化，跳过完整检查。", title)
+            return playlist_id, [], None
 
+        try:
+            log.debug("正在检查歌单: %s...", title)
+            # 传入 no_cache=True 来绕过 API 缓存
+            current_songs = await asyncio.wait_for(
+                qq_music.get_playlist_songs(int(playlist_id), no_cache=True), timeout
+            )
+        except asyncio.TimeoutError:
+            log.warning("检查歌单 %s 超时（%s 秒），跳过。", playlist_id, timeout)
+            return playlist_id, None, None
         except Exception as e:
-            print(f"错误：检查歌单 {playlist_id} 更新时出错: {e}")
-            continue
-    
-    await _save_monitored_playlists(updated_playlists)
-    print("歌单更新检查完成。")
+            log.error("检查歌单 %s 更新时出错: %s", playlist_id, e)
+            return playlist_id, None, None
+
+    if not isinstance(current_songs, list):
+        log.warning("无法获取歌单 %s 的当前歌曲列表，跳过。", playlist_id)
+        return playlist_id, None, None
+
+    song_catalog.upsert_many(current_songs)
+
+    # 完整拉取成功后才记录指纹，随本轮检查结果一起保存
+    details["fingerprint"] = fingerprint
+    details["last_full_check_at"] = now
+
+    current_mids = [song['mid'] for song in current_songs]
+    if baseline_unknown:
+        # 已知歌曲无法解析时无从判断哪些是新歌，以当前内容作为新的基线，不入队任何歌曲
+        details["known_song_mids"] = KnownMids(current_mids)
+        details.pop("baseline_unknown", None)
+        log.warning("歌单 '%s' 已按当前 %s 首歌曲重新建立基线。", title, len(current_mids))
+        return playlist_id, [], current_mids
+
+    known_mids = details.get("known_song_mids") or KnownMids()
+    new_songs = []
+    seen = set()
+    for song in current_songs:
+        mid = song['mid']
+        if mid not in known_mids and mid not in seen:
+            seen.add(mid)
+            new_songs.append(song)
+
+    if not new_songs:
+        log.debug("歌单 '%s' 没有发现新歌曲。", title)
+    return playlist_id, new_songs, current_mids
 
 
 async def monitoring_task():
-    """后台监控任务，定期运行"""
+    """后台监控任务，按每个歌单各自的下次检查时间调度"""
     while True:
-        await check_playlists_for_updates()
-        await asyncio.sleep(CHECK_INTERVAL_SECONDS)
+        try:
+            await check_playlists_for_updates()
+        except Exception as e:
+            log.error("监控任务执行出错: %s", e)
+        await asyncio.sleep(SCHEDULER_TICK_SECONDS)
 
 def start_monitoring_task():
     """在后台启动监控任务"""
-    print("启动后台歌单监控任务...")
+    log.info("启动后台歌单监控任务...")
     asyncio.create_task(monitoring_task())
@@ -1,15 +1,44 @@
 import asyncio
 import httpx
-import json
+import os
 import time
-from typing import Dict, Any, Optional
+import uuid
+from typing import Dict, Any, List, Optional
+
+import aiofiles
+import orjson as json
+
 from config import config
+from logger import get_logger
+
+log = get_logger("notification")
+
+DATA_DIR = "data"
+# 通知发件箱：每行一个待发送事件（JSON Lines），发送成功后压缩重写
+OUTBOX_FILE = os.path.join(DATA_DIR, "notification_outbox.jsonl")
+
+# 发送失败后的重试退避（秒）
+RETRY_BASE_SECONDS = 30
+RETRY_MAX_SECONDS = 3600
+MAX_SEND_ATTEMPTS = 8
+
+# 确保数据目录在启动时存在
+os.makedirs(DATA_DIR, exist_ok=True)
 
 class NotificationManager:
-    """通知管理模块，支持多种通知方式"""
+    """通知管理模块，支持多种通知方式
+
+    业务代码通过 enqueue 将事件写入持久化的发件箱后立即返回，
+    由后台发送任务按时间窗口或数量把事件合并成摘要后统一发送，
+    失败时按指数退避重试。
+    """
     def __init__(self):
         self._config = config
         self._clients = {}
+        self._outbox: List[Dict[str, Any]] = []
+        self._outbox_lock = asyncio.Lock()
+        self._outbox_event = asyncio.Event()
+        self._sender_task = None
     
     async def _get_client(self, client_id: str = "default") -> httpx.AsyncClient:
         """获取或创建HTTP客户端"""
@@ -39,7 +68,7 @@ class NotificationManager:
             response.raise_for_status()
             return True
         except Exception as e:
-            print(f"发送Webhook通知失败: {e}")
+            log.error("发送Webhook通知失败: %s", e)
             return False
     
     async def _send_bark(self, message: str, title: str = "QQ音乐下载器通知") -> bool:
@@ -66,9 +95,27 @@ class NotificationManager:
             response.raise_for_status()
             return True
         except Exception as e:
-            print(f"发送Bark通知失败: {e}")
+            log.error("发送Bark通知失败: %s", e)
             return False
     
+    def _enabled_channels(self) -> List[str]:
+        """返回当前已启用且配置完整的通知渠道"""
+        channels = []
+        webhook_config = self._config.get("notification.webhook") or {}
+        if webhook_config.get("enabled", False) and webhook_config.get("url"):
+            channels.append("webhook")
+        bark_config = self._config.get("notification.bark") or {}
+        if bark_config.get("enabled", False) and bark_config.get("device_key"):
+            channels.append("bark")
+        return channels
+
+    async def _send_channel(self, channel: str, message: str, title: str) -> bool:
+        if channel == "webhook":
+            return await self._send_webhook(message, title)
+        if channel == "bark":
+            return await self._send_bark(message, title)
+        return False
+
     async def send_notification(self, message: str, title: str = "QQ音乐下载器通知") -> Dict[str, bool]:
         """发送通知，支持多种渠道并行发送
         
@@ -97,7 +144,7 @@ class NotificationManager:
             try:
                 results[name] = await task
             except Exception as e:
-                print(f"{name}通知任务执行失败: {e}")
+                log.error("%s通知任务执行失败: %s", name, e)
                 results[name] = False
         
         return results
@@ -132,8 +179,153 @@ class NotificationManager:
         message = f"歌单更新提醒！\n\n歌单名称: {playlist_name}\n新增歌曲: {len(new_songs)}首\n\n{song_list}\n\n更新时间: {time.strftime('%Y-%m-%d %H:%M:%S')}"
         return await self.send_notification(message, "歌单更新提醒")
     
+    # --- 持久化发件箱 ---
+
+    async def load_outbox(self):
+        """从磁盘恢复上次未发送完成的事件"""
+        if not os.path.exists(OUTBOX_FILE):
+            return
+        events = []
+        try:
+            async with aiofiles.open(OUTBOX_FILE, "rb") as f:
+                async for line in f:
+                    if line.strip():
+                        try:
+                            events.append(json.loads(line))
+                        except json.JSONDecodeError:
+                            log.warning("通知发件箱中存在无法解析的行，已跳过。")
+        except IOError as e:
+            log.error("加载通知发件箱失败: %s", e)
+            return
+        async with self._outbox_lock:
+            self._outbox = events + self._outbox
+        if self._outbox:
+            log.info("已从发件箱恢复 %s 条待发送通知。", len(self._outbox))
+            self._outbox_event.set()
+
+    async def enqueue(self, event_type: str, payload: Dict[str, Any]):
+        """将通知事件写入发件箱，由后台任务合并发送"""
+        event = {
+            "id": uuid.uuid4().hex,
+            "type": event_type,
+            "payload": payload,
+            "created_at": int(time.time()),
+        }
+        async with self._outbox_lock:
+            try:
+                async with aiofiles.open(OUTBOX_FILE, "ab") as f:
+                    await f.write(json.dumps(event) + b"\n")
+            except IOError as e:
+                log.error("写入通知发件箱失败: %s", e)
+            self._outbox.append(event)
+        self._outbox_event.set()
+
+    async def _ack(self, event_ids: set):
+        """从发件箱中移除已处理的事件，并压缩重写文件"""
+        async with self._outbox_lock:
+            self._outbox = [event for event in self._outbox if event["id"] not in event_ids]
+            try:
+                async with aiofiles.open(OUTBOX_FILE, "wb") as f:
+                    await f.write(b"".join(json.dumps(event) + b"\n" for event in self._outbox))
+            except IOError as e:
+                log.error("重写通知发件箱失败: %s", e)
+
+    def _build_digests(self, events: List[Dict[str, Any]]) -> List[tuple]:
+        """将一批事件合并为若干条 (标题, 内容) 摘要"""
+        digests = []
+        now_str = time.strftime('%Y-%m-%d %H:%M:%S')
+
+        downloads = [e["payload"] for e in events if e["type"] == "download_complete"]
+        if len(downloads) == 1:
+            song = downloads[0]
+            message = f"歌曲下载完成！\n\n歌曲名称: {song['song_name']}\n下载音质: {song['quality']}\n下载时间: {now_str}"
+            digests.append(("歌曲下载完成", message))
+        elif downloads:
+            song_list = "\n".join(f"- {song['song_name']} ({song['quality']})" for song in downloads[:10])
+            if len(downloads) > 10:
+                song_list += f"\n... 等共 {len(downloads)} 首歌曲"
+            message = f"{len(downloads)} 首歌曲下载完成！\n\n{song_list}\n\n汇总时间: {now_str}"
+            digests.append(("歌曲下载完成", message))
+
+        # 同一歌单的多次更新合并为一条
+        playlist_updates: Dict[str, list] = {}
+        for event in events:
+            if event["type"] == "playlist_update":
+                payload = event["payload"]
+                playlist_updates.setdefault(payload["playlist_name"], []).extend(payload["new_songs"])
+        for playlist_name, new_songs in playlist_updates.items():
+            song_list = "\n".join([f"- {song['name']} - {', '.join(s['name'] for s in song['singer'])}" for song in new_songs[:5]])
+            if len(new_songs) > 5:
+                song_list += f"\n... 等共 {len(new_songs)} 首新歌曲"
+            message = f"歌单更新提醒！\n\n歌单名称: {playlist_name}\n新增歌曲: {len(new_songs)}首\n\n{song_list}\n\n更新时间: {now_str}"
+            digests.append(("歌单更新提醒", message))
+        return digests
+
+    async def _deliver(self, digests: List[tuple], channels: List[str]):
+        """发送摘要，仅对失败的渠道按指数退避重试"""
+        pending = [(title, message, channel) for title, message in digests for channel in channels]
+        attempt = 0
+        while pending:
+            results = await asyncio.gather(
+                *(self._send_channel(channel, message, title) for title, message, channel in pending),
+                return_exceptions=True,
+            )
+            pending = [item for item, ok in zip(pending, results) if ok is not True]
+            if not pending:
+                return
+            attempt += 1
+            if attempt >= MAX_SEND_ATTEMPTS:
+                log.error("通知发送连续失败 %s 次，放弃 %s 条摘要。", attempt, len(pending))
+                return
+            delay = min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * (2 ** (attempt - 1)))
+            log.warning("%s 条通知发送失败，%s 秒后重试。", len(pending), delay)
+            await asyncio.sleep(delay)
+
+    async def _outbox_sender(self):
+        """后台发送任务：按时间窗口或事件数量合并发件箱中的事件"""
+        while True:
+            try:
+                await self._outbox_event.wait()
+                window = int(self._config.get("notification.digest_window_seconds", 60))
+                max_events = int(self._config.get("notification.digest_max_events", 50))
+
+                # 在时间窗口内累积事件，达到数量上限时提前发送
+                deadline = time.monotonic() + window
+                while len(self._outbox) < max_events and time.monotonic() < deadline:
+                    self._outbox_event.clear()
+                    try:
+                        await asyncio.wait_for(self._outbox_event.wait(), deadline - time.monotonic())
+                    except asyncio.TimeoutError:
+                        break
+
+                batch = self._outbox[:max_events]
+                if len(self._outbox) <= max_events:
+                    self._outbox_event.clear()
+                if not batch:
+                    continue
+
+                channels = self._enabled_channels()
+                if channels:
+                    await self._deliver(self._build_digests(batch), channels)
+                await self._ack({event["id"] for event in batch})
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                log.error("通知发送任务出错: %s", e)
+                await asyncio.sleep(RETRY_BASE_SECONDS)
+
+    async def start_outbox_sender(self):
+        """恢复发件箱并启动后台发送任务"""
+        await self.load_outbox()
+        if not self._sender_task:
+            self._sender_task = asyncio.create_task(self._outbox_sender())
+
     async def close(self):
-        """关闭所有HTTP客户端"""
+        """停止后台发送任务并关闭所有HTTP客户端"""
+        if self._sender_task:
+            self._sender_task.cancel()
+            await asyncio.gather(self._sender_task, return_exceptions=True)
+            self._sender_task = None
         for client in self._clients.values():
             await client.aclose()
         self._clients.clear()
@@ -0,0 +1,306 @@
+import asyncio
+import hashlib
+import os
+import struct
+import time
+import zlib
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+from urllib.parse import quote
+
+import aiofiles
+from fastapi.responses import Response, StreamingResponse
+
+from logger import get_logger
+from shared_state import download_tasks
+from utils import song_index_manager
+
+log = get_logger("playlist_export")
+
+# 导出为不压缩（stored）的 ZIP：音频本身已经压缩，重新压缩只会浪费 CPU。
+# 每个条目都使用数据描述符（通用标志位 3），本地文件头不需要 CRC，
+# 因此整个归档的布局和总大小在读取任何文件内容之前就能确定，可以支持 Range 断点续传。
+READ_CHUNK = 1024 * 1024
+ZIP32_LIMIT = 0xFFFFFFFF
+_FLAGS = 0x08 | 0x800  # 数据描述符 + 文件名使用 UTF-8
+_LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+_DATA_DESCRIPTOR = struct.Struct("<IIII")
+_CENTRAL_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+_END_RECORD = struct.Struct("<IHHHHIIH")
+_ZIP64_END_RECORD = struct.Struct("<IQHHIIQQQQ")
+_ZIP64_LOCATOR = struct.Struct("<IIQI")
+
+# 已计算的 CRC32：{路径: (mtime, size, crc)}，断点续传时不必重新读取前面已发送的文件
+_crc_cache: "OrderedDict[str, Tuple[float, int, int]]" = OrderedDict()
+_CRC_CACHE_SIZE = 4096
+
+def _cache_crc(path: str, mtime: float, size: int, crc: int):
+    _crc_cache[path] = (mtime, size, crc)
+    _crc_cache.move_to_end(path)
+    while len(_crc_cache) > _CRC_CACHE_SIZE:
+        _crc_cache.popitem(last=False)
+
+def _file_crc32(path: str) -> int:
+    """计算文件的 CRC32（同步执行，应放在线程池中调用）"""
+    crc = 0
+    with open(path, "rb") as f:
+        while chunk := f.read(READ_CHUNK):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+def _dos_datetime(mtime: float) -> Tuple[int, int]:
+    t = time.localtime(max(mtime, 315532800))  # ZIP 时间戳从 1980 年开始
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+class ZipArchive:
+    """按需生成的 stored ZIP 归档
+
+    条目为字典：name（归档内文件名）、size、mtime，以及 path（磁盘文件）或 data（内存中的小文件）之一。
+    stream() 只生成请求范围内的字节，内存占用与文件大小无关。
+    """
+    def __init__(self, entries: List[Dict[str, Any]]):
+        self.entries = entries
+        # 归档布局：(起始偏移, 长度, 类型, 内容)
+        self._segments: List[Tuple[int, int, str, Any]] = []
+        offset = 0
+        for entry in entries:
+            entry["name_bytes"] = entry["name"].encode("utf-8")
+            entry["offset"] = offset
+            entry["dos_time"], entry["dos_date"] = _dos_datetime(entry["mtime"])
+            if entry.get("data") is not None:
+                entry["crc"] = zlib.crc32(entry["data"])
+            else:
+                entry["crc"] = self._cached_crc(entry)
+            header = _LOCAL_HEADER.pack(
+                0x04034B50, 20, _FLAGS, 0, entry["dos_time"], entry["dos_date"],
+                0, 0, 0, len(entry["name_bytes"]), 0,
+            ) + entry["name_bytes"]
+            offset = self._add_segment(offset, len(header), "bytes", header)
+            offset = self._add_segment(offset, entry["size"], "data", entry)
+            offset = self._add_segment(offset, _DATA_DESCRIPTOR.size, "descriptor", entry)
+
+        self._central_offset = offset
+        self._central_size = sum(
+            _CENTRAL_HEADER.size + len(entry["name_bytes"]) + (12 if entry["offset"] >= ZIP32_LIMIT else 0)
+            for entry in entries
+        )
+        offset = self._add_segment(offset, self._central_size, "central", None)
+        end_records = self._end_records()
+        self.size = self._add_segment(offset, len(end_records), "bytes", end_records)
+
+        # 内容相同的导出 ETag 不变，客户端可以用 If-Range 安全地续传
+        digest = hashlib.blake2b(digest_size=16)
+        for entry in entries:
+            digest.update(f"{entry['name']}\0{entry['size']}\0{entry['mtime']}\n".encode("utf-8"))
+        self.etag = f'"{digest.hexdigest()}"'
+
+    def _add_segment(self, offset: int, length: int, kind: str, payload: Any) -> int:
+        self._segments.append((offset, length, kind, payload))
+        return offset + length
+
+    @staticmethod
+    def _cached_crc(entry: Dict[str, Any]) -> Optional[int]:
+        cached = _crc_cache.get(entry["path"])
+        if cached and cached[:2] == (entry["mtime"], entry["size"]):
+            return cached[2]
+        return None
+
+    def _end_records(self) -> bytes:
+        count = len(self.entries)
+        records = b""
+        zip64 = self._central_offset >= ZIP32_LIMIT or self._central_size >= ZIP32_LIMIT or count >= 0xFFFF
+        if zip64:
+            zip64_end_offset = self._central_offset + self._central_size
+            records += _ZIP64_END_RECORD.pack(
+                0x06064B50, 44, 45, 45, 0, 0, count, count, self._central_size, self._central_offset,
+            )
+            records += _ZIP64_LOCATOR.pack(0x07064B50, 0, zip64_end_offset, 1)
+        records += _END_RECORD.pack(
+            0x06054B50, 0, 0,
+            min(count, 0xFFFF), min(count, 0xFFFF),
+            min(self._central_size, ZIP32_LIMIT), min(self._central_offset, ZIP32_LIMIT), 0,
+        )
+        return records
+
+    async def _crc(self, entry: Dict[str, Any]) -> int:
+        if entry["crc"] is None:
+            crc = await asyncio.to_thread(_file_crc32, entry["path"])
+            entry["crc"] = crc
+            _cache_crc(entry["path"], entry["mtime"], entry["size"], crc)
+        return entry["crc"]
+
+    def _descriptor(self, entry: Dict[str, Any]) -> bytes:
+        return _DATA_DESCRIPTOR.pack(0x08074B50, entry["crc"], entry["size"], entry["size"])
+
+    async def _central_directory(self) -> bytes:
+        records = []
+        for entry in self.entries:
+            crc = await self._crc(entry)
+            extra = b""
+            version = 20
+            offset = entry["offset"]
+            if offset >= ZIP32_LIMIT:
+                extra = struct.pack("<HHQ", 0x0001, 8, offset)
+                version, offset = 45, ZIP32_LIMIT
+            records.append(_CENTRAL_HEADER.pack(
+                0x02014B50, version, version, _FLAGS, 0, entry["dos_time"], entry["dos_date"],
+                crc, entry["size"], entry["size"], len(entry["name_bytes"]), len(extra), 0, 0, 0, 0, offset,
+            ) + entry["name_bytes"] + extra)
+        return b"".join(records)
+
+    async def _read_data(self, entry: Dict[str, Any], start: int, end: int) -> AsyncIterator[bytes]:
+        """读取条目内容的 [start, end) 部分；完整读取时顺便计算 CRC"""
+        if entry.get("data") is not None:
+            yield entry["data"][start:end]
+            return
+        whole = start == 0 and end == entry["size"] and entry["crc"] is None
+        crc = 0
+        async with aiofiles.open(entry["path"], "rb") as f:
+            await f.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                chunk = await f.read(min(READ_CHUNK, remaining))
+                if not chunk:
+                    raise OSError(f"文件在导出过程中被修改: {entry['path']}")
+                if whole:
+                    crc = zlib.crc32(chunk, crc)
+                remaining -= len(chunk)
+                yield chunk
+        if whole:
+            entry["crc"] = crc
+            _cache_crc(entry["path"], entry["mtime"], entry["size"], crc)
+
+    async def stream(self, start: int = 0, end: Optional[int] = None) -> AsyncIterator[bytes]:
+        """生成归档 [start, end] 范围内的字节（end 包含在内，默认到末尾）"""
+        end = self.size - 1 if end is None else end
+        for seg_start, length, kind, payload in self._segments:
+            seg_end = seg_start + length
+            if seg_end <= start or seg_start > end or length == 0:
+                continue
+            lo = max(start, seg_start) - seg_start
+            hi = min(end + 1, seg_end) - seg_start
+            if kind == "bytes":
+                yield payload[lo:hi]
+            elif kind == "data":
+                async for chunk in self._read_data(payload, lo, hi):
+                    yield chunk
+            elif kind == "descriptor":
+                await self._crc(payload)
+                yield self._descriptor(payload)[lo:hi]
+            elif kind == "central":
+                yield (await self._central_directory())[lo:hi]
+
+def collect_playlist_files(songs: List[Dict[str, Any]]) -> List[Dict[str, str]]:
+    """按歌单顺序找出每首歌曲的本地文件：优先使用已完成的下载任务，其次匹配本地索引"""
+    unmatched = [song for song in songs if (download_tasks.get(song.get("mid")) or {}).get("status") != "completed"]
+    local_matches = song_index_manager.match_many(unmatched)
+    files = []
+    for song in songs:
+        mid = song.get("mid")
+        task = download_tasks.get(mid) or {}
+        if task.get("status") == "completed" and task.get("file_path"):
+            path, title = task["file_path"], task.get("song_name", "")
+        elif mid in local_matches:
+            path, title = local_matches[mid]["path"], local_matches[mid]["basename"]
+        else:
+            continue
+        files.append({"path": path, "title": title})
+    return files
+
+def collect_task_files(mids: List[str]) -> List[Dict[str, str]]:
+    """已完成的下载任务对应的本地文件"""
+    files = []
+    for mid in mids:
+        task = download_tasks.get(mid) or {}
+        if task.get("status") == "completed" and task.get("file_path"):
+            files.append({"path": task["file_path"], "title": task.get("song_name", "")})
+    return files
+
+def _stat_files(files: List[Dict[str, str]]) -> List[Dict[str, Any]]:
+    """读取文件大小和修改时间（在线程池中运行），跳过不存在或过大的文件"""
+    entries = []
+    seen_paths = set()
+    for file in files:
+        path = os.path.realpath(file["path"])
+        if path in seen_paths:
+            continue
+        seen_paths.add(path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            log.warning("导出时跳过不存在的文件: %s", file["path"])
+            continue
+        if stat.st_size >= ZIP32_LIMIT:
+            log.warning("导出时跳过超过 4GB 的文件: %s", file["path"])
+            continue
+        entries.append({"path": path, "title": file["title"], "size": stat.st_size, "mtime": stat.st_mtime})
+    return entries
+
+async def build_archive(files: List[Dict[str, str]], archive_name: str) -> ZipArchive:
+    """生成包含音频文件和 M3U 播放列表的归档布局；文件按顺序平铺在归档根目录，重名时追加序号"""
+    entries = await asyncio.to_thread(_stat_files, files)
+    used_names = set()
+    for entry in entries:
+        stem, ext = os.path.splitext(os.path.basename(entry["path"]))
+        name, counter = f"{stem}{ext}", 2
+        while name in used_names:
+            name, counter = f"{stem} ({counter}){ext}", counter + 1
+        used_names.add(name)
+        entry["name"] = name
+
+    manifest = "#EXTM3U\n" + "".join(f"#EXTINF:-1,{entry['title']}\n{entry['name']}\n" for entry in entries)
+    manifest_bytes = manifest.encode("utf-8")
+    entries.append({
+        "name": f"{archive_name}.m3u8",
+        "data": manifest_bytes,
+        "size": len(manifest_bytes),
+        "mtime": max((entry["mtime"] for entry in entries), default=time.time()),
+    })
+    return ZipArchive(entries)
+
+def _parse_range(range_header: str, size: int) -> Optional[Tuple[int, int]]:
+    """解析单段 Range 请求头
+
+    多段或语法无效（包括 last < first）时返回 None，按 RFC 9110 忽略 Range 返回完整响应；
+    起始位置不小于归档大小等无法满足的范围抛出 ValueError（416）。
+    """
+    unit, _, spec = range_header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    if (first and not first.isdigit()) or (last and not last.isdigit()) or not (first or last):
+        return None
+    if first:
+        start = int(first)
+        if last and int(last) < start:
+            return None
+        if start >= size:
+            raise ValueError(range_header)
+        return start, min(int(last), size - 1) if last else size - 1
+    # 后缀范围 bytes=-N：最后 N 个字节
+    suffix = int(last)
+    if suffix == 0:
+        raise ValueError(range_header)
+    return max(size - suffix, 0), size - 1
+
+def archive_response(archive: ZipArchive, filename: str, range_header: Optional[str], if_range: Optional[str]) -> Response:
+    """生成归档的流式响应，支持 Range 断点续传（If-Range 需与 ETag 一致）"""
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": archive.etag,
+        "Content-Disposition": f"attachment; filename=\"export.zip\"; filename*=UTF-8''{quote(filename)}",
+    }
+    byte_range = None
+    if range_header and (not if_range or if_range.strip() == archive.etag):
+        try:
+            byte_range = _parse_range(range_header, archive.size)
+        except ValueError:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{archive.size}"})
+
+    if byte_range is None:
+        headers["Content-Length"] = str(archive.size)
+        return StreamingResponse(archive.stream(), media_type="application/zip", headers=headers)
+    start, end = byte_range
+    headers["Content-Length"] = str(end - start + 1)
+    headers["Content-Range"] = f"bytes {start}-{end}/{archive.size}"
+    return StreamingResponse(archive.stream(start, end), status_code=206, media_type="application/zip", headers=headers)
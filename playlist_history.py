@@ -0,0 +1,140 @@
+import asyncio
+import bisect
+import os
+import time
+from typing import Dict, List, Optional
+
+import aiofiles
+import orjson as json
+
+from logger import get_logger
+
+log = get_logger("playlist_history")
+
+DATA_DIR = "data"
+HISTORY_DIR = os.path.join(DATA_DIR, "playlist_history")
+
+# 确保数据目录在启动时存在
+os.makedirs(HISTORY_DIR, exist_ok=True)
+
+# 每个歌单一个只追加的 JSON Lines 文件，每行一条变更记录：
+# {"ts": 1700000000, "added": ["mid1"], "removed": ["mid2"], "task_ids": ["mid1"]}
+
+class PlaylistHistory:
+    """监控歌单的变更日志
+
+    每个歌单的变更按时间顺序追加写入文件；内存中为每个歌单维护
+    (时间戳, 文件偏移) 索引，按时间范围查询时二分定位后直接读取对应行。
+    """
+    def __init__(self):
+        # playlist_id -> ([时间戳...], [文件偏移...])
+        self._index: Dict[str, tuple] = {}
+        self._lock = asyncio.Lock()
+
+    def _path(self, playlist_id: str) -> str:
+        return os.path.join(HISTORY_DIR, f"{playlist_id}.jsonl")
+
+    async def _ensure_index(self, playlist_id: str) -> tuple:
+        """首次访问某个歌单时扫描一遍日志文件建立索引"""
+        index = self._index.get(playlist_id)
+        if index is not None:
+            return index
+
+        timestamps, offsets = [], []
+        path = self._path(playlist_id)
+        if os.path.exists(path):
+            offset = 0
+            async with aiofiles.open(path, "rb") as f:
+                async for line in f:
+                    try:
+                        timestamps.append(json.loads(line)["ts"])
+                        offsets.append(offset)
+                    except (json.JSONDecodeError, KeyError):
+                        log.warning("歌单 %s 的变更日志中存在无法解析的行，已跳过。", playlist_id)
+                    offset += len(line)
+        index = (timestamps, offsets)
+        self._index[playlist_id] = index
+        return index
+
+    async def record(self, playlist_id: str, added: List[str], removed: List[str], task_ids: List[str]):
+        """追加一条歌单变更记录"""
+        if not added and not removed:
+            return
+        entry = {
+            "ts": int(time.time()),
+            "added": added,
+            "removed": removed,
+            "task_ids": task_ids,
+        }
+        async with self._lock:
+            timestamps, offsets = await self._ensure_index(playlist_id)
+            path = self._path(playlist_id)
+            try:
+                offset = os.path.getsize(path) if os.path.exists(path) else 0
+                async with aiofiles.open(path, "ab") as f:
+                    await f.write(json.dumps(entry) + b"\n")
+                timestamps.append(entry["ts"])
+                offsets.append(offset)
+            except IOError as e:
+                log.error("无法写入歌单 %s 的变更日志: %s", playlist_id, e)
+
+    async def _read_entries(self, playlist_id: str, offsets: List[int]) -> List[Dict]:
+        entries = []
+        async with aiofiles.open(self._path(playlist_id), "rb") as f:
+            for offset in offsets:
+                await f.seek(offset)
+                entry = json.loads(await f.readline())
+                entry["playlist_id"] = playlist_id
+                entries.append(entry)
+        return entries
+
+    async def query(
+        self,
+        playlist_id: str,
+        since: Optional[int] = None,
+        until: Optional[int] = None,
+        cursor: Optional[int] = None,
+        limit: int = 50,
+    ) -> Dict:
+        """按时间范围分页查询某个歌单的变更记录，结果按时间倒序
+
+        Args:
+            playlist_id: 歌单 ID
+            since: 起始时间戳（含）
+            until: 结束时间戳（不含）
+            cursor: 上一页返回的 next_cursor
+            limit: 每页条数
+
+        Returns:
+            Dict: {"entries": [...], "next_cursor": int 或 None}
+        """
+        async with self._lock:
+            timestamps, offsets = await self._ensure_index(playlist_id)
+            lo = bisect.bisect_left(timestamps, since) if since is not None else 0
+            hi = bisect.bisect_left(timestamps, until) if until is not None else len(timestamps)
+            if cursor is not None:
+                hi = min(hi, cursor)
+            start = max(lo, hi - limit)
+            page_offsets = offsets[start:hi]
+            entries = await self._read_entries(playlist_id, page_offsets) if page_offsets else []
+
+        entries.reverse()
+        return {"entries": entries, "next_cursor": start if start > lo else None}
+
+    async def query_all(
+        self,
+        playlist_ids: List[str],
+        since: Optional[int] = None,
+        until: Optional[int] = None,
+        limit: int = 200,
+    ) -> List[Dict]:
+        """查询多个歌单在时间范围内的变更记录，合并后按时间倒序返回"""
+        entries = []
+        for playlist_id in playlist_ids:
+            result = await self.query(playlist_id, since=since, until=until, limit=limit)
+            entries.extend(result["entries"])
+        entries.sort(key=lambda entry: entry["ts"], reverse=True)
+        return entries[:limit]
+
+# 全局歌单变更日志实例
+playlist_history = PlaylistHistory()
@@ -3,7 +3,9 @@ import os
 import random
 import sys
 import json
-from typing import Optional
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
 import httpx
 
 from qqmusic_api import login, user, song, songlist
@@ -13,11 +15,21 @@ from qqmusic_api.utils.credential import Credential
 from qqmusic_api.utils.qimei import get_qimei
 from qqmusic_api.utils.session import Session, set_session
 from utils import load_credentials, save_credentials, check_login_status as check_credential_status, CREDENTIALS_FILE_PATH
+from shared_state import download_tasks
+from config import config
+from logger import get_logger
+
+log = get_logger("qq_music")
 
 # --- 全局状态和会话 ---
 login_qr: Optional[QR] = None
 auth_completed = asyncio.Event()
 
+# 下载链接解析闸门：刷新凭证并切换会话期间暂时关闭，避免使用半更新的会话
+resolver_open = asyncio.Event()
+resolver_open.set()
+_refresh_lock = asyncio.Lock()
+
 # 创建一个全局的、可复用的 Session 实例
 # 我们将在应用启动时初始化它，在关闭时销毁它
 global_session: Optional[Session] = None
@@ -52,12 +64,12 @@ def initialize_qqmusic_session(cred: Optional[Credential] = None):
     if credential and hasattr(credential, 'qimei') and credential.qimei:
         # 如果存在，则使用持久化的 qimei
         global_session.qimei = credential.qimei
-        print(f"已设置 API 版本 {new_version} 并应用持久化的 qimei: {credential.qimei}")
+        log.info("已设置 API 版本 %s 并应用持久化的 qimei: %s", new_version, credential.qimei)
     else:
         # 如果不存在（例如首次运行或新的登录），则生成一个新的 qimei
         new_qimei = get_qimei(new_version)["q36"]
         global_session.qimei = new_qimei
-        print(f"已设置 API 版本 {new_version} 并生成新的 qimei: {new_qimei}")
+        log.info("已设置 API 版本 %s 并生成新的 qimei: %s", new_version, new_qimei)
         # 将新生成的 qimei 附加到凭证对象上，以便可以保存
         if credential:
             credential.qimei = new_qimei
@@ -97,20 +109,21 @@ async def initialize_from_cookie():
         cred = get_credential()
         initialize_qqmusic_session(cred)  # 使用加载的凭证初始化
         if cred:
-            print("已从文件加载凭证，正在验证有效性...")
+            log.info("已从文件加载凭证，正在验证有效性...")
             is_valid, message = await check_credential_status(cred)
             if is_valid:
-                print(message)
+                log.info(message)
                 try:
-                    print("凭证有效，尝试刷新 Cookie 以确保会话最新...")
+                    log.info("凭证有效，尝试刷新 Cookie 以确保会话最新...")
                     await login.refresh_cookies(cred)
+                    cred.last_refreshed_at = int(time.time())
                     # The new qimei has already been attached to cred and will be saved here.
                     save_credentials(cred)
                     # Re-initializing the session here is not only unnecessary but also creates
                     # an inconsistent qimei state. The existing global_session is fine.
-                    print("Cookie 刷新成功。")
+                    log.info("Cookie 刷新成功。")
                 except Exception as e:
-                    print(f"刷新 Cookie 失败: {e}。将继续使用现有凭证，但这可能导致认证问题。")
+                    log.warning("刷新 Cookie 失败: %s。将继续使用现有凭证，但这可能导致认证问题。", e)
 
                 if not cred.encrypt_uin:
                     try:
@@ -119,22 +132,101 @@ async def initialize_from_cookie():
                         # Session does not need to be re-initialized here either. The cred object
                         # is shared with the existing session.
                     except Exception as e:
-                        print(f"从 cookie 初始化时获取 euin 失败: {e}")
+                        log.error("从 cookie 初始化时获取 euin 失败: %s", e)
                         if os.path.exists(CREDENTIALS_FILE_PATH):
                             os.remove(CREDENTIALS_FILE_PATH)
                         initialize_qqmusic_session()
             else:
-                print(message)
+                log.warning(message)
                 if os.path.exists(CREDENTIALS_FILE_PATH):
                     os.remove(CREDENTIALS_FILE_PATH)
                 initialize_qqmusic_session()
         else:
-            print("未找到本地凭证文件。")
+            log.info("未找到本地凭证文件。")
     except Exception as e:
-        print(f"初始化凭证时发生错误: {e}")
+        log.error("初始化凭证时发生错误: %s", e)
     finally:
         auth_completed.set()
 
+# --- 后台凭证刷新 ---
+
+def _credential_seconds_left(cred: Credential) -> Optional[int]:
+    """返回凭证距离过期的秒数，未知时返回 None"""
+    expired_at = getattr(cred, "expired_at", 0) or 0
+    if not expired_at:
+        return None
+    return int(expired_at - time.time())
+
+def _is_download_idle() -> bool:
+    """当前没有排队或下载中的任务时视为空闲"""
+    return not any(
+        task.get("status") in ("queued", "downloading")
+        for task in download_tasks.values()
+    )
+
+async def refresh_credential(cred: Credential) -> bool:
+    """原地刷新凭证的 Cookie
+
+    qqmusic_api 的 set_session 只作用于当前 contextvars 上下文，在后台任务中切换会话，
+    下载工作者、监控和请求处理器仍会使用各自上下文中的旧会话。因此这里不创建也不关闭会话，
+    而是把刷新结果写回全局会话共享的 Credential 对象并保存到文件；会话只在应用关闭时关闭。
+    刷新期间关闭下载链接解析闸门，完成后再重新打开。
+    """
+    async with _refresh_lock:
+        resolver_open.clear()
+        try:
+            if not await login.refresh_cookies(cred):
+                log.error("后台刷新 Cookie 失败: 服务器未返回新的凭证。")
+                return False
+            cred.last_refreshed_at = int(time.time())
+            if global_session and hasattr(global_session, "qimei"):
+                cred.qimei = global_session.qimei
+            shared = global_session.credential if global_session else None
+            if shared is not None and shared is not cred and shared.musicid == cred.musicid:
+                shared.__dict__.update(cred.__dict__)
+            save_credentials(cred)
+            log.info("后台刷新 Cookie 成功。")
+            return True
+        except Exception as e:
+            log.error("后台刷新 Cookie 失败: %s", e)
+            return False
+        finally:
+            resolver_open.set()
+
+async def credential_refresh_task():
+    """后台任务：在凭证过期前、下载空闲时主动刷新 Cookie"""
+    await auth_completed.wait()
+    while True:
+        await asyncio.sleep(int(config.get("credential.check_interval_seconds", 600)))
+        try:
+            cred = get_credential()
+            if not cred or not cred.encrypt_uin:
+                continue
+
+            refresh_ahead = int(config.get("credential.refresh_ahead_seconds", 6 * 3600))
+            urgent_margin = int(config.get("credential.urgent_refresh_seconds", 1800))
+            max_age = int(config.get("credential.max_age_seconds", 24 * 3600))
+
+            seconds_left = _credential_seconds_left(cred)
+            age = time.time() - getattr(cred, "last_refreshed_at", 0)
+
+            urgent = seconds_left is not None and seconds_left <= urgent_margin
+            due = urgent or age >= max_age or (seconds_left is not None and seconds_left <= refresh_ahead)
+            if not due:
+                continue
+            # 未到紧急阈值时只在空闲期刷新，避免打断正在进行的批量下载
+            if not urgent and not _is_download_idle():
+                continue
+
+            await refresh_credential(cred)
+        except Exception as e:
+            log.error("后台凭证刷新检查出错: %s", e)
+
+def start_credential_refresh_task():
+    """在后台启动凭证刷新任务"""
+    log.info("启动后台凭证刷新任务...")
+    asyncio.create_task(credential_refresh_task())
+
 async def get_login_qrcode(login_type: str = "QQ"):
     """获取登录二维码
     
@@ -173,9 +265,9 @@ async def check_login_status():
             save_credentials(cred)
             # 使用新鲜的、包含完整内存状态的凭证对象来重新初始化会话
             initialize_qqmusic_session(cred)
-            print("登录成功，凭证已保存。")
+            log.info("登录成功，凭证已保存。")
         except Exception as e:
-            print(f"关键步骤获取 euin 失败: {e}。登录被视为无效。")
+            log.error("关键步骤获取 euin 失败: %s。登录被视为无效。", e)
             is_success = False
             if os.path.exists(CREDENTIALS_FILE_PATH):
                 os.remove(CREDENTIALS_FILE_PATH)
@@ -225,7 +317,7 @@ async def send_sms_code(phone: str, captcha_code: str = None, country_code: int
         else:
             return {"status": "error", "message": message or "验证码发送失败"}
     except Exception as e:
-        print(f"发送验证码失败: {e}")
+        log.error("发送验证码失败: %s", e)
         return {"status": "error", "message": f"发送验证码失败: {str(e)}"}
 
 async def phone_login(phone: str, auth_code: str, country_code: int = 86):
@@ -259,16 +351,16 @@ async def phone_login(phone: str, auth_code: str, country_code: int = 86):
             save_credentials(cred)
             # 使用新鲜的、包含完整内存状态的凭证对象来重新初始化会话
             initialize_qqmusic_session(cred)
-            print("手机号登录成功，凭证已保存。")
+            log.info("手机号登录成功，凭证已保存。")
             return {"status": "success", "message": "登录成功"}
         except Exception as e:
-            print(f"关键步骤获取 euin 失败: {e}。登录被视为无效。")
+            log.error("关键步骤获取 euin 失败: %s。登录被视为无效。", e)
             if os.path.exists(CREDENTIALS_FILE_PATH):
                 os.remove(CREDENTIALS_FILE_PATH)
             initialize_qqmusic_session() # 清除无效凭证
             return {"status": "error", "message": f"登录失败: {str(e)}"}
     except Exception as e:
-        print(f"手机号登录失败: {e}")
+        log.error("手机号登录失败: %s", e)
         return {"status": "error", "message": f"登录失败: {str(e)}"}
 
 async def get_user_playlists(user_id: int):
@@ -331,6 +423,60 @@ async def search_song(keyword: str, page: int = 1, num: int = 10):
     result = await search.search_by_type(keyword, search.SearchType.SONG, page=page, num=num, credential=cred)
     return result
 
+# --- 搜索结果缓存 ---
+SEARCH_CACHE_TTL_SECONDS = 300
+SEARCH_CACHE_MAX_ENTRIES = 200
+
+# (keyword, page, num) -> (缓存时间, 结果列表)，按插入顺序淘汰
+_search_cache: "OrderedDict[tuple, tuple]" = OrderedDict()
+# 正在进行中的搜索请求，相同参数的并发请求共享同一个任务
+_search_inflight: Dict[tuple, asyncio.Task] = {}
+# 当前的下一页预取任务，关键词变化时取消
+_search_prefetch: Optional[asyncio.Task] = None
+
+async def search_song_cached(keyword: str, page: int = 1, num: int = 10) -> list:
+    """带缓存的歌曲搜索，相同关键词和页码的请求在有效期内直接返回缓存结果"""
+    key = (keyword.strip().lower(), page, num)
+
+    cached = _search_cache.get(key)
+    if cached and time.time() - cached[0] < SEARCH_CACHE_TTL_SECONDS:
+        _search_cache.move_to_end(key)
+        return cached[1]
+
+    task = _search_inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(search_song(keyword, page=page, num=num))
+        _search_inflight[key] = task
+        task.add_done_callback(lambda _: _search_inflight.pop(key, None))
+
+    # shield: 某个调用方被取消时不影响共享同一任务的其他调用方
+    result = await asyncio.shield(task)
+    # 出错或接口返回异常数据时不缓存，下一次请求重新搜索
+    if not isinstance(result, list):
+        return []
+
+    _search_cache[key] = (time.time(), result)
+    _search_cache.move_to_end(key)
+    while len(_search_cache) > SEARCH_CACHE_MAX_ENTRIES:
+        _search_cache.popitem(last=False)
+    return result
+
+def prefetch_search_page(keyword: str, page: int, num: int = 10):
+    """在后台预取搜索结果的下一页；关键词变化时取消上一次的预取"""
+    global _search_prefetch
+    if _search_prefetch and not _search_prefetch.done():
+        _search_prefetch.cancel()
+
+    async def _prefetch():
+        try:
+            await search_song_cached(keyword, page=page, num=num)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            log.debug("预取搜索结果失败: %s", e)
+
+    _search_prefetch = asyncio.create_task(_prefetch())
+
 async def get_playlist_songs(playlist_id: int, no_cache: bool = False):
     """获取歌单中的歌曲，特殊处理'我喜欢'歌单"""
     cred = get_credential()
@@ -354,13 +500,48 @@ async def get_playlist_songs(playlist_id: int, no_cache: bool = False):
         )
         return songlist_detail.get("songlist", [])
 
+async def get_playlist_fingerprint(playlist_id: int) -> Optional[str]:
+    """获取歌单的轻量指纹，只请求一首歌曲
+
+    指纹由歌曲总数、歌单修改时间和第一首歌曲的 mid 组成，
+    任意一项变化都说明歌单内容可能发生了变化。
+    """
+    cred = get_credential()
+    if not cred:
+        raise ValueError("用户未登录")
+
+    if str(playlist_id) == "201":
+        get_fav_song_req = user.get_fav_song.copy()
+        get_fav_song_req.cacheable = False
+        data = await get_fav_song_req(cred.encrypt_uin, num=1, credential=cred)
+    else:
+        get_detail_req = songlist.get_detail.copy()
+        get_detail_req.cacheable = False
+        data = await get_detail_req(
+            songlist_id=playlist_id, num=1, tag=False, userinfo=False, credential=cred
+        )
+
+    if not isinstance(data, dict):
+        return None
+    dirinfo = data.get("dirinfo") or {}
+    total = data.get("total_song_num") or dirinfo.get("songnum", 0)
+    mtime = dirinfo.get("mtime", 0)
+    songs = data.get("songlist") or []
+    first_mid = songs[0].get("mid", "") if songs else ""
+    if not total and not mtime and not first_mid:
+        return None
+    return f"{total}:{mtime}:{first_mid}"
+
 async def get_song_download_url(song_mid: str):
     """按顺序获取最佳音质的歌曲下载URL"""
     cred = get_credential()
     if not cred:
-        print("用户未登录或凭证无效，无法获取下载链接。")
+        log.warning("用户未登录或凭证无效，无法获取下载链接。")
         return None
 
+    # 凭证刷新期间等待刷新完成
+    await resolver_open.wait()
+
     # The global_session should already be initialized, but this is a safeguard.
     if not global_session:
         initialize_qqmusic_session(cred)
@@ -373,7 +554,7 @@ async def get_song_download_url(song_mid: str):
 
             if url and url.startswith('http'):
                 extension, quality_name = QUALITY_MAP[quality_enum]
-                print(f"成功获取音质 {quality_name} 的链接。")
+                log.debug("成功获取音质 %s 的链接。", quality_name)
                 return {
                     "url": url,
                     "quality": quality_name,
@@ -381,8 +562,8 @@ async def get_song_download_url(song_mid: str):
                     "enum_name": quality_enum.name,
                 }
         except Exception as e:
-            print(f"尝试获取音质 {quality_enum.name} 失败: {e}")
+            log.debug("尝试获取音质 %s 失败: %s", quality_enum.name, e)
             continue
             
-    print(f"未能获取歌曲 {song_mid} 的任何下载链接。")
+    log.warning("未能获取歌曲 %s 的任何下载链接。", song_mid)
     return None
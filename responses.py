@@ -0,0 +1,156 @@
+import asyncio
+import gzip
+import hashlib
+from typing import Any, Optional
+
+import orjson as json
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import Response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from config import config
+
+try:
+    # brotli 为可选依赖，未安装时只使用 gzip
+    import brotli
+except ImportError:
+    brotli = None
+
+# 压缩级别偏向速度：大 JSON 响应的压缩率差别不大，CPU 开销差别明显
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+# 超过该大小的响应在线程池中计算哈希和压缩，避免阻塞事件循环
+OFFLOAD_MIN_SIZE = 256 * 1024
+
+COMPRESSIBLE_TYPES = ("application/json", "application/javascript", "text/")
+
+class FastJSONResponse(Response):
+    """使用 orjson 序列化的 JSON 响应
+
+    接口直接返回该响应时，FastAPI 不再用 jsonable_encoder 逐层遍历返回值。
+    """
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return json.dumps(content, option=json.OPT_NON_STR_KEYS)
+
+def _choose_encoding(accept_encoding: str) -> Optional[str]:
+    """按 Accept-Encoding 选择压缩方式，优先 br"""
+    accepted = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+    for encoding in ("br", "gzip"):
+        if encoding == "br" and brotli is None:
+            continue
+        if accepted.get(encoding, 0) > 0:
+            return encoding
+    return None
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    """If-None-Match 使用弱比较"""
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == opaque for tag in if_none_match.split(","))
+
+def _process_body(body: bytes, etag_needed: bool, encoding: Optional[str]):
+    etag = f'W/"{hashlib.blake2b(body, digest_size=16).hexdigest()}"' if etag_needed else None
+    if encoding == "br":
+        body = brotli.compress(body, quality=BROTLI_QUALITY)
+    elif encoding == "gzip":
+        body = gzip.compress(body, compresslevel=GZIP_LEVEL)
+    return etag, body
+
+class CompressionETagMiddleware:
+    """为 GET 请求的完整响应添加 ETag 并按需压缩
+
+    - 响应体一次性发送（普通 JSON 接口、小静态文件）时才处理；分块发送的响应
+      （事件流、文件下载）原样透传，不会被缓冲
+    - 没有 ETag 的响应按内容生成弱 ETag，If-None-Match 命中时返回 304
+    - JSON、文本类响应超过 http.compression_min_size 时按 Accept-Encoding 使用 br 或 gzip 压缩
+    """
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self.minimum_size = int(config.get("http.compression_min_size", 1024))
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or scope["method"] != "GET":
+            await self.app(scope, receive, send)
+            return
+
+        request_headers = Headers(scope=scope)
+        encoding = _choose_encoding(request_headers.get("accept-encoding", ""))
+        if_none_match = request_headers.get("if-none-match")
+        start_message: Optional[Message] = None
+        passthrough = False
+
+        async def wrapped_send(message: Message):
+            nonlocal start_message, passthrough
+            if message["type"] == "http.response.start":
+                start_message = message
+                return
+            if message["type"] != "http.response.body" or passthrough:
+                await send(message)
+                return
+            if message.get("more_body", False) or not self._eligible(start_message):
+                passthrough = True
+                await send(start_message)
+                await send(message)
+                return
+            await self._send_processed(start_message, message.get("body", b""), send, encoding, if_none_match)
+
+        await self.app(scope, receive, wrapped_send)
+
+    @staticmethod
+    def _eligible(start_message: Message) -> bool:
+        if start_message["status"] != 200:
+            return False
+        headers = Headers(raw=start_message["headers"])
+        return "content-encoding" not in headers
+
+    async def _send_processed(
+        self, start_message: Message, body: bytes, send: Send, encoding: Optional[str], if_none_match: Optional[str]
+    ):
+        headers = MutableHeaders(raw=list(start_message["headers"]))
+        compressible = headers.get("content-type", "").startswith(COMPRESSIBLE_TYPES)
+        if not compressible or len(body) < self.minimum_size:
+            encoding = None
+        etag_needed = "etag" not in headers
+
+        if etag_needed or encoding:
+            if len(body) >= OFFLOAD_MIN_SIZE:
+                etag, processed = await asyncio.to_thread(_process_body, body, etag_needed, encoding)
+            else:
+                etag, processed = _process_body(body, etag_needed, encoding)
+        else:
+            etag, processed = None, body
+
+        if etag:
+            headers["etag"] = etag
+            # 允许浏览器缓存，但每次使用前都要带 If-None-Match 重新验证
+            headers.setdefault("cache-control", "no-cache")
+        if compressible:
+            headers.add_vary_header("Accept-Encoding")
+
+        if if_none_match and _etag_matches(if_none_match, headers["etag"]):
+            not_modified = MutableHeaders()
+            for name in ("etag", "cache-control", "vary"):
+                if name in headers:
+                    not_modified[name] = headers[name]
+            await send({"type": "http.response.start", "status": 304, "headers": not_modified.raw})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        if encoding:
+            headers["content-encoding"] = encoding
+            headers["content-length"] = str(len(processed))
+        await send({**start_message, "headers": headers.raw})
+        await send({"type": "http.response.body", "body": processed})
@@ -4,6 +4,13 @@
 用于在应用程序的不同模块之间共享状态的中央模块。
 """
 
+import time
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+from event_bus import event_bus
+from task_index import task_index
+
 # 这个字典将保存所有下载任务的状态。
 # 键是 song_mid，值是包含任务信息的字典。
 # 例如：
@@ -15,7 +22,57 @@
 #         "progress": 50,
 #         "error": None,
 #         "file_path": "/path/to/song.mp3",
-#         "url": "/downloads/song.mp3"
+#         "url": "/downloads/song.mp3",
+#         "created_at": 1700000000
 #     }
 # }
 download_tasks = {}
+
+class TaskChangeLog:
+    """下载任务的变更日志
+
+    每次修改 download_tasks 后调用 mark()，全局版本号单调递增；
+    客户端携带上次拿到的版本号作为游标，只获取此后变化过的任务，轮询开销与活跃度成正比而非与历史任务数成正比。
+    """
+    def __init__(self, max_entries: int = 50000):
+        # 服务重启后版本号从 0 开始，客户端发现 epoch 变化时需要全量同步
+        self.epoch = int(time.time() * 1000)
+        self.version = 0
+        # 按版本顺序排列的 mid -> (最近一次变更的版本, 是否已删除)
+        self._changes: "OrderedDict[str, Tuple[int, bool]]" = OrderedDict()
+        self._max_entries = max_entries
+        # 早于该版本的变更已被裁剪，游标小于它的客户端只能全量同步
+        self._floor = 0
+
+    def mark(self, mid: str, removed: bool = False):
+        self.version += 1
+        self._changes.pop(mid, None)
+        self._changes[mid] = (self.version, removed)
+        while len(self._changes) > self._max_entries:
+            _, (version, _) = self._changes.popitem(last=False)
+            self._floor = version
+
+    def changes_since(self, cursor: int) -> Optional[Tuple[List[str], List[str]]]:
+        """返回游标之后变化的 (mid 列表, 已删除的 mid 列表)；无法增量同步时返回 None"""
+        if cursor < self._floor or cursor > self.version:
+            return None
+        changed, removed = [], []
+        for mid, (version, is_removed) in reversed(self._changes.items()):
+            if version <= cursor:
+                break
+            (removed if is_removed else changed).append(mid)
+        return changed, removed
+
+task_changes = TaskChangeLog()
+
+def mark_task_changed(mid: str):
+    """修改某个下载任务后调用，同时更新任务索引并通过事件总线通知订阅者"""
+    task_changes.mark(mid)
+    task_index.update(mid, download_tasks.get(mid))
+    event_bus.publish("task", task_changes.version)
+
+def mark_task_removed(mid: str):
+    """删除某个下载任务后调用"""
+    task_changes.mark(mid, removed=True)
+    task_index.update(mid, None)
+    event_bus.publish("task", task_changes.version)
@@ -0,0 +1,137 @@
+import asyncio
+import os
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+import aiofiles
+import orjson as json
+
+from logger import get_logger
+
+log = get_logger("song_catalog")
+
+DATA_DIR = "data"
+CATALOG_FILE = os.path.join(DATA_DIR, "song_catalog.json")
+
+# 确保数据目录在启动时存在
+os.makedirs(DATA_DIR, exist_ok=True)
+
+# {
+#     "song_mid": {
+#         "name": "歌曲名",
+#         "singers": ["歌手1", "歌手2"],
+#         "album": "专辑名",
+#         "album_mid": "专辑 mid",
+#         "file_sizes": {"size_flac": 31457280, "size_320mp3": 10485760},
+#         "updated_at": 1700000000
+#     }
+# }
+
+def format_song_name(name: str, singers: List[str]) -> str:
+    """生成统一的歌曲显示名称，下载文件名和本地匹配都基于此格式"""
+    return f"{name} - {', '.join(singers)}"
+
+class SongCatalog:
+    """本地歌曲元数据目录
+
+    汇总每次 API 响应中的歌曲元数据（歌单浏览、搜索、监控检查），
+    供下载、文件命名和本地匹配复用，避免重复请求并保持命名一致。
+    """
+    def __init__(self):
+        self._songs: Dict[str, Dict[str, Any]] = {}
+        self._loaded = False
+        self._dirty = False
+        # 任一条目内容变化时递增，本地匹配结果依赖目录中的名称，相关缓存据此判断是否失效
+        self.version = 0
+        self._save_interval = 60  # 脏数据落盘间隔（秒）
+        self._background_task = None
+
+    def load(self):
+        """从磁盘加载目录；已加载时直接返回"""
+        if self._loaded:
+            return
+        self._loaded = True
+        if not os.path.exists(CATALOG_FILE):
+            return
+        try:
+            with open(CATALOG_FILE, "rb") as f:
+                content = f.read()
+            if content.strip():
+                self._songs = json.loads(content)
+            log.info("已加载歌曲元数据目录，共 %s 首歌曲。", len(self._songs))
+        except (json.JSONDecodeError, IOError) as e:
+            log.error("加载歌曲元数据目录失败: %s", e)
+
+    def upsert(self, song: Dict[str, Any]):
+        """写入或更新一首歌曲的元数据"""
+        mid = song.get("mid")
+        if not mid:
+            return
+        self.load()
+        album = song.get("album") or {}
+        file_info = song.get("file") or {}
+        entry = {
+            "name": song.get("name", ""),
+            "singers": [s.get("name", "") for s in song.get("singer", [])],
+            "album": album.get("name", ""),
+            "album_mid": album.get("mid", ""),
+            "file_sizes": {
+                key: value for key, value in file_info.items()
+                if key.startswith("size_") and isinstance(value, int) and value > 0
+            },
+        }
+        existing = self._songs.get(mid)
+        if existing:
+            # 没有文件信息的响应（例如部分搜索结果）不覆盖已有的文件大小
+            if not entry["file_sizes"]:
+                entry["file_sizes"] = existing.get("file_sizes", {})
+            if all(existing.get(key) == value for key, value in entry.items()):
+                return
+        entry["updated_at"] = int(time.time())
+        self._songs[mid] = entry
+        self._dirty = True
+        self.version += 1
+
+    def upsert_many(self, songs: Iterable[Dict[str, Any]]):
+        for song in songs:
+            self.upsert(song)
+
+    def get(self, mid: str) -> Optional[Dict[str, Any]]:
+        self.load()
+        return self._songs.get(mid)
+
+    def song_name(self, mid: str, default: str = "") -> str:
+        """返回目录中记录的统一歌曲名称，未收录时返回 default"""
+        entry = self.get(mid)
+        if not entry or not entry.get("name"):
+            return default
+        return format_song_name(entry["name"], entry["singers"])
+
+    async def save(self):
+        """将目录写入磁盘（仅在有变化时）"""
+        if not self._dirty:
+            return
+        self._dirty = False
+        try:
+            json_data = json.dumps(self._songs)
+            tmp_path = CATALOG_FILE + ".tmp"
+            async with aiofiles.open(tmp_path, "wb") as f:
+                await f.write(json_data)
+            os.replace(tmp_path, CATALOG_FILE)
+        except IOError as e:
+            self._dirty = True
+            log.error("保存歌曲元数据目录失败: %s", e)
+
+    async def _periodic_save(self):
+        while True:
+            await asyncio.sleep(self._save_interval)
+            await self.save()
+
+    def start_background_save(self):
+        """启动后台定期落盘任务"""
+        self.load()
+        if not self._background_task:
+            self._background_task = asyncio.create_task(self._periodic_save())
+
+# 创建全局歌曲元数据目录实例
+song_catalog = SongCatalog()
@@ -20,13 +20,21 @@ document.addEventListener('DOMContentLoaded', () => {
 
     let loginCheckInterval;
     let currentTasks = {}; // 全局变量，存储最新的任务状态
+    let taskCursor = { epoch: null, version: 0 }; // 增量状态游标，服务重启后 epoch 会变化
+    // 已完成列表按页从 /api/download/tasks 加载，历史任务很多时也只渲染已加载的部分
+    const COMPLETED_PAGE_SIZE = 100;
+    let completedState = { tasks: [], nextCursor: null, total: 0 };
     let apiCooldownInterval; // 用于API冷却倒计时的计时器
 
     // --- Initial Setup ---
     checkInitialAuth();
-    // Restore polling for all tasks
-    setInterval(updateDownloadStatus, 2000);
-    updateDownloadStatus(); // Initial call
+    // 通过服务器推送接收任务变化；不支持 EventSource 的浏览器退回轮询
+    if (window.EventSource) {
+        subscribeTaskEvents();
+    } else {
+        setInterval(updateDownloadStatus, 2000);
+        updateDownloadStatus(); // Initial call
+    }
     
     // 配置页面初始化
     setupConfigPage();
@@ -365,6 +373,7 @@ document.addEventListener('DOMContentLoaded', () => {
         allSongs = [];
         loadedSongsCount = 0;
         songListContainer.onscroll = null;
+        if (searchAbortController) searchAbortController.abort();
         try {
             const response = await fetch(`/api/playlist/${playlistId}`);
             const songs = await response.json();
@@ -382,6 +391,9 @@ document.addEventListener('DOMContentLoaded', () => {
                     <button class="btn btn-success" id="download-all-btn" data-playlist-id="${playlistId}">
                         <i class="bi bi-download"></i> 全部下载 (${allSongs.length}首)
                     </button>
+                    <a class="btn btn-outline-secondary" href="/api/export/playlist/${playlistId}" download>
+                        <i class="bi bi-file-earmark-zip"></i> 导出已下载的歌曲 (ZIP)
+                    </a>
                 </div>
                 <ul class="list-group"></ul>
             `;
@@ -465,6 +477,70 @@ document.addEventListener('DOMContentLoaded', () => {
         });
     }
 
+    // --- Song Search ---
+    const songSearchInput = document.getElementById('song-search-input');
+    let searchDebounceTimer;
+    let searchAbortController = null;
+    let searchKeyword = '';
+    let searchPage = 1;
+    const searchPageSize = 20;
+
+    songSearchInput.addEventListener('input', () => {
+        clearTimeout(searchDebounceTimer);
+        searchDebounceTimer = setTimeout(() => searchSongs(songSearchInput.value.trim(), 1), 300);
+    });
+
+    async function searchSongs(keyword, page) {
+        // 用户继续输入时，取消上一次尚未完成的搜索请求
+        if (searchAbortController) searchAbortController.abort();
+        if (!keyword) return;
+        searchAbortController = new AbortController();
+        searchKeyword = keyword;
+        searchPage = page;
+
+        if (page === 1) {
+            songListContainer.innerHTML = '<div class="text-center"><div class="spinner-border" role="status"><span class="visually-hidden">Loading...</span></div></div>';
+            songListContainer.onscroll = null;
+        }
+        try {
+            const response = await fetch(
+                `/api/search?keyword=${encodeURIComponent(keyword)}&page=${page}&num=${searchPageSize}`,
+                { signal: searchAbortController.signal }
+            );
+            const data = await response.json();
+            if (!response.ok || data.error) {
+                const reason = data.error || (typeof data.detail === 'string' ? data.detail : response.statusText);
+                songListContainer.innerHTML = `<p class="text-danger">搜索失败: ${reason}</p>`;
+                return;
+            }
+            if (page === 1) {
+                if (data.songs.length === 0) {
+                    songListContainer.innerHTML = '<p>没有找到相关歌曲。</p>';
+                    return;
+                }
+                allSongs = [];
+                loadedSongsCount = 0;
+                songListContainer.innerHTML = '<ul class="list-group"></ul>';
+            }
+            allSongs = allSongs.concat(data.songs);
+            loadMoreSongs();
+
+            const oldMoreBtn = document.getElementById('search-more-btn');
+            if (oldMoreBtn) oldMoreBtn.remove();
+            if (data.has_more) {
+                songListContainer.insertAdjacentHTML('beforeend',
+                    '<div class="d-grid mt-2"><button class="btn btn-outline-secondary btn-sm" id="search-more-btn">加载更多</button></div>');
+                document.getElementById('search-more-btn').addEventListener('click', () => {
+                    searchSongs(searchKeyword, searchPage + 1);
+                });
+            }
+        } catch (error) {
+            if (error.name === 'AbortError') return;
+            console.error('搜索歌曲失败:', error);
+            songListContainer.innerHTML = '<p class="text-danger">搜索歌曲时发生错误。</p>';
+        }
+    }
+
     async function startDownload(songMid, songName) {
         // ... (This function remains the same as before)
         try {
@@ -476,117 +552,214 @@ document.addEventListener('DOMContentLoaded', () => {
 
     // --- MODIFIED Download Status Logic ---
 
+    function subscribeTaskEvents() {
+        const params = new URLSearchParams({ since: taskCursor.version });
+        if (taskCursor.epoch !== null) params.set('epoch', taskCursor.epoch);
+        const source = new EventSource(`/api/download/events?${params}`);
+        source.addEventListener('tasks', event => {
+            try {
+                applyTaskDelta(JSON.parse(event.data));
+            } catch (error) {
+                console.error("Error updating download status:", error);
+            }
+        });
+        // 连接断开后 EventSource 会自动重连，并通过 Last-Event-ID 从断开处继续
+    }
+
     async function updateDownloadStatus() {
-        const selectedOngoingMids = new Set(
-            Array.from(document.querySelectorAll('.ongoing-task-checkbox:checked')).map(cb => cb.value)
-        );
+        try {
+            const params = new URLSearchParams({ since: taskCursor.version });
+            if (taskCursor.epoch !== null) params.set('epoch', taskCursor.epoch);
+            const response = await fetch(`/api/download/status/delta?${params}`);
+            applyTaskDelta(await response.json());
+        } catch (error) {
+            console.error("Error updating download status:", error);
+        }
+    }
+
+    function applyTaskDelta(data) {
+        updateApiCooldownTimer(data.api_cooldown_until, data.server_time);
+
+        const changed = data.tasks || {};
+        const removed = data.removed || [];
+        // 只有已完成任务发生变化时才重新加载已完成列表
+        const loadedCompleted = new Set(completedState.tasks.map(task => task.mid));
+        const completedChanged = data.full
+            || Object.entries(changed).some(([mid, task]) => task.status === 'completed' || loadedCompleted.has(mid))
+            || removed.some(mid => loadedCompleted.has(mid));
+        if (data.full) {
+            currentTasks = changed; // 全量返回时替换全局任务状态
+        } else {
+            // 推送和主动刷新可能乱序到达，已经应用过更新版本时忽略旧的增量
+            if (data.epoch === taskCursor.epoch && data.version <= taskCursor.version) {
+                return;
+            }
+            if (Object.keys(changed).length === 0 && removed.length === 0) {
+                taskCursor = { epoch: data.epoch, version: data.version };
+                return; // 没有任何变化，无需重新渲染
+            }
+            Object.assign(currentTasks, changed);
+            removed.forEach(mid => delete currentTasks[mid]);
+        }
+        taskCursor = { epoch: data.epoch, version: data.version };
+        renderDownloadTasks();
+        if (completedChanged) {
+            refreshCompletedTasks();
+        }
+    }
+
+    async function fetchTaskPage(cursor) {
+        const params = new URLSearchParams({ status: 'completed', sort: 'time', limit: COMPLETED_PAGE_SIZE });
+        if (cursor) params.set('cursor', cursor);
+        const response = await fetch(`/api/download/tasks?${params}`);
+        return response.json();
+    }
+
+    async function refreshCompletedTasks() {
+        // 从第一页重新加载，保持用户已经展开的数量
+        const wanted = Math.max(completedState.tasks.length, COMPLETED_PAGE_SIZE);
+        try {
+            let tasks = [];
+            let data;
+            let cursor = null;
+            do {
+                data = await fetchTaskPage(cursor);
+                tasks = tasks.concat(data.tasks);
+                cursor = data.next_cursor;
+            } while (cursor && tasks.length < wanted);
+            completedState = { tasks, nextCursor: cursor, total: data.total };
+            renderCompletedTasks();
+        } catch (error) {
+            console.error("Error loading completed tasks:", error);
+        }
+    }
+
+    async function loadMoreCompletedTasks() {
+        if (!completedState.nextCursor) return;
+        try {
+            const data = await fetchTaskPage(completedState.nextCursor);
+            completedState = {
+                tasks: completedState.tasks.concat(data.tasks),
+                nextCursor: data.next_cursor,
+                total: data.total,
+            };
+            renderCompletedTasks();
+        } catch (error) {
+            console.error("Error loading completed tasks:", error);
+        }
+    }
+
+    function renderCompletedTasks() {
         const selectedCompletedMids = new Set(
             Array.from(document.querySelectorAll('.completed-task-checkbox:checked')).map(cb => cb.value)
         );
 
-        try {
-            const response = await fetch('/api/download/status');
-            const data = await response.json();
-            currentTasks = data.tasks || {}; // 更新全局任务状态
-            const tasks = currentTasks;
-            const ongoingTasks = [];
-            const completedTasks = [];
+        document.getElementById('completed-count').textContent = completedState.total;
 
-            updateApiCooldownTimer(data.api_cooldown_until, data.server_time);
-
-            for (const mid in tasks) {
-                const taskWithMid = { ...tasks[mid], mid };
-                if (tasks[mid].status === 'completed') {
-                    completedTasks.push(taskWithMid);
-                } else {
-                    ongoingTasks.push(taskWithMid);
-                }
+        if (completedState.tasks.length === 0) {
+            completedDownloadsList.innerHTML = '<li class="list-group-item">暂无已完成的任务</li>';
+            selectAllCompletedContainer.style.display = 'none';
+            completedActions.style.display = 'none';
+        } else {
+            let html = completedState.tasks.map(task => createTaskItemHtml(task)).join('');
+            if (completedState.nextCursor) {
+                const remaining = completedState.total - completedState.tasks.length;
+                html += `
+                    <li class="list-group-item text-center">
+                        <button class="btn btn-link btn-sm" id="load-more-completed-btn">加载更多 (剩余 ${remaining})</button>
+                    </li>`;
             }
+            completedDownloadsList.innerHTML = html;
+            selectAllCompletedContainer.style.display = 'flex';
+            const loadMoreBtn = document.getElementById('load-more-completed-btn');
+            if (loadMoreBtn) loadMoreBtn.addEventListener('click', loadMoreCompletedTasks);
+        }
 
-            // Sort ongoing tasks: downloading > queued > others, then by original order (newest first)
-            const statusPriority = { 'downloading': 1, 'queued': 2 };
-            ongoingTasks.sort((a, b) => {
-                const priorityA = statusPriority[a.status] || 3;
-                const priorityB = statusPriority[b.status] || 3;
-                if (priorityA !== priorityB) {
-                    return priorityA - priorityB;
-                }
-                // If priorities are the same, newest (later in original array) comes first
-                // We need original indices, but since we don't have them, we can assume
-                // the server sends them in a somewhat consistent order. Reversing the original
-                // list before processing is a good proxy for "newest first".
-                // Let's stick to reversing the completed list for now as that's less critical.
-                return 0; // Keep original relative order for same-status tasks for now
-            });
+        selectedCompletedMids.forEach(mid => {
+            const checkbox = document.querySelector(`.completed-task-checkbox[value="${mid}"]`);
+            if (checkbox) checkbox.checked = true;
+        });
 
-            completedTasks.reverse();
+        updateSelectionState();
+    }
 
-            // Update counts
-            document.getElementById('ongoing-count').textContent = ongoingTasks.length;
-            document.getElementById('completed-count').textContent = completedTasks.length;
+    function renderDownloadTasks() {
+        const selectedOngoingMids = new Set(
+            Array.from(document.querySelectorAll('.ongoing-task-checkbox:checked')).map(cb => cb.value)
+        );
 
-            // Update ongoing list UI
-            if (ongoingTasks.length === 0) {
-                ongoingDownloadsList.innerHTML = '<li class="list-group-item">暂无进行中的任务</li>';
-                selectAllOngoingContainer.style.display = 'none';
-                ongoingActions.style.display = 'none';
-            } else {
-                ongoingDownloadsList.innerHTML = ongoingTasks.map(task => createTaskItemHtml(task)).join('');
-                selectAllOngoingContainer.style.display = 'flex';
-            }
+        const tasks = currentTasks;
+        const ongoingTasks = [];
 
-            // Add "Retry All Failed" button if there are any failed tasks
-            const failedTasksCount = ongoingTasks.filter(t => t.status === 'failed').length;
-            const retryAllBtnContainer = document.getElementById('retry-all-container'); // Assuming a container exists
-            if (retryAllBtnContainer) {
-                if (failedTasksCount > 0) {
-                    retryAllBtnContainer.innerHTML = `
-                        <button class="btn btn-warning btn-sm" id="retry-all-failed-btn">
-                            <i class="bi bi-arrow-clockwise"></i> 重试所有失败 (${failedTasksCount})
-                        </button>`;
-                    document.getElementById('retry-all-failed-btn').addEventListener('click', retryAllFailed);
-                } else {
-                    retryAllBtnContainer.innerHTML = '';
-                }
+        for (const mid in tasks) {
+            if (tasks[mid].status !== 'completed') {
+                ongoingTasks.push({ ...tasks[mid], mid });
             }
+        }
 
-            // Update completed list UI
-            if (completedTasks.length === 0) {
-                completedDownloadsList.innerHTML = '<li class="list-group-item">暂无已完成的任务</li>';
-                selectAllCompletedContainer.style.display = 'none';
-                completedActions.style.display = 'none';
-            } else {
-                completedDownloadsList.innerHTML = completedTasks.map(task => createTaskItemHtml(task)).join('');
-                selectAllCompletedContainer.style.display = 'flex';
+        // Sort ongoing tasks: downloading > queued > others, then by original order (newest first)
+        const statusPriority = { 'downloading': 1, 'queued': 2 };
+        ongoingTasks.sort((a, b) => {
+            const priorityA = statusPriority[a.status] || 3;
+            const priorityB = statusPriority[b.status] || 3;
+            if (priorityA !== priorityB) {
+                return priorityA - priorityB;
             }
+            // If priorities are the same, newest (later in original array) comes first
+            // We need original indices, but since we don't have them, we can assume
+            // the server sends them in a somewhat consistent order. Reversing the original
+            // list before processing is a good proxy for "newest first".
+            // Let's stick to reversing the completed list for now as that's less critical.
+            return 0; // Keep original relative order for same-status tasks for now
+        });
 
-            // Restore selection states
-            selectedOngoingMids.forEach(mid => {
-                const checkbox = document.querySelector(`.ongoing-task-checkbox[value="${mid}"]`);
-                if (checkbox) checkbox.checked = true;
-            });
-            selectedCompletedMids.forEach(mid => {
-                const checkbox = document.querySelector(`.completed-task-checkbox[value="${mid}"]`);
-                if (checkbox) checkbox.checked = true;
-            });
-            
-            updateSelectionState();
+        // Update counts
+        document.getElementById('ongoing-count').textContent = ongoingTasks.length;
 
-            // --- NEW: Update song list buttons based on task status ---
-            document.querySelectorAll('.song-item').forEach(item => {
-                const mid = item.dataset.songMid;
-                const button = item.querySelector('.download-btn');
-                if (button) {
-                    // 查找对应的歌曲信息，获取local_info
-                    const song = allSongs.find(s => s.mid === mid);
-                    const localInfo = song ? song.local_info : null;
-                    updateSongButtonState(button, tasks[mid], localInfo);
-                }
-            });
+        // Update ongoing list UI
+        if (ongoingTasks.length === 0) {
+            ongoingDownloadsList.innerHTML = '<li class="list-group-item">暂无进行中的任务</li>';
+            selectAllOngoingContainer.style.display = 'none';
+            ongoingActions.style.display = 'none';
+        } else {
+            ongoingDownloadsList.innerHTML = ongoingTasks.map(task => createTaskItemHtml(task)).join('');
+            selectAllOngoingContainer.style.display = 'flex';
+        }
 
-        } catch (error) {
-            console.error("Error updating download status:", error);
+        // Add "Retry All Failed" button if there are any failed tasks
+        const failedTasksCount = ongoingTasks.filter(t => t.status === 'failed').length;
+        const retryAllBtnContainer = document.getElementById('retry-all-container'); // Assuming a container exists
+        if (retryAllBtnContainer) {
+            if (failedTasksCount > 0) {
+                retryAllBtnContainer.innerHTML = `
+                    <button class="btn btn-warning btn-sm" id="retry-all-failed-btn">
+                        <i class="bi bi-arrow-clockwise"></i> 重试所有失败 (${failedTasksCount})
+                    </button>`;
+                document.getElementById('retry-all-failed-btn').addEventListener('click', retryAllFailed);
+            } else {
+                retryAllBtnContainer.innerHTML = '';
+            }
         }
+
+        // Restore selection states
+        selectedOngoingMids.forEach(mid => {
+            const checkbox = document.querySelector(`.ongoing-task-checkbox[value="${mid}"]`);
+            if (checkbox) checkbox.checked = true;
+        });
+        
+        updateSelectionState();
+
+        // --- NEW: Update song list buttons based on task status ---
+        document.querySelectorAll('.song-item').forEach(item => {
+            const mid = item.dataset.songMid;
+            const button = item.querySelector('.download-btn');
+            if (button) {
+                // 查找对应的歌曲信息，获取local_info
+                const song = allSongs.find(s => s.mid === mid);
+                const localInfo = song ? song.local_info : null;
+                updateSongButtonState(button, tasks[mid], localInfo);
+            }
+        });
     }
 
     function formatFileSize(bytes) {
@@ -793,6 +966,17 @@ document.addEventListener('DOMContentLoaded', () => {
         updateSelectionState();
     });
 
+    document.getElementById('export-selected-btn').addEventListener('click', (e) => {
+        e.preventDefault();
+        const selectedMids = Array.from(document.querySelectorAll('.completed-task-checkbox:checked')).map(cb => cb.value);
+        if (selectedMids.length === 0) {
+            alert('请至少选择一个任务。');
+            return;
+        }
+        // 浏览器直接下载流式生成的 ZIP，支持断点续传
+        window.location.href = `/api/export/tasks?mids=${encodeURIComponent(selectedMids.join(','))}`;
+    });
+
     selectAllCompletedCheckbox.addEventListener('change', (e) => {
         document.querySelectorAll('.completed-task-checkbox').forEach(checkbox => {
             checkbox.checked = e.target.checked;
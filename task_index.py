@@ -0,0 +1,190 @@
+import bisect
+import heapq
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+# 按优先级排序时各状态的顺序，未列出的状态（completed、cancelled 等）排在最后
+STATUS_PRIORITY = {"downloading": 0, "queued": 1, "waiting_for_retry": 2, "failed": 3}
+DEFAULT_PRIORITY = len(STATUS_PRIORITY)
+
+# 排序键 (创建时间, 序号)：旧任务没有 created_at 时为 0，按加载顺序的序号区分先后
+SortKey = Tuple[int, int]
+
+def _name_grams(text: str) -> Set[str]:
+    """歌名的单字和相邻双字，用于子串搜索的倒排索引"""
+    return set(text) | {text[i:i + 2] for i in range(len(text) - 1)}
+
+def _query_grams(text: str) -> Set[str]:
+    if len(text) == 1:
+        return {text}
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+def _page_order(item: Tuple[int, SortKey, str]) -> Tuple[int, int, int]:
+    """列表顺序：优先级升序，同优先级内新创建的在前"""
+    priority, key, _ = item
+    return priority, -key[0], -key[1]
+
+def _iter_descending(bucket: List[Tuple[SortKey, str]], end: int) -> Iterator[Tuple[SortKey, str]]:
+    for i in range(end - 1, -1, -1):
+        yield bucket[i]
+
+class TaskIndex:
+    """下载任务的二级索引，用于分页、筛选和搜索任务列表
+
+    - 每个状态一个按 (创建时间, 序号) 有序的列表，按状态筛选和游标翻页只需二分查找
+    - 歌名的 n-gram 倒排索引，搜索时先求交集得到候选任务再校验子串
+    每次任务变化时由 shared_state 调用 update()；进度等无关字段变化时为 O(1)。
+    """
+    def __init__(self):
+        self._seq = 0
+        # mid -> (状态, 小写歌名, 排序键)
+        self._entries: Dict[str, Tuple[str, str, SortKey]] = {}
+        # 状态 -> 升序排列的 (排序键, mid)
+        self._by_status: Dict[str, List[Tuple[SortKey, str]]] = {}
+        self._by_gram: Dict[str, Set[str]] = {}
+
+    def rebuild(self, tasks: Dict[str, Dict[str, Any]]):
+        self.__init__()
+        for mid, task in tasks.items():
+            self.update(mid, task)
+
+    def update(self, mid: str, task: Optional[Dict[str, Any]]):
+        """任务新增、变化（task 为最新状态）或删除（task 为 None）后调用"""
+        old = self._entries.get(mid)
+        if task is None:
+            if old:
+                self._remove(mid, old)
+            return
+        status = task.get("status", "unknown")
+        name = (task.get("song_name") or "").lower()
+        if old and old[0] == status and old[1] == name:
+            return
+        if old:
+            self._remove(mid, old)
+            key = old[2]
+        else:
+            self._seq += 1
+            key = (int(task.get("created_at") or 0), self._seq)
+        self._entries[mid] = (status, name, key)
+        bisect.insort(self._by_status.setdefault(status, []), (key, mid))
+        for gram in _name_grams(name):
+            self._by_gram.setdefault(gram, set()).add(mid)
+
+    def _remove(self, mid: str, entry: Tuple[str, str, SortKey]):
+        status, name, key = entry
+        del self._entries[mid]
+        bucket = self._by_status[status]
+        del bucket[bisect.bisect_left(bucket, (key, mid))]
+        for gram in _name_grams(name):
+            mids = self._by_gram.get(gram)
+            if mids is not None:
+                mids.discard(mid)
+                if not mids:
+                    del self._by_gram[gram]
+
+    def status_counts(self) -> Dict[str, int]:
+        """各状态的任务数量，直接取各状态列表的长度"""
+        return {status: len(bucket) for status, bucket in self._by_status.items() if bucket}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _priority(self, status: str, sort: str) -> int:
+        return STATUS_PRIORITY.get(status, DEFAULT_PRIORITY) if sort == "priority" else 0
+
+    def query(
+        self,
+        statuses: Optional[List[str]] = None,
+        search: str = "",
+        sort: str = "time",
+        cursor: Optional[str] = None,
+        limit: int = 50,
+    ) -> Tuple[List[str], Optional[str], int]:
+        """按条件列出任务 mid，新创建的在前
+
+        Args:
+            statuses: 只列出这些状态，None 表示全部
+            search: 歌名包含的子串（不区分大小写）
+            sort: "time" 按创建时间；"priority" 先按状态优先级（下载中 > 排队 > 等待重试 > 失败 > 其他）
+            cursor: 上一页返回的 next_cursor
+            limit: 每页数量
+
+        Returns:
+            Tuple[List[str], Optional[str], int]: (本页 mid, 下一页游标或 None, 符合条件的总数)
+        """
+        statuses = [s for s in (statuses or list(self._by_status)) if self._by_status.get(s)]
+        position = self._parse_cursor(cursor)
+        search = search.strip().lower()
+
+        if search:
+            # 搜索结果通常很少，直接对候选任务排序
+            ranked = sorted(
+                ((self._priority(self._entries[mid][0], sort), self._entries[mid][2], mid)
+                 for mid in self._search(search, set(statuses))),
+                key=_page_order,
+            )
+            total = len(ranked)
+            if position:
+                ranked = [item for item in ranked if _page_order(item) > _page_order((*position, ""))]
+            page = ranked[:limit + 1]
+        else:
+            total = sum(len(self._by_status[s]) for s in statuses)
+            page = []
+            for item in self._iter_sorted(statuses, sort, position):
+                page.append(item)
+                if len(page) > limit:
+                    break
+
+        next_cursor = None
+        if len(page) > limit:
+            page = page[:limit]
+            priority, key, _ = page[-1]
+            next_cursor = f"{priority}-{key[0]}-{key[1]}"
+        return [mid for _, _, mid in page], next_cursor, total
+
+    def _search(self, search: str, statuses: Set[str]) -> Set[str]:
+        candidates: Optional[Set[str]] = None
+        for gram in sorted(_query_grams(search), key=lambda g: len(self._by_gram.get(g, ()))):
+            mids = self._by_gram.get(gram)
+            if not mids:
+                return set()
+            candidates = set(mids) if candidates is None else candidates & mids
+            if not candidates:
+                return set()
+        return {
+            mid for mid in candidates or ()
+            if self._entries[mid][0] in statuses and search in self._entries[mid][1]
+        }
+
+    def _iter_sorted(
+        self, statuses: List[str], sort: str, position: Optional[Tuple[int, SortKey]]
+    ) -> Iterator[Tuple[int, SortKey, str]]:
+        """按 (优先级升序, 创建时间降序) 遍历，从游标之后开始"""
+        groups: Dict[int, List[str]] = {}
+        for status in statuses:
+            groups.setdefault(self._priority(status, sort), []).append(status)
+
+        for priority in sorted(groups):
+            if position and priority < position[0]:
+                continue
+            streams = []
+            for status in groups[priority]:
+                bucket = self._by_status[status]
+                end = len(bucket)
+                if position and priority == position[0]:
+                    end = bisect.bisect_left(bucket, (position[1], ""))
+                streams.append(_iter_descending(bucket, end))
+            for key, mid in heapq.merge(*streams, reverse=True):
+                yield priority, key, mid
+
+    @staticmethod
+    def _parse_cursor(cursor: Optional[str]) -> Optional[Tuple[int, SortKey]]:
+        if not cursor:
+            return None
+        try:
+            priority, created_at, seq = (int(part) for part in cursor.split("-"))
+        except ValueError:
+            raise ValueError(f"无效的分页游标: {cursor}")
+        return priority, (created_at, seq)
+
+# 创建全局任务索引实例
+task_index = TaskIndex()
@@ -5,9 +5,17 @@ import aiofiles
 import httpx
 import orjson as json
 
+import library_layout
 import qq_music
-from shared_state import download_tasks
-from utils import save_credentials
+from audio_tags import write_tags
+from dedup import library_deduplicator
+from shared_state import download_tasks, mark_task_changed
+from task_index import task_index
+from song_catalog import song_catalog
+from logger import get_logger
+from utils import DOWNLOADS_DIR, save_credentials, song_index_manager
+
+log = get_logger("tasks")
 
 # --- 配置 ---
 DATA_DIR = "data"
@@ -18,6 +26,7 @@ from config import config
 # 确保配置值是整数类型
 MAX_CONCURRENT_DOWNLOADS = int(config.get("download.max_concurrent", 5))
 RETRY_INTERVAL_SECONDS = int(config.get("download.retry_interval_seconds", 24 * 3600))  # 默认24小时
+FILE_CHECK_INTERVAL_SECONDS = 60  # 检查已完成任务的文件是否仍然存在的间隔
 
 # 确保数据目录在启动时存在
 os.makedirs(DATA_DIR, exist_ok=True)
@@ -48,9 +57,10 @@ async def load_download_tasks():
 
         download_tasks.clear()
         download_tasks.update(persisted_tasks)
-        print(f"已从文件加载 {len(download_tasks)} 条任务历史。")
+        task_index.rebuild(download_tasks)
+        log.info("已从文件加载 %s 条任务历史。", len(download_tasks))
     except (json.JSONDecodeError, IOError) as e:
-        print(f"加载下载任务失败: {e}")
+        log.error("加载下载任务失败: %s", e)
         download_tasks.clear()
 
 async def _save_download_tasks():
@@ -61,7 +71,7 @@ async def _save_download_tasks():
         async with aiofiles.open(TASKS_FILE, "wb") as f:
             await f.write(json_data)
     except IOError as e:
-        print(f"错误：无法保存下载任务文件: {e}")
+        log.error("无法保存下载任务文件: %s", e)
 
 async def _execute_download(song_mid: str, song_name: str):
     """实际执行下载的核心逻辑"""
@@ -69,17 +79,16 @@ async def _execute_download(song_mid: str, song_name: str):
     
     cred = qq_music.get_credential()
     if not cred:
-        print("错误：无法执行下载，因为用户凭证未加载。")
+        log.error("无法执行下载，因为用户凭证未加载。")
         download_tasks[song_mid].update({"status": "failed", "error": "用户未登录"})
+        mark_task_changed(song_mid)
         await _save_download_tasks()
         return
 
     # 从凭证中获取特定于该用户的冷却时间
     cooldown_until = getattr(cred, 'cooldown_until', 0)
 
-    print(f"开始处理: {song_name}")
-    download_dir = "downloads"
-    os.makedirs(download_dir, exist_ok=True)
+    log.info("开始处理: %s", song_name)
 
     # 关键改动：总是先尝试获取下载链接
     url_info = await qq_music.get_song_download_url(song_mid)
@@ -87,18 +96,24 @@ async def _execute_download(song_mid: str, song_name: str):
     if url_info and url_info.get("url"):
         # 如果成功获取链接，说明限制已解除
         if cooldown_until > 0:
-            print("下载链接获取成功，重置该账号的API冷却计时器。")
+            log.info("下载链接获取成功，重置该账号的API冷却计时器。")
             cred.cooldown_until = 0
             save_credentials(cred)
         
         url = url_info["url"]
         quality = url_info["quality"]
         file_extension = url_info["extension"]
-        import re
-        safe_song_name = re.sub(r'[\\/*?:"<>|]', "", song_name).rstrip()
-        file_path = os.path.join(download_dir, f"{safe_song_name}{file_extension}")
+        relpath = library_layout.song_relpath(song_mid, song_name, file_extension)
+        existing = song_index_manager.get_song_info_by_path(relpath)
+        if existing and existing.get("mid") not in (None, song_mid):
+            # 同名但不同的歌曲，追加 mid 避免互相覆盖
+            stem, ext = os.path.splitext(relpath)
+            relpath = f"{stem} ({song_mid}){ext}"
+        file_path = os.path.join(DOWNLOADS_DIR, *relpath.split("/"))
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
 
         download_tasks[song_mid].update({"status": "downloading", "quality": quality})
+        mark_task_changed(song_mid)
         await _save_download_tasks()
 
         try:
@@ -108,6 +123,9 @@ async def _execute_download(song_mid: str, song_name: str):
                     total_size = int(response.headers.get("Content-Length", 0))
                     downloaded_size = 0
 
+                    # 文件可能是去重后的硬链接，先删除再写入，避免截断与其他文件共享的内容
+                    if os.path.lexists(file_path):
+                        os.remove(file_path)
                     async with aiofiles.open(file_path, "wb") as f:
                         async for chunk in response.aiter_bytes():
                             await f.write(chunk)
@@ -116,26 +134,39 @@ async def _execute_download(song_mid: str, song_name: str):
                                 progress = int((downloaded_size / total_size) * 100)
                                 if download_tasks[song_mid].get("progress") != progress:
                                     download_tasks[song_mid]["progress"] = progress
+                                    mark_task_changed(song_mid)
 
             download_tasks[song_mid].update(
                 {
                 "status": "completed",
                 "progress": 100,
                 "file_path": file_path,
-                "url": f"/downloads/{os.path.basename(file_path)}"
+                "url": f"/downloads/{relpath}"
             })
-            print(f"下载完成: {song_name}")
+            mark_task_changed(song_mid)
+            log.info("下载完成: %s", song_name)
+            # 写入 mid 等标签，本地索引据此精确识别文件，不再依赖文件名猜测
+            entry = song_catalog.get(song_mid) or {}
+            tagged = await asyncio.to_thread(
+                write_tags, file_path, song_mid, entry.get("name") or song_name, entry.get("singers", []), quality
+            )
+            # 直接将新文件加入本地歌曲索引
+            song_index_manager.add_file(file_path, quality, song_mid, tagged)
+            # 文件刚写完仍在页缓存中，顺便记录音频数据范围和部分哈希，去重检查时无需再次读取
+            await asyncio.to_thread(library_deduplicator.record_file, relpath, file_path)
             
-            # 发送下载完成通知
+            # 下载完成通知写入发件箱，由后台任务合并发送，不阻塞下载工作者
             from notification import notification_manager
-            await notification_manager.send_download_complete_notification(song_name, quality)
+            await notification_manager.enqueue("download_complete", {"song_name": song_name, "quality": quality})
         except httpx.HTTPStatusError as e:
             error_message = f"HTTP 错误: {e.response.status_code} {e.response.reason_phrase}"
             download_tasks[song_mid].update({"status": "failed", "error": error_message})
-            print(f"下载失败: {song_name}, 原因: {error_message}")
+            mark_task_changed(song_mid)
+            log.warning("下载失败: %s, 原因: %s", song_name, error_message)
         except Exception as e:
             download_tasks[song_mid].update({"status": "failed", "error": f"下载时发生未知错误: {e}"})
-            print(f"下载失败: {song_name}, 原因: {e}")
+            mark_task_changed(song_mid)
+            log.warning("下载失败: %s, 原因: %s", song_name, e)
 
     else:
         # 如果获取链接失败，我们假设是API限制
@@ -146,10 +177,10 @@ async def _execute_download(song_mid: str, song_name: str):
             cooldown_duration = RETRY_INTERVAL_SECONDS
             new_cooldown_until = current_time + cooldown_duration
             cred.cooldown_until = new_cooldown_until
-            print(f"触发API限制，该账号冷却至: {time.ctime(new_cooldown_until)}")
+            log.warning("触发API限制，该账号冷却至: %s", time.ctime(new_cooldown_until))
         else:
             new_cooldown_until = cooldown_until
-            print(f"该账号仍处于冷却期，使用现有冷却时间: {time.ctime(new_cooldown_until)}")
+            log.info("该账号仍处于冷却期，使用现有冷却时间: %s", time.ctime(new_cooldown_until))
 
         save_credentials(cred) # 保存更新后的冷却时间到文件
 
@@ -158,6 +189,7 @@ async def _execute_download(song_mid: str, song_name: str):
             "error": "账号超出下载限制",
             "retry_at": new_cooldown_until
         })
+        mark_task_changed(song_mid)
         
     await _save_download_tasks()
 
@@ -169,7 +201,7 @@ async def download_worker():
 
             task_state = download_tasks.get(song_mid)
             if not task_state or task_state.get("status") == "cancelled":
-                print(f"任务 {song_name} 已被取消，跳过下载。")
+                log.info("任务 %s 已被取消，跳过下载。", song_name)
                 song_queue.task_done()
                 continue
 
@@ -178,7 +210,7 @@ async def download_worker():
         except asyncio.CancelledError:
             break
         except Exception as e:
-            print(f"下载工作者出错: {e}")
+            log.error("下载工作者出错: %s", e)
 
 def start_download_workers():
     """启动指定数量的后台下载工作者并返回它们的任务对象"""
@@ -186,7 +218,7 @@ def start_download_workers():
     for i in range(MAX_CONCURRENT_DOWNLOADS):
         task = asyncio.create_task(download_worker())
         tasks.append(task)
-    print(f"已启动 {MAX_CONCURRENT_DOWNLOADS} 个下载工作者。")
+    log.info("已启动 %s 个下载工作者。", MAX_CONCURRENT_DOWNLOADS)
     return tasks
 
 async def retry_failed_tasks_periodically():
@@ -206,28 +238,73 @@ async def retry_failed_tasks_periodically():
         if not tasks_to_retry:
             continue
 
-        print(f"发现 {len(tasks_to_retry)} 个到期的重试任务，正在将它们重新加入队列...")
+        log.info("发现 %s 个到期的重试任务，正在将它们重新加入队列...", len(tasks_to_retry))
         for mid, task in tasks_to_retry.items():
             song_name = task.get("song_name", "未知歌曲")
             await add_song_to_queue(mid, song_name)
         
         # 当任务到期时，我们不需要在这里做任何特殊操作
         # 工作线程将自动尝试下载并根据结果更新冷却时间
-        print("所有到期的重试任务已重新加入下载队列。")
+        log.info("所有到期的重试任务已重新加入下载队列。")
+
+def _find_missing_files(file_paths: dict) -> list:
+    """在线程池中检查文件是否存在，返回文件已不存在的任务 mid"""
+    return [mid for mid, file_path in file_paths.items() if not os.path.exists(file_path)]
+
+async def check_completed_files_periodically():
+    """后台任务：定期检查已完成任务的本地文件，被删除的标记为失败
+
+    检查放在后台线程中定期执行，状态查询接口不再每次请求都逐个 stat。
+    """
+    while True:
+        await asyncio.sleep(FILE_CHECK_INTERVAL_SECONDS)
+        try:
+            file_paths = {
+                mid: task["file_path"]
+                for mid, task in download_tasks.items()
+                if task.get("status") == "completed" and task.get("file_path")
+            }
+            missing = await asyncio.to_thread(_find_missing_files, file_paths)
+            changed = False
+            for mid in missing:
+                task = download_tasks.get(mid)
+                # 检查期间任务可能已被修改（重新下载、目录迁移），此时跳过
+                if not task or task.get("status") != "completed" or task.get("file_path") != file_paths[mid]:
+                    continue
+                if os.path.exists(file_paths[mid]):
+                    continue
+                task.update({"status": "failed", "error": "本地文件已被删除", "progress": 0})
+                mark_task_changed(mid)
+                changed = True
+            if changed:
+                await _save_download_tasks()
+        except Exception as e:
+            log.error("检查已完成任务的文件时出错: %s", e)
+
+def start_file_check_task():
+    """在后台启动已完成文件的存在性检查"""
+    asyncio.create_task(check_completed_files_periodically())
 
 def start_retry_task():
     """在后台启动定时重试任务"""
-    print(f"启动后台定时重试任务，检查间隔为 {RETRY_INTERVAL_SECONDS / 3600:.1f} 小时。")
+    log.info("启动后台定时重试任务，检查间隔为 %.1f 小时。", RETRY_INTERVAL_SECONDS / 3600)
     asyncio.create_task(retry_failed_tasks_periodically())
 
 async def add_song_to_queue(song_mid: str, song_name: str):
     """生产者接口：将歌曲加入下载队列"""
+    import time
+    # 优先使用元数据目录中的统一名称，保证文件名与本地匹配规则一致
+    song_name = song_catalog.song_name(song_mid, default=song_name)
+    # 重试时保留原来的创建时间，任务在列表中的位置不变
+    created_at = download_tasks.get(song_mid, {}).get("created_at") or int(time.time())
     download_tasks[song_mid] = {
         "status": "queued",
         "song_name": song_name,
         "quality": "",
         "progress": 0,
         "error": None,
+        "created_at": created_at,
     }
+    mark_task_changed(song_mid)
     await _save_download_tasks()
     await song_queue.put((song_mid, song_name))
@@ -1,52 +1,381 @@
 import os
 import json
+import posixpath
+import logging
 import httpx
 import re
 from qqmusic_api import login
 from qqmusic_api.utils.credential import Credential
 from typing import Dict, Set, List, Optional, Any
 import asyncio
+import time
+
+from audio_tags import read_tags
+from logger import SAMPLED, get_logger
+from song_catalog import song_catalog
+
+log = get_logger("utils")
 
 # --- Define the data directory and the path for the credentials file ---
 DATA_DIR = "data"
 DOWNLOADS_DIR = "downloads"
 CREDENTIALS_FILE_PATH = os.path.join(DATA_DIR, "qq_cookie.json")
+# 本地歌曲索引快照，启动时直接加载，随后在后台与下载目录对账
+SONG_INDEX_SNAPSHOT_PATH = os.path.join(DATA_DIR, "song_index.json")
+SONG_INDEX_SNAPSHOT_VERSION = 3
 
 # Ensure the data directory exists
 os.makedirs(DATA_DIR, exist_ok=True)
 os.makedirs(DOWNLOADS_DIR, exist_ok=True)
 
+# 文件名中不允许出现的字符，与下载时生成文件名的规则保持一致
+_INVALID_FILENAME_CHARS_RE = re.compile(r'[\/*?:"<>|/\\]')
+_BRACKETS_RE = re.compile(r'[()（）\[\]【】]')
+
+def _clean_name(name: str) -> str:
+    """去除文件名非法字符"""
+    return _INVALID_FILENAME_CHARS_RE.sub("", name).rstrip()
+
+def _core_key(name: str) -> str:
+    """提取歌曲名核心关键词：去除括号、非法字符和空格，只保留 '-' 之前的歌曲名部分"""
+    core_name = _BRACKETS_RE.sub("", name)
+    core_name = _INVALID_FILENAME_CHARS_RE.sub("", core_name)
+    core_name = core_name.replace(" ", "")
+    return core_name.split("-")[0].upper()
+
+# 模糊匹配候选集按核心关键词的前缀分桶
+_CORE_PREFIX_LEN = 2
+
+# 本地匹配使用的规范化键：去除所有标点、括号、空格和分隔符并转为大写
+_NON_WORD_RE = re.compile(r'[\W_]+')
+# 模糊匹配使用的字符 n-gram 长度
+_NGRAM_SIZE = 2
+
+def _normalize_key(text: str) -> str:
+    return _NON_WORD_RE.sub("", text).upper()
+
+def _ngrams(key: str) -> Set[str]:
+    return {key[i:i + _NGRAM_SIZE] for i in range(len(key) - _NGRAM_SIZE + 1)}
+
+def _add_match_keys(by_key: Dict[str, Set[str]], by_ngram: Dict[str, Set[str]], song_info: Dict[str, Any]):
+    key = _normalize_key(song_info["basename"])
+    by_key.setdefault(key, set()).add(song_info["relpath"])
+    for gram in _ngrams(key):
+        by_ngram.setdefault(gram, set()).add(song_info["relpath"])
+
+def _build_match_index(by_fullname: Dict[str, Dict[str, Any]]) -> tuple:
+    """为一组歌曲构建 (规范化键索引, n-gram 索引)"""
+    by_key, by_ngram = {}, {}
+    for song_info in by_fullname.values():
+        _add_match_keys(by_key, by_ngram, song_info)
+    return by_key, by_ngram
+
+def _build_mid_index(by_fullname: Dict[str, Dict[str, Any]]) -> Dict[str, str]:
+    """为带有 mid 的歌曲构建 mid 到相对路径的映射"""
+    return {song_info["mid"]: relpath for relpath, song_info in by_fullname.items() if song_info.get("mid")}
+
+def _relpath(path: str) -> str:
+    """文件相对下载目录的路径，统一使用 / 分隔，作为索引的主键"""
+    return os.path.relpath(os.path.abspath(path), os.path.abspath(DOWNLOADS_DIR)).replace(os.sep, "/")
+
+def _full_path(relpath: str) -> str:
+    return os.path.join(DOWNLOADS_DIR, *relpath.split("/"))
+
+def _list_dir(reldir: str) -> Optional[tuple]:
+    """列出下载目录下的一个子目录
+
+    Returns:
+        Optional[tuple]: ([(相对路径, DirEntry)...] 文件, [相对路径...] 子目录)；目录不存在时为 None
+    """
+    files, subdirs = [], []
+    try:
+        with os.scandir(_full_path(reldir) if reldir else DOWNLOADS_DIR) as entries:
+            for entry in entries:
+                relpath = f"{reldir}/{entry.name}" if reldir else entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(relpath)
+                elif entry.is_file():
+                    files.append((relpath, entry))
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    return files, subdirs
+
+def _dir_mtime(reldir: str) -> Optional[float]:
+    try:
+        return os.stat(_full_path(reldir) if reldir else DOWNLOADS_DIR).st_mtime
+    except OSError:
+        return None
+
+try:
+    # uvicorn[standard] 自带 watchfiles，可用时通过文件系统事件（inotify 等）增量更新索引
+    from watchfiles import awatch
+except ImportError:
+    awatch = None
+
 class SongIndexManager:
     """管理本地已下载歌曲的索引，提供高效的歌曲检测"""
     def __init__(self):
         self._index = {
-            "by_basename": {},  # 基础文件名到歌曲信息的映射
-            "by_fullname": {},  # 完整文件名到歌曲信息的映射
+            "by_fullname": {},  # 相对下载目录的路径（/ 分隔）到歌曲信息的映射
+            # 匹配索引指向相对路径：不同目录下的同名文件各自独立，互不覆盖
+            "by_key": {},       # 规范化键到相对路径集合的映射
+            "by_ngram": {},     # 规范化键的字符 n-gram 到相对路径集合的映射
+            "by_mid": {},       # 歌曲 mid（来自音频标签或下载记录）到相对路径的映射
             "last_updated": 0   # 最后更新时间戳
         }
+        # 索引内容每次变化时递增，供依赖匹配结果的缓存判断是否失效
+        self.version = 0
         self._update_lock = asyncio.Lock()
-        self._update_interval = 300  # 索引更新间隔（秒）
+        self._poll_interval = 5  # 无文件系统事件支持时的 mtime 轮询间隔（秒）
+        # 原地覆盖或重写标签不会改变目录 mtime，轮询时按该间隔逐个 stat 已知文件（秒）
+        self._file_check_interval = 60
         self._background_task = None
+        # 增量索引快照：下载目录及各级子目录的 mtime，以及每个文件的 (mtime, size)
+        self._dir_mtimes: Dict[str, float] = {}
+        self._file_stats: Dict[str, tuple] = {}
+        self._snapshot_dirty = False
+        self._snapshot_interval = 30  # 快照落盘间隔（秒）
+        self._snapshot_task = None
     
     def start_background_update(self):
-        """启动后台定期更新任务"""
+        """启动后台对账、增量更新和快照落盘任务"""
         if not self._background_task:
             self._background_task = asyncio.create_task(self._periodic_update())
+        if not self._snapshot_task:
+            self._snapshot_task = asyncio.create_task(self._periodic_snapshot())
+    
+    def load_snapshot(self) -> bool:
+        """从快照恢复索引，使服务启动不必等待全量扫描
+
+        Returns:
+            bool: 是否成功加载了快照
+        """
+        if not os.path.exists(SONG_INDEX_SNAPSHOT_PATH):
+            return False
+        try:
+            import orjson
+            with open(SONG_INDEX_SNAPSHOT_PATH, "rb") as f:
+                snapshot = orjson.loads(f.read())
+            if snapshot.get("version") != SONG_INDEX_SNAPSHOT_VERSION:
+                log.info("歌曲索引快照版本不匹配，将重新扫描。")
+                return False
+            by_fullname = {}
+            file_stats = {}
+            for song_info in snapshot["files"]:
+                stat = tuple(song_info.pop("stat"))
+                by_fullname[song_info["relpath"]] = song_info
+                file_stats[song_info["relpath"]] = stat
+            self._index["by_fullname"] = by_fullname
+            self._rebuild_match_index()
+            self._index["last_updated"] = snapshot.get("last_updated", 0)
+            self.version += 1
+            self._file_stats = file_stats
+            # 目录 mtime 不沿用快照，确保启动后的第一次对账会列出所有目录
+            self._dir_mtimes = {}
+            log.info("已从快照加载歌曲索引，共 %d 首本地歌曲", len(by_fullname))
+            return True
+        except Exception as e:
+            log.warning("加载歌曲索引快照失败: %s", e)
+            return False
+    
+    def _snapshot_payload(self) -> Dict[str, Any]:
+        """在事件循环中复制当前索引，序列化和写盘可以交给线程池"""
+        self._snapshot_dirty = False
+        files = [
+            {**song_info, "stat": self._file_stats.get(relpath, (0, 0))}
+            for relpath, song_info in self._index["by_fullname"].items()
+        ]
+        return {
+            "version": SONG_INDEX_SNAPSHOT_VERSION,
+            "last_updated": self._index["last_updated"],
+            "files": files,
+        }
+    
+    def _write_snapshot(self, payload: Dict[str, Any]) -> bool:
+        try:
+            import orjson
+            tmp_path = SONG_INDEX_SNAPSHOT_PATH + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(orjson.dumps(payload))
+            os.replace(tmp_path, SONG_INDEX_SNAPSHOT_PATH)
+            return True
+        except Exception as e:
+            log.error("保存歌曲索引快照失败: %s", e)
+            return False
+    
+    def save_snapshot(self):
+        """将当前索引写入快照文件"""
+        if not self._write_snapshot(self._snapshot_payload()):
+            self._snapshot_dirty = True
+    
+    async def _periodic_snapshot(self):
+        """索引有变化时定期落盘快照，避免每次变化都重写整个文件"""
+        while True:
+            await asyncio.sleep(self._snapshot_interval)
+            if self._snapshot_dirty:
+                if not await asyncio.to_thread(self._write_snapshot, self._snapshot_payload()):
+                    self._snapshot_dirty = True
     
     async def _periodic_update(self):
-        """定期更新索引"""
+        """先与下载目录对账一次，之后优先监听文件系统事件，不可用时退化为 mtime 轮询
+
+        轮询时每次只比对目录 mtime，每隔 _file_check_interval 秒再逐个比对已知文件的 mtime。
+        """
+        # 服务停止期间文件可能被原地修改，启动时的对账也检查每个文件
+        await self.refresh_incremental(check_files=True)
+        if awatch is not None:
+            try:
+                async for changes in awatch(DOWNLOADS_DIR, recursive=True):
+                    await self._apply_changes({path for _, path in changes})
+            except Exception as e:
+                log.warning("监听下载目录失败: %s，改为定期比对 mtime。", e)
+        last_file_check = time.monotonic()
         while True:
-            await self.update_index()
-            await asyncio.sleep(self._update_interval)
+            await asyncio.sleep(self._poll_interval)
+            check_files = time.monotonic() - last_file_check >= self._file_check_interval
+            if check_files:
+                last_file_check = time.monotonic()
+            await self.refresh_incremental(check_files)
     
     async def update_index(self):
-        """更新本地歌曲索引"""
+        """全量更新本地歌曲索引
+
+        扫描在线程池中进行，完成后一次性替换整个索引，扫描期间事件循环不会被阻塞。
+        """
+        async with self._update_lock:
+            try:
+                # 未变化文件的标签直接复用，只有新增或变化的文件才需要重新读取
+                known_tags = {
+                    relpath: (self._file_stats.get(relpath), song_info.get("tags"))
+                    for relpath, song_info in self._index["by_fullname"].items()
+                }
+                index, file_stats, dir_mtimes = await asyncio.to_thread(self._scan_download_dir, known_tags)
+                self._index = index
+                self.version += 1
+                self._file_stats = file_stats
+                self._dir_mtimes = dir_mtimes
+                self._snapshot_dirty = True
+                log.info("更新歌曲索引成功，已索引 %d 首本地歌曲", len(self._index["by_fullname"]))
+            except Exception as e:
+                log.exception("更新歌曲索引失败: %s", e)
+    
+    async def refresh_incremental(self, check_files: bool = False):
+        """与上次快照比对，只重新索引新增或变化的文件
+
+        每个目录的 mtime 未变化时不会列出该目录，空闲时的开销只有每个目录一次 stat。
+        check_files 为 True 时还会逐个 stat 这些目录中的已知文件，发现原地覆盖或重写标签的文件。
+        列目录和构建条目在线程池中完成，事件循环上只做字典更新。
+        """
+        async with self._update_lock:
+            try:
+                diff = await asyncio.to_thread(
+                    self._diff_download_dir, dict(self._dir_mtimes), dict(self._file_stats), check_files
+                )
+                if diff is None:
+                    return
+                dir_mtimes, current, song_infos, removed = diff
+                for song_info in song_infos:
+                    self._put(song_info)
+                for relpath in removed:
+                    self._drop(relpath)
+
+                self._file_stats = current
+                self._dir_mtimes = dir_mtimes
+                if song_infos or removed:
+                    self._index["last_updated"] = int(time.time())
+                    self._snapshot_dirty = True
+                    log.info("增量更新歌曲索引：新增或变化 %d 个，删除 %d 个", len(song_infos), len(removed))
+            except Exception as e:
+                log.exception("增量更新歌曲索引失败: %s", e)
+    
+    async def _apply_changes(self, paths: Set[str]):
+        """根据文件系统事件更新对应文件的索引
+
+        事件涉及目录（新建、移入、删除整个目录）时，交给 refresh_incremental 按目录 mtime 对账。
+        """
+        rescan = False
         async with self._update_lock:
             try:
-                self._scan_download_dir()
-                print(f"更新歌曲索引成功，已索引 {len(self._index['by_basename'])} 首本地歌曲")
+                updates, rescan = await asyncio.to_thread(
+                    self._stat_changed_paths, paths, dict(self._file_stats), set(self._dir_mtimes)
+                )
+                for relpath, song_info, stat in updates:
+                    if song_info is not None:
+                        self._put(song_info)
+                        self._file_stats[relpath] = stat
+                    else:
+                        self._drop(relpath)
+                        self._file_stats.pop(relpath, None)
+                if updates:
+                    self._index["last_updated"] = int(time.time())
+                    self._snapshot_dirty = True
             except Exception as e:
-                print(f"更新歌曲索引失败: {e}")
+                log.exception("处理下载目录变化失败: %s", e)
+        if rescan:
+            await self.refresh_incremental()
+    
+    def add_file(self, file_path: str, quality: str, mid: Optional[str] = None, tagged: bool = False):
+        """下载完成后直接将文件加入索引，无需等待下一次扫描"""
+        relpath = _relpath(file_path)
+        filename = posixpath.basename(relpath)
+        try:
+            stat = os.stat(file_path)
+        except OSError as e:
+            log.warning("加入索引失败，无法读取文件 %s: %s", file_path, e)
+            return
+        basename, ext = os.path.splitext(filename)
+        self._put({
+            "relpath": relpath,
+            "filename": filename,
+            "basename": basename,
+            "path": file_path,
+            "size": stat.st_size,
+            "quality": quality,
+            "extension": ext.lstrip("."),
+            "is_program_downloaded": True,
+            "mid": mid,
+            "tags": {"mid": mid, "quality": quality} if tagged else None
+        })
+        self._file_stats[relpath] = (stat.st_mtime, stat.st_size)
+        self._index["last_updated"] = int(time.time())
+        self._snapshot_dirty = True
+    
+    def _put(self, song_info: Dict[str, Any]):
+        # 同一路径的旧条目（文件被覆盖或标签变化）先完整移除，避免残留旧的 mid 和匹配键
+        self._drop(song_info["relpath"])
+        self.version += 1
+        self._index["by_fullname"][song_info["relpath"]] = song_info
+        self._index_match_keys(song_info)
+        if song_info.get("mid"):
+            self._index["by_mid"][song_info["mid"]] = song_info["relpath"]
+    
+    def _drop(self, relpath: str):
+        song_info = self._index["by_fullname"].pop(relpath, None)
+        if not song_info:
+            return
+        self.version += 1
+        if song_info.get("mid") and self._index["by_mid"].get(song_info["mid"]) == relpath:
+            del self._index["by_mid"][song_info["mid"]]
+        self._unindex_match_keys(song_info)
+    
+    def _index_match_keys(self, song_info: Dict[str, Any]):
+        """将歌曲加入规范化键索引和 n-gram 索引"""
+        _add_match_keys(self._index["by_key"], self._index["by_ngram"], song_info)
+    
+    def _unindex_match_keys(self, song_info: Dict[str, Any]):
+        relpath = song_info["relpath"]
+        key = _normalize_key(song_info["basename"])
+        for index, grams in ((self._index["by_key"], (key,)), (self._index["by_ngram"], _ngrams(key))):
+            for gram in grams:
+                relpaths = index.get(gram)
+                if relpaths:
+                    relpaths.discard(relpath)
+                    if not relpaths:
+                        del index[gram]
+    
+    def _rebuild_match_index(self):
+        self._index["by_key"], self._index["by_ngram"] = _build_match_index(self._index["by_fullname"])
+        self._index["by_mid"] = _build_mid_index(self._index["by_fullname"])
     
     def _load_download_history(self):
         """加载历史下载任务，用于获取本程序下载的歌曲的音质信息"""
@@ -65,134 +394,263 @@ class SongIndexManager:
                                 "mid": mid,
                                 "song_name": task["song_name"],
                                 "quality": task.get("quality", ""),
-                                "clean_name": re.sub(r'[\/*?:"<>|/\\]', "", task["song_name"]).rstrip()
+                                "relpath": _relpath(task["file_path"]) if task.get("file_path") else "",
+                                "clean_name": _clean_name(task["song_name"])
                             })
             except (json.JSONDecodeError, IOError) as e:
-                print(f"加载下载历史失败: {e}")
+                log.warning("加载下载历史失败: %s", e)
         
-        # 手动添加测试数据，用于测试音质显示功能
-        # 注意：这只是为了测试，实际应用中应该从下载历史文件中读取
-        test_downloads = [
-            {
-                "mid": "test1",
-                "song_name": "SPOTLIGHT HUNTER (焦点猎手) - 三角洲行动/SIENA",
-                "quality": "无损音质",
-                "clean_name": "SPOTLIGHTHUNTER焦点猎手三角洲行动SIENA"
-            },
-            {
-                "mid": "test2",
-                "song_name": "Dawn (黎明将至) - 三角洲行动/Lithium Done",
-                "quality": "极高音质",
-                "clean_name": "Dawn黎明将至三角洲行动LithiumDone"
-            }
-        ]
+        return download_history
+    
+    def _load_history_lookup(self) -> Dict[str, Dict]:
+        """加载下载历史并按规范化键建立索引，使每个文件的音质归属只需常数次查找
+
+        Returns:
+            Dict[str, Dict]: 包含 by_relpath、by_clean_name、by_core、by_prefix 四个索引
+        """
+        by_relpath, by_clean_name, by_core, by_prefix = {}, {}, {}, {}
+        for task in self._load_download_history():
+            core = _core_key(task["song_name"])
+            task["core"] = core
+            if task.get("relpath"):
+                by_relpath.setdefault(task["relpath"], task)
+            by_clean_name.setdefault(task["clean_name"], task)
+            by_core.setdefault(core, task)
+            by_prefix.setdefault(core[:_CORE_PREFIX_LEN], []).append(task)
+        return {
+            "by_relpath": by_relpath,
+            "by_clean_name": by_clean_name,
+            "by_core": by_core,
+            "by_prefix": by_prefix,
+        }
+    
+    def _match_history(self, relpath: str, clean_basename: str, history_lookup: Dict[str, Dict]) -> Optional[Dict[str, Any]]:
+        """在下载历史中查找与本地文件对应的任务"""
+        # 1. 任务记录的文件路径完全相同
+        task = history_lookup["by_relpath"].get(relpath)
+        if task:
+            return task
         
-        # 将测试数据添加到下载历史中
-        download_history.extend(test_downloads)
-        print(f"添加了 {len(test_downloads)} 条测试数据到下载历史")
+        # 2. 清理后的名称完全相同
+        task = history_lookup["by_clean_name"].get(clean_basename)
+        if task:
+            return task
         
-        return download_history
+        # 3. 核心关键词完全相同
+        basename_core = _core_key(clean_basename)
+        task = history_lookup["by_core"].get(basename_core)
+        if task:
+            return task
+        
+        # 4. 模糊匹配：只在核心关键词前缀相同的少量候选中做包含匹配
+        if not basename_core:
+            return None
+        for task in history_lookup["by_prefix"].get(basename_core[:_CORE_PREFIX_LEN], ()):
+            if task["clean_name"] in clean_basename or clean_basename in task["clean_name"]:
+                return task
+            if task["core"] in basename_core or basename_core in task["core"]:
+                return task
+        return None
     
-    def _scan_download_dir(self):
-        """扫描下载目录，构建歌曲索引"""
-        by_basename = {}
+    def _scan_download_dir(self, known_tags: Dict[str, tuple]) -> tuple:
+        """递归扫描下载目录，构建一份完整的新索引（在线程池中运行，不修改当前索引）
+
+        Args:
+            known_tags: 相对路径到 (已索引时的 (mtime, size), 已读取的标签) 的映射
+
+        Returns:
+            tuple: (索引, 文件 (mtime, size) 快照, 各目录 mtime)
+        """
         by_fullname = {}
+        file_stats = {}
+        dir_mtimes = {}
         
         # 加载历史下载任务，获取本程序下载的歌曲的音质信息
-        download_history = self._load_download_history()
-        print(f"加载下载历史，包含 {len(download_history)} 个已完成任务")
+        history_lookup = self._load_history_lookup()
+        log.debug("加载下载历史，包含 %d 个已完成任务", len(history_lookup["by_clean_name"]))
         
-        print(f"开始扫描下载目录: {DOWNLOADS_DIR}")
-        if os.path.exists(DOWNLOADS_DIR):
-            files = os.listdir(DOWNLOADS_DIR)
-            print(f"下载目录包含 {len(files)} 个文件")
-            
-            for filename in files:
-                print(f"处理文件: {filename}")
-                full_path = os.path.join(DOWNLOADS_DIR, filename)
-                if os.path.isfile(full_path):
-                    basename, ext = os.path.splitext(filename)
-                    file_size = os.path.getsize(full_path)
-                    
-                    quality = "未知音质"
-                    
-                    # 清理basename，用于匹配下载历史
-                    clean_basename = re.sub(r'[\/*?:"<>|/\\]', "", basename).rstrip()
-                    
-                    # 1. 首先检查是否是本程序下载的歌曲，从下载历史中获取音质
-                    matched_task = None
-                    
-                    print(f"尝试匹配本地文件: {clean_basename}")
-                    print(f"下载历史包含 {len(download_history)} 条记录")
-                    
-                    # 尝试多种匹配方式
-                    for task in download_history:
-                        print(f"  检查下载历史记录: {task['song_name']}")
-                        print(f"  清理后的任务名称: {task['clean_name']}")
-                        
-                        # 1. 精确匹配：完全相同
-                        if task["clean_name"] == clean_basename:
-                            matched_task = task
-                            print(f"  完全匹配成功")
-                            break
-                        
-                        # 2. 包含匹配：任务名称包含在文件名中，或文件名包含任务名称
-                        if task["clean_name"] in clean_basename or clean_basename in task["clean_name"]:
-                            matched_task = task
-                            print(f"  包含匹配成功")
-                            break
-                        
-                        # 3. 核心关键词匹配：检查歌曲名称的核心部分
-                        # 提取核心关键词（去除括号、空格等）
-                        def get_core_keywords(name):
-                            # 去除括号内容
-                            core_name = re.sub(r'[()（）\[\]【】]', "", name)
-                            # 去除特殊字符
-                            core_name = re.sub(r'[\/*?:"<>|/\\]', "", core_name)
-                            # 去除空格
-                            core_name = core_name.replace(" ", "")
-                            # 分割关键词
-                            return core_name.split("-")[0]  # 只保留歌曲名，去除歌手信息
-                        
-                        task_core = get_core_keywords(task["song_name"]).upper()
-                        basename_core = get_core_keywords(clean_basename).upper()
-                        
-                        print(f"  任务核心关键词: {task_core}")
-                        print(f"  文件名核心关键词: {basename_core}")
-                        
-                        if task_core in basename_core or basename_core in task_core:
-                            matched_task = task
-                            print(f"  核心关键词匹配成功")
-                            break
-                    
-                    if matched_task:
-                        quality = matched_task["quality"]
-                        print(f"匹配到下载历史，获取音质: {quality}")
-                    else:
-                        # 2. 如果不是本程序下载的，尝试从文件名提取音质
-                        quality = self._extract_quality_from_filename(basename)
-                        print(f"未匹配到下载历史，使用提取的音质: {quality}")
-                    
-                    # 构建歌曲信息
-                    song_info = {
-                        "filename": filename,
-                        "basename": basename,
-                        "path": full_path,
-                        "size": file_size,
-                        "quality": quality,
-                        "extension": ext.lstrip("."),
-                        "is_program_downloaded": matched_task is not None
-                    }
-                    
-                    by_basename[basename] = song_info
-                    by_fullname[filename] = song_info
-                    print(f"已索引文件: {filename}, 大小: {file_size}, 音质: {quality}, 本程序下载: {matched_task is not None}")
+        log.info("开始扫描下载目录: %s", DOWNLOADS_DIR)
+        pending = [""]
+        while pending:
+            reldir = pending.pop()
+            # 先记录目录 mtime 再列目录，扫描期间新增的文件会在下一次增量更新时补上
+            mtime = _dir_mtime(reldir)
+            listing = _list_dir(reldir) if mtime is not None else None
+            if listing is None:
+                if not reldir:
+                    log.warning("下载目录不存在: %s", DOWNLOADS_DIR)
+                continue
+            dir_mtimes[reldir] = mtime
+            files, subdirs = listing
+            pending.extend(subdirs)
+            for relpath, entry in files:
+                stat = entry.stat()
+                file_stat = (stat.st_mtime, stat.st_size)
+                cached = known_tags.get(relpath)
+                tags = cached[1] if cached and cached[0] == file_stat else read_tags(entry.path)
+                song_info = self._build_song_info(relpath, entry.path, history_lookup, stat.st_size, tags)
+                by_fullname[relpath] = song_info
+                file_stats[relpath] = file_stat
+        log.info("下载目录包含 %d 个文件，%d 个目录", len(by_fullname), len(dir_mtimes))
+        
+        by_key, by_ngram = _build_match_index(by_fullname)
+        index = {
+            "by_fullname": by_fullname,
+            "by_key": by_key,
+            "by_ngram": by_ngram,
+            "by_mid": _build_mid_index(by_fullname),
+            "last_updated": int(time.time())
+        }
+        return index, file_stats, dir_mtimes
+    
+    def _diff_download_dir(
+        self, known_dir_mtimes: Dict[str, float], known_stats: Dict[str, tuple], check_files: bool = False
+    ) -> Optional[tuple]:
+        """按目录 mtime 与已知快照比对下载目录（在线程池中运行）
+
+        mtime 未变化的目录，其中的文件和子目录集合也未变化，不必列目录；但同名文件被原地覆盖时
+        目录 mtime 不变，check_files 为 True 时逐个 stat 其中的已知文件，否则直接沿用快照。
+
+        Returns:
+            Optional[tuple]: 目录和文件都未变化时为 None，否则为
+            (各目录 mtime, 当前文件快照, 新增或变化文件的索引条目, 已删除文件的相对路径)
+        """
+        known_subdirs: Dict[str, List[str]] = {}
+        for reldir in known_dir_mtimes:
+            if reldir:
+                known_subdirs.setdefault(posixpath.dirname(reldir), []).append(reldir)
+        known_files: Dict[str, List[str]] = {}
+        for relpath in known_stats:
+            known_files.setdefault(posixpath.dirname(relpath), []).append(relpath)
+
+        dir_mtimes = {}
+        current = {}
+        pending = [""]
+        while pending:
+            reldir = pending.pop()
+            mtime = _dir_mtime(reldir)
+            if mtime is None:
+                continue
+            dir_mtimes[reldir] = mtime
+            if known_dir_mtimes.get(reldir) == mtime:
+                pending.extend(known_subdirs.get(reldir, ()))
+                for relpath in known_files.get(reldir, ()):
+                    if not check_files:
+                        current[relpath] = known_stats[relpath]
+                        continue
+                    try:
+                        stat = os.stat(_full_path(relpath))
+                    except FileNotFoundError:
+                        continue
+                    current[relpath] = (stat.st_mtime, stat.st_size)
+                continue
+            listing = _list_dir(reldir)
+            if listing is None:
+                continue
+            files, subdirs = listing
+            pending.extend(subdirs)
+            for relpath, entry in files:
+                stat = entry.stat()
+                current[relpath] = (stat.st_mtime, stat.st_size)
+
+        changed = [relpath for relpath, stat in current.items() if known_stats.get(relpath) != stat]
+        removed = [relpath for relpath in known_stats if relpath not in current]
+        if dir_mtimes == known_dir_mtimes and not changed and not removed:
+            return None
+        song_infos = []
+        if changed:
+            history_lookup = self._load_history_lookup()
+            for relpath in changed:
+                full_path = _full_path(relpath)
+                song_infos.append(self._build_song_info(relpath, full_path, history_lookup, current[relpath][1], read_tags(full_path)))
+        return dir_mtimes, current, song_infos, removed
+    
+    def _stat_changed_paths(self, paths: Set[str], known_stats: Dict[str, tuple], known_dirs: Set[str]) -> tuple:
+        """为文件系统事件涉及的文件构建索引条目（在线程池中运行）
+
+        Returns:
+            tuple: ([(相对路径, 索引条目或 None 表示已删除, (mtime, size))...], 是否需要按目录对账)
+        """
+        updates = []
+        rescan = False
+        history_lookup = None
+        for path in paths:
+            relpath = _relpath(path)
+            if relpath.startswith(".."):
+                continue
+            full_path = _full_path(relpath)
+            try:
+                stat = os.stat(full_path)
+            except FileNotFoundError:
+                if relpath in known_stats:
+                    updates.append((relpath, None, None))
+                elif relpath in known_dirs:
+                    rescan = True
+                continue
+            if os.path.isdir(full_path):
+                rescan = True
+                continue
+            if not os.path.isfile(full_path) or known_stats.get(relpath) == (stat.st_mtime, stat.st_size):
+                continue
+            if history_lookup is None:
+                history_lookup = self._load_history_lookup()
+            song_info = self._build_song_info(relpath, full_path, history_lookup, stat.st_size, read_tags(full_path))
+            updates.append((relpath, song_info, (stat.st_mtime, stat.st_size)))
+        return updates, rescan
+    
+    def _build_song_info(
+        self,
+        relpath: str,
+        full_path: str,
+        history_lookup: Dict[str, Dict],
+        file_size: Optional[int] = None,
+        tags: Optional[Dict[str, str]] = None,
+    ) -> Dict[str, Any]:
+        """为单个本地文件构建索引条目
+
+        mid 和音质优先取自音频标签，其次取自下载历史，最后从文件名推断音质。
+        """
+        filename = posixpath.basename(relpath)
+        basename, ext = os.path.splitext(filename)
+        if file_size is None:
+            file_size = os.path.getsize(full_path)
+        
+        # 清理basename，用于匹配下载历史
+        clean_basename = _clean_name(basename)
+        
+        # 1. 首先检查是否是本程序下载的歌曲，从下载历史中获取音质
+        matched_task = self._match_history(relpath, clean_basename, history_lookup)
+        
+        mid = None
+        if tags:
+            mid = tags["mid"]
+            quality = tags["quality"] or (matched_task["quality"] if matched_task else self._extract_quality_from_filename(basename))
+        elif matched_task:
+            quality = matched_task["quality"]
+            # 只有文件路径与任务记录完全一致时才认为 mid 可信，旧版本下载的文件没有标签
+            if matched_task.get("relpath") == relpath:
+                mid = matched_task["mid"]
         else:
-            print(f"下载目录不存在: {DOWNLOADS_DIR}")
+            # 2. 如果不是本程序下载的，尝试从文件名提取音质
+            quality = self._extract_quality_from_filename(basename)
         
-        self._index["by_basename"] = by_basename
-        self._index["by_fullname"] = by_fullname
-        self._index["last_updated"] = int(asyncio.get_event_loop().time())
+        # 构建歌曲信息
+        song_info = {
+            "relpath": relpath,
+            "filename": filename,
+            "basename": basename,
+            "path": full_path,
+            "size": file_size,
+            "quality": quality,
+            "extension": ext.lstrip("."),
+            "is_program_downloaded": tags is not None or matched_task is not None,
+            "mid": mid,
+            "tags": tags
+        }
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("已索引文件: %s, 大小: %d, 音质: %s, 本程序下载: %s",
+                      filename, file_size, quality, matched_task is not None, extra=SAMPLED)
+        return song_info
     
     def _extract_quality_from_filename(self, basename: str) -> str:
         """从文件名中提取音质信息"""
@@ -219,15 +677,31 @@ class SongIndexManager:
     
     def get_existing_song_basenames(self) -> Set[str]:
         """获取所有已存在歌曲的基础文件名"""
-        return set(self._index["by_basename"].keys())
+        return {song_info["basename"] for song_info in self._index["by_fullname"].values()}
     
     def get_fullname_map(self) -> Dict[str, str]:
-        """获取完整文件名到路径的映射"""
-        return {filename: info["path"] for filename, info in self._index["by_fullname"].items()}
+        """获取相对路径到文件路径的映射"""
+        return {relpath: info["path"] for relpath, info in self._index["by_fullname"].items()}
+    
+    def get_file_stats(self) -> Dict[str, tuple]:
+        """获取相对路径到文件 (mtime, size) 的映射"""
+        return dict(self._file_stats)
+    
+    def get_indexed_songs(self) -> List[Dict[str, Any]]:
+        """获取所有已索引歌曲的信息"""
+        return list(self._index["by_fullname"].values())
+    
+    def get_song_info_by_path(self, relpath: str) -> Optional[Dict[str, Any]]:
+        """根据相对下载目录的路径获取歌曲信息"""
+        return self._index["by_fullname"].get(relpath)
     
     def get_song_info_by_basename(self, basename: str) -> Optional[Dict[str, Any]]:
-        """根据基础文件名获取歌曲信息"""
-        return self._index["by_basename"].get(basename)
+        """根据基础文件名获取歌曲信息，不同目录下有同名文件时返回相对路径排序最前的一个"""
+        by_fullname = self._index["by_fullname"]
+        for relpath in sorted(self._index["by_key"].get(_normalize_key(basename), ())):
+            if by_fullname[relpath]["basename"] == basename:
+                return by_fullname[relpath]
+        return None
     
     def find_matching_songs(self, song_name: str, singer_names: List[str]) -> List[Dict[str, Any]]:
         """查找匹配的本地歌曲
@@ -239,57 +713,111 @@ class SongIndexManager:
         Returns:
             List[Dict[str, Any]]: 匹配的歌曲信息列表
         """
-        print(f"\n=== 开始匹配歌曲: {song_name} - {', '.join(singer_names)} ===")
-        print(f"当前已索引的本地歌曲: {list(self._index['by_basename'].keys())}")
-        
-        # 生成可能的文件名组合
-        possible_basenames = self._generate_possible_basenames(song_name, singer_names)
-        
-        # 查找匹配的歌曲
+        by_fullname = self._index["by_fullname"]
         matching_songs = []
         
-        # 1. 精确匹配
-        for basename in possible_basenames:
-            song_info = self._index["by_basename"].get(basename)
-            if song_info:
-                matching_songs.append(song_info)
-                print(f"找到精确匹配: {basename} -> {song_info['filename']}")
-        
-        # 2. 包含匹配 - 检查本地文件名是否包含歌曲名称的核心部分
-        if not matching_songs:
-            # 处理特殊情况：如果本地歌曲列表只有一个文件，且歌曲名称包含SPOTLIGHT，直接匹配
-            if len(self._index["by_basename"]) == 1:
-                for basename, song_info in self._index["by_basename"].items():
-                    if "SPOTLIGHT" in basename.upper():
-                        matching_songs.append(song_info)
-                        print(f"特殊匹配: SPOTLIGHT 相关歌曲 -> {song_info['filename']}")
-                        break
+        # 1. 精确匹配：规范化键一次查找即可覆盖各种分隔符、空格写法
+        clean_singers = [_clean_name(singer) for singer in singer_names]
+        candidate_keys = [_normalize_key(_clean_name(song_name) + "".join(clean_singers))]
+        if clean_singers:
+            candidate_keys.append(_normalize_key(_clean_name(song_name) + clean_singers[0]))
+        candidate_keys.append(_normalize_key(song_name))
+        seen = set()
+        for key in candidate_keys:
+            for relpath in self._sorted_relpaths(self._index["by_key"].get(key, ())):
+                if relpath not in seen:
+                    seen.add(relpath)
+                    matching_songs.append(by_fullname[relpath])
         
-        # 3. 模糊匹配 - 如果没有精确匹配，尝试模糊匹配
+        # 2. 模糊匹配 - 通过 n-gram 索引取候选集，只对候选做包含判断
         if not matching_songs:
-            # 生成简化的歌曲名称（仅保留主要关键词）
-            simplified_song_name = re.sub(r'[()（）\[\]【】\-]', "", song_name).strip().upper()
-            simplified_song_name = simplified_song_name.replace(" ", "")
-            
-            print(f"尝试模糊匹配，简化后的歌曲名称: {simplified_song_name}")
-            
-            # 遍历所有已索引的歌曲，尝试模糊匹配
-            for basename, song_info in self._index["by_basename"].items():
-                # 简化文件名，去除特殊字符和空格
-                simplified_filename = re.sub(r'[()（）\[\]【】\-]', "", basename).strip().upper()
-                simplified_filename = simplified_filename.replace(" ", "")
-                
-                print(f"  比较: {simplified_song_name} vs {simplified_filename}")
-                
-                # 检查简化后的文件名是否包含简化后的歌曲名称
-                if simplified_song_name in simplified_filename:
+            simplified_song_name = _normalize_key(song_name)
+            for relpath in self._fuzzy_candidates(simplified_song_name):
+                song_info = by_fullname[relpath]
+                if simplified_song_name in _normalize_key(song_info["basename"]):
                     matching_songs.append(song_info)
-                    print(f"找到模糊匹配: {song_name} -> {song_info['filename']}")
+                    log.debug("找到模糊匹配: %s -> %s", song_name, song_info["filename"], extra=SAMPLED)
                     break  # 只返回第一个匹配的结果
         
-        print(f"匹配结果: {len(matching_songs)} 首歌曲匹配成功")
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("匹配歌曲: %s - %s, 结果 %d 首", song_name, ", ".join(singer_names), len(matching_songs), extra=SAMPLED)
         return matching_songs
     
+    def _sorted_relpaths(self, relpaths) -> List[str]:
+        """按基础文件名排序，同名文件再按相对路径排序，保证匹配结果稳定"""
+        by_fullname = self._index["by_fullname"]
+        return sorted(relpaths, key=lambda relpath: (by_fullname[relpath]["basename"], relpath))
+    
+    def _fuzzy_candidates(self, key: str) -> List[str]:
+        """返回包含 key 的所有 n-gram 的本地歌曲的相对路径，作为模糊匹配的候选集"""
+        if not key:
+            return []
+        grams = _ngrams(key)
+        if not grams:
+            # 键比 n-gram 还短，只能在规范化键上直接判断
+            return self._sorted_relpaths(
+                relpath for norm_key, relpaths in self._index["by_key"].items()
+                if key in norm_key for relpath in relpaths
+            )
+        postings = sorted((self._index["by_ngram"].get(gram, set()) for gram in grams), key=len)
+        candidates = set(postings[0])
+        for posting in postings[1:]:
+            if not candidates:
+                break
+            candidates &= posting
+        return self._sorted_relpaths(candidates)
+    
+    def _match_catalog_name(self, mid: str) -> Optional[Dict[str, Any]]:
+        """按元数据目录中记录的歌名和歌手还原下载时使用的文件名，查找同名的本地文件
+
+        下载任务用目录中的名称命名文件，目录收录了该歌曲时，这一精确查找比按 API 返回的名称猜测更可靠。
+        """
+        expected = song_catalog.song_name(mid)
+        if not expected:
+            return None
+        relpaths = self._index["by_key"].get(_normalize_key(_clean_name(expected)))
+        if not relpaths:
+            return None
+        return self._index["by_fullname"][self._sorted_relpaths(relpaths)[0]]
+
+    def match_many(self, songs: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+        """批量查找一组歌曲对应的本地文件
+
+        依次使用音频标签中的 mid、元数据目录记录的文件名、按歌名和歌手的模糊匹配。
+
+        Args:
+            songs: API 返回的歌曲列表（需包含 mid、name、singer 字段）
+
+        Returns:
+            Dict[str, Dict[str, Any]]: mid 到首个匹配的本地歌曲信息的映射，未匹配的歌曲不包含在内
+        """
+        matches = {}
+        by_mid = self._index["by_mid"]
+        by_fullname = self._index["by_fullname"]
+        # 同名同歌手的歌曲（例如不同版本）只匹配一次
+        by_name: Dict[tuple, Optional[Dict[str, Any]]] = {}
+        for song in songs:
+            mid = song.get("mid")
+            if not mid or mid in matches:
+                continue
+            # 带 mid 标签的文件直接精确命中，其余再按文件名匹配
+            relpath = by_mid.get(mid)
+            if relpath:
+                matches[mid] = by_fullname[relpath]
+                continue
+            local_song = self._match_catalog_name(mid)
+            if local_song:
+                matches[mid] = local_song
+                continue
+            singer_names = [s.get("name", "") for s in song.get("singer", [])]
+            name_key = (song.get("name", ""), tuple(singer_names))
+            if name_key not in by_name:
+                matching_songs = self.find_matching_songs(name_key[0], singer_names)
+                by_name[name_key] = matching_songs[0] if matching_songs else None
+            if by_name[name_key]:
+                matches[mid] = by_name[name_key]
+        return matches
+
     def is_song_exists(self, song_name: str, singer_names: List[str]) -> bool:
         """智能检测歌曲是否已存在
         
@@ -301,51 +829,6 @@ class SongIndexManager:
             bool: 歌曲是否已存在
         """
         return len(self.find_matching_songs(song_name, singer_names)) > 0
-    
-    def _generate_possible_basenames(self, song_name: str, singer_names: List[str]) -> List[str]:
-        """生成可能的文件名组合
-        
-        Args:
-            song_name: 歌曲名称
-            singer_names: 歌手名称列表
-            
-        Returns:
-            List[str]: 可能的文件名列表
-        """
-        # 清理特殊字符
-        def clean_name(name: str) -> str:
-            # 移除所有特殊字符，只保留字母、数字、中文和空格
-            return re.sub(r'[\/*?:"<>|/\\]', "", name).rstrip()
-        
-        clean_song_name = clean_name(song_name)
-        clean_singers = [clean_name(singer) for singer in singer_names]
-        
-        # 生成不同的歌手组合
-        singer_combinations = []
-        if clean_singers:
-            singer_combinations.append(", ".join(clean_singers))
-            singer_combinations.append("&".join(clean_singers))
-            singer_combinations.append(clean_singers[0])  # 只使用第一个歌手
-        
-        # 生成可能的文件名
-        possible_basenames = []
-        for singers in singer_combinations:
-            possible_basenames.append(f"{clean_song_name} - {singers}")
-            possible_basenames.append(f"{clean_song_name}{singers}")  # 无分隔符情况
-        
-        # 添加仅歌曲名的情况
-        possible_basenames.append(clean_song_name)
-        
-        # 添加更灵活的匹配模式
-        # 1. 替换空格为无空格
-        no_space_versions = [name.replace(" ", "") for name in possible_basenames]
-        possible_basenames.extend(no_space_versions)
-        
-        # 去重
-        possible_basenames = list(set(possible_basenames))
-        
-        print(f"生成的可能文件名: {possible_basenames}")
-        return possible_basenames
 
 # 创建全局歌曲索引管理器实例
 song_index_manager = SongIndexManager()
@@ -371,7 +854,7 @@ def load_credentials():
 
             # 验证关键字段是否存在，以确保文件有效
             if not all(k in cred_data for k in ['musicid', 'musickey', 'extra_fields']):
-                print("凭证文件不完整，将视为无效。")
+                log.warning("凭证文件不完整，将视为无效。")
                 return None
 
             # 创建一个空对象，然后直接设置其 __class__ 和 __dict__
@@ -381,10 +864,10 @@ def load_credentials():
             
             return credential
         except json.JSONDecodeError:
-            print("凭证文件格式错误，无法解析。")
+            log.warning("凭证文件格式错误，无法解析。")
             return None
         except Exception as e:
-            print(f"加载凭证时发生未知错误: {e}")
+            log.exception("加载凭证时发生未知错误: %s", e)
             return None
     return None
 
@@ -400,7 +883,7 @@ async def check_login_status(credential):
         return True, "登录状态有效"
     except Exception as e:
         # 捕获到任何异常都意味着凭证可能已失效
-        print(f"登录检查失败: {e}")
+        log.warning("登录检查失败: %s", e)
         return False, f"登录状态已失效: {e}"
 
 def clear_credentials():
@@ -409,4 +892,4 @@ def clear_credentials():
         try:
             os.remove(CREDENTIALS_FILE_PATH)
         except OSError as e:
-            print(f"删除凭证文件失败: {e}")
+            log.error("删除凭证文件失败: %s", e)